@@ -0,0 +1,113 @@
+#!/usr/bin/env python2.7
+"""
+Microbenchmark of per-tick session lookups of the x/84 engine.
+
+Usage::
+
+    python bench/engine_sessions.py [<ticks>]
+
+For each number of registered sessions, a tick of the main loop is
+simulated: a fixed number of sessions are ready, each is found by its
+client, as for ready client sockets, and each sends a ``route`` event to
+another session, dispatched by :func:`x84.engine.session_recv`.  The cost
+of a tick should not grow with the number of sessions registered.
+
+The column ``scan`` is the cost of the same lookups by scanning all
+registered sessions, as the engine did previously, for comparison.
+"""
+# std imports
+import logging
+import random
+import sys
+import timeit
+
+# local
+from x84 import engine, terminal
+
+#: numbers of registered sessions measured.
+SESSIONS = (10, 100, 500, 1000, 2000)
+
+#: number of sessions ready at each tick.
+READY = 10
+
+
+class Pipe(object):
+
+    """ Session pipe delivering queued events, in place of a real pipe. """
+
+    def __init__(self):
+        self.events = list()
+
+    def poll(self):
+        """ Whether an event is queued. """
+        return bool(self.events)
+
+    def recv(self):
+        """ Return queued event. """
+        return self.events.pop()
+
+    def send(self, data):
+        """ Discard ``data`` sent to the session. """
+        pass
+
+
+class Session(object):
+
+    """ Registered session, with the attributes used by the engine. """
+
+    def __init__(self, sid):
+        self.sid = sid
+        self.client = object()
+        self.master_read = Pipe()
+        self.master_write = Pipe()
+
+
+def register(num):
+    """ Register ``num`` sessions, as by register_tty(), without pipes. """
+    terminal.TERMINALS.clear()
+    terminal.CLIENT_TERMINALS.clear()
+    for idx in range(num):
+        tty = Session('sid-{0}'.format(idx))
+        terminal.TERMINALS[tty.sid] = tty
+        terminal.CLIENT_TERMINALS[tty.client] = tty
+
+
+def tick(ready, targets, log):
+    """ Find ``ready`` sessions by client, routing an event of each. """
+    terms = list()
+    for tty, target in zip(ready, targets):
+        tty = terminal.find_tty(tty.client)
+        tty.master_read.events.append(('route', (target, 'bench', None)))
+        terms.append((tty.sid, tty))
+    engine.session_recv(dict(), terms, log, False)
+
+
+def tick_scan(ready, targets):
+    """ Same lookups as :func:`tick`, by scanning all sessions. """
+    for tty, target in zip(ready, targets):
+        next(_tty for _, _tty in terminal.get_terminals()
+             if _tty.client == tty.client)
+        next(_tty for _sid, _tty in terminal.get_terminals()
+             if _sid == target).master_write.send(('bench', None))
+
+
+def main(ticks=2000):
+    """ Print cost of a tick, in microseconds, by number of sessions. """
+    log = logging.getLogger(__name__)
+    print('{0:>8} {1:>10} {2:>10}'.format('sessions', 'tick (us)',
+                                          'scan (us)'))
+    for num in SESSIONS:
+        register(num)
+        sessions = terminal.TERMINALS.values()
+        ready = random.sample(sessions, READY)
+        targets = [tty.sid for tty in random.sample(sessions, READY)]
+        elapsed = min(timeit.repeat(lambda: tick(ready, targets, log),
+                                    number=ticks, repeat=3))
+        elapsed_scan = min(timeit.repeat(lambda: tick_scan(ready, targets),
+                                         number=ticks, repeat=3))
+        print('{0:>8} {1:>10.1f} {2:>10.1f}'.format(
+            num, elapsed * 1e6 / ticks, elapsed_scan * 1e6 / ticks))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -13,7 +13,12 @@ from x84.bbs.exception import Disconnected, Goto
 from x84.bbs.ini import get_ini
 from x84.bbs.lightbar import Lightbar
 from x84.bbs.modem import send_modem, recv_modem
-from x84.bbs.msgbase import list_msgs, get_msg, list_tags, Msg, list_privmsgs
+from x84.bbs.msgbase import (list_msgs, get_msg, list_tags, Msg,
+                              list_privmsgs, count_msgs_by_tag, search_msgs,
+                              get_thread, get_thread_root, mark_read,
+                              mark_tags_read, is_read, list_read,
+                              unread_count, count_subscribed, filter_msgs,
+                              get_archived_msg, list_archived_msgs)
 from x84.bbs.output import (echo, timeago, encode_pipe, decode_pipe,
                             syncterm_setfont, showart, ropen,
                             from_cp437,  # deprecated in v2.0
@@ -37,5 +42,9 @@ __all__ = ('list_users', 'get_user', 'find_user', 'User', 'Group', 'list_msgs',
            'goto', 'disconnect', 'getsession', 'getterminal', 'getch', 'gosub',
            'ropen', 'showart', 'Dropfile', 'encode_pipe',
            'decode_pipe', 'syncterm_setfont', 'get_ini', 'send_modem',
-           'recv_modem', 'Script', 'list_privmsgs',
+           'recv_modem', 'Script', 'list_privmsgs', 'count_msgs_by_tag',
+           'search_msgs', 'get_thread', 'get_thread_root', 'mark_read',
+           'mark_tags_read', 'is_read', 'list_read', 'unread_count',
+           'count_subscribed', 'get_archived_msg', 'list_archived_msgs',
+           'filter_msgs',
            )
@@ -1,16 +1,29 @@
 """ Database proxy helper for x/84. """
 # std imports
+import threading
+import itertools
 import logging
+import copy
+import time
 
 # local
 from x84.bbs.ini import get_ini
 from x84.db import (
-    get_db_filepath,
-    get_database,
-    get_db_func,
-    get_db_lock,
-    log_db_cmd,
+    DB_LOCK_ACQUIRE,
+    DB_LOCK_RELEASE,
+    DB_STREAM_CLOSE,
+    DB_STREAM_NEXT,
+    AsyncError,
+    get_db_service,
+    get_written_keys,
 )
+from x84.dbindex import Sequences
+
+#: request ids of asynchronous requests of this session.
+REQUEST_IDS = itertools.count()
+
+#: session read caches, keyed by ``(schema, table)``, see :class:`DBCache`.
+DBCACHES = dict()
 
 
 class DBProxy(object):
@@ -19,8 +32,8 @@ class DBProxy(object):
     Provide dictionary-like object interface to shared database.
 
     A database call, such as __len__() or keys() is issued as a command
-    to the main engine when ``use_session`` is True, which spawns a thread
-    to acquire a lock on the database and return the results via IPC pipe
+    to the main engine when ``use_session`` is True, which queues it to
+    a database worker thread and returns the results via IPC pipe
     transfer.
     """
 
@@ -43,42 +56,62 @@ class DBProxy(object):
 
         from x84.bbs.session import getsession
         self._session = use_session and getsession()
+        self._cache = None
+        if self._session and schema in get_ini('session', 'db_cache',
+                                               split=True):
+            self._cache = get_db_cache(schema, table)
 
     def proxy_iter_session(self, method, *args):
-        """ Proxy for iterable-return method calls over session IPC pipe. """
+        """
+        Proxy for iterable-return method calls over session IPC pipe.
+
+        Items are received in chunks: the next chunk is requested as soon
+        as one is received, so that it may be transferred while the items
+        of the current chunk are consumed.  When iteration is stopped early,
+        chunks already sent are read and discarded until the engine
+        acknowledges the stream is closed.
+        """
         event = 'db={0}'.format(self.schema)
         self._session.flush_event(event)
         self._session.send_event(event, (self.table, method, args))
-        data = self._session.read_event(event)
-        assert data == (None, 'StartIteration'), (
-            'iterable proxy used on non-iterable, {0!r}'.format(data))
-        data = self._session.read_event(event)
-        while data != (None, StopIteration):
-            yield data
-            data = self._session.read_event(event)
-        self._session.flush_event(event)
-
-    def proxy_method_direct(self, method, *args):
-        """ Proxy for direct dictionary method calls. """
-        dictdb = get_database(filepath=get_db_filepath(self.schema),
-                              table=self.table)
+        stream_id, done = None, False
         try:
-            func = get_db_func(dictdb, method)
-            if self._tap_db:
-                log_db_cmd(self.log, self.schema, method, args)
-            return func(*args)
+            while not done:
+                data = self._session.read_event(event)
+                assert isinstance(data, tuple) and len(data) == 3, (
+                    'iterable proxy used on non-iterable, {0!r}'.format(data))
+                stream_id, items, done = data
+                if not done:
+                    self._session.send_event(
+                        event, (self.table, DB_STREAM_NEXT, (stream_id,)))
+                for item in items:
+                    yield item
         finally:
-            dictdb.close()
+            if stream_id is not None and not done:
+                # iteration was stopped early, discard remaining items.
+                self._session.send_event(
+                    event, (self.table, DB_STREAM_CLOSE, (stream_id,)))
+                while self._session.read_event(event) != (
+                        stream_id, None, True):
+                    pass
+
+    def proxy_method_direct(self, method, *args, **kwargs):
+        """ Proxy for direct dictionary method calls. """
+        return get_db_service().call(schema=self.schema, table=self.table,
+                                     cmd=method, args=args,
+                                     iterable=kwargs.get('iterable', False))
 
     def proxy_iter(self, method, *args):
         """ Proxy for iterable dictionary method calls. """
         if self._session:
             return self.proxy_iter_session(method, *args)
 
-        return self.proxy_method_direct(method, *args)
+        return iter(self.proxy_method_direct(method, *args, iterable=True))
 
     def proxy_method(self, method, *args):
         """ Proxy for dictionary method calls. """
+        if self._cache is not None:
+            return self._cache.proxy_method(self, method, *args)
         if self._session:
             return self.proxy_method_session(method, *args)
 
@@ -90,21 +123,104 @@ class DBProxy(object):
         self._session.send_event(event, (self.table, method, args))
         return self._session.read_event(event)
 
+    def proxy_method_async(self, method, *args):
+        """
+        Proxy for dictionary method calls, without waiting for the result.
+
+        :rtype: DBFuture
+        """
+        if not self._session:
+            # no session to dispatch replies, resolve at once.
+            future = DBFuture(None, None)
+            try:
+                future.set_result(self.proxy_method_direct(method, *args))
+            # pylint: disable=W0703
+            #         Catching too general exception
+            except Exception as err:
+                future.set_result(AsyncError(err))
+            return future
+
+        event = 'db-{0}#{1}'.format(self.schema, next(REQUEST_IDS))
+        future = DBFuture(self._session, event)
+        self._session.add_future(event, future)
+        self._session.send_event(event, (self.table, method, args))
+        if self._cache is not None:
+            keys = get_written_keys(method, args)
+            if keys is None or keys:
+                self._cache.invalidate(keys)
+        return future
+
+    def get_async(self, key, default=None):
+        """
+        Return :class:`DBFuture` of ``get(key, default)``.
+
+        The request is sent at once, and the script may continue to draw
+        or read keyboard input while it is performed, for example::
+
+            future = DBProxy('msgbase').get_async('%d' % (next_idx,))
+            # ... display current message ...
+            next_msg = future.result()
+        """
+        return self.proxy_method_async('get', key, default)
+
+    def _lock_holder(self):
+        """ Return lock holder id of this session, or calling thread. """
+        if self._session:
+            return self._session.sid
+        return 'thread-{0}'.format(threading.current_thread().ident)
+
     def acquire(self):
-        """ Acquire system-wide lock on database. """
-        lock = get_db_lock(schema=self.schema, table=self.table)
+        """
+        Acquire bbs-wide lock on database table.
+
+        Locks are held by the database worker of the engine, and exclude
+        all other sessions and engine threads (such as web modules).  This
+        call blocks until the lock is granted.  Locks are re-entrant, and a
+        lock held by a disconnected session is recovered.
+        """
+        holder = self._lock_holder()
         if self._tap_db:
             self.log.debug('lock acquire schema=%s, table=%s',
                            self.schema, self.table)
-        lock.acquire()
+        delay = 0.01
+        while not self.proxy_method(DB_LOCK_ACQUIRE, holder):
+            time.sleep(delay)
+            delay = min(delay * 2, 0.25)
 
     def release(self):
-        """ Release system-wide lock on database. """
-        lock = get_db_lock(schema=self.schema, table=self.table)
+        """ Release bbs-wide lock on database table. """
         if self._tap_db:
             self.log.debug('lock release schema=%s, table=%s',
                            self.schema, self.table)
-        lock.release()
+        self.proxy_method(DB_LOCK_RELEASE, self._lock_holder())
+
+    def atomic_update(self, key, operation, arg, field=None):
+        """
+        Modify value of ``key`` by ``operation``, returning the new value.
+
+        The operation is performed by the database worker within a single
+        transaction, without holding a lock or transferring the old value.
+
+        :param str operation: ``'set-add'`` or ``'set-discard'`` of the
+            items of iterable ``arg``; ``'incr'`` by number ``arg``;
+            ``'dict-merge'`` of dictionary ``arg``; or ``'dict-delete'`` of
+            keys of iterable ``arg``.
+        :param field: when set, the value is a dictionary, and the operation
+            is performed on its item ``field``, such as a user attribute.
+        """
+        return self.proxy_method('atomic_update', key, operation, arg, field)
+
+    def next_id(self, count=1):
+        """
+        Allocate ``count`` new integer keys of this table, returning the first.
+
+        Keys are allocated by a sequence of the same name held by the
+        database worker, see :class:`x84.dbindex.Sequences`, and are never
+        allocated twice, even if the records are later deleted.
+        """
+        sequences = DBProxy(self.schema, table=Sequences.tablename,
+                            use_session=bool(self._session))
+        return sequences.proxy_method('next', self.table, count)
 
     def __enter__(self):
         self.acquire()
@@ -175,16 +291,329 @@ class DBProxy(object):
         return self.proxy_method('keys')
     keys.__doc__ = dict.keys.__doc__
 
-    def pop(self):
-        return self.proxy_method('pop')
+    def pop(self, key, *args):
+        return self.proxy_method('pop', key, *args)
     pop.__doc__ = dict.pop.__doc__
 
     def popitem(self):
         return self.proxy_method('popitem')
     popitem.__doc__ = dict.popitem.__doc__
 
+    def get_many(self, keys, default=None):
+        """ Return list of values for each of ``keys``, or ``default``. """
+        return self.proxy_method('get_many', list(keys), default)
+
+    def set_many(self, items):
+        """ Store all ``(key, value)`` pairs of dictionary ``items``. """
+        return self.proxy_method('update', dict(items))
+
+    def top(self, count=None, field=None, reverse=True, fields=None):
+        """
+        Return list of ``(key, value)`` items, sorted by ``field`` of values.
+
+        Sorting is performed by the database worker, so that only ``count``
+        items are returned.  ``field`` may be an index of tuple values, a key
+        of dictionary values, or an attribute name; by default, values are
+        compared.  When ``fields`` is set, each value is returned as a tuple
+        of only those fields.
+        """
+        return self.proxy_method('top', count, field, reverse, fields)
+
+    def scan(self, prefix=None, start=None, stop=None, limit=None,
+             reverse=False, fields=None):
+        """
+        Return list of ``(key, value)`` items, sorted by key.
+
+        Only keys beginning with ``prefix``, or within range ``start``
+        (inclusive) to ``stop`` (exclusive) are returned, up to ``limit``
+        items.  ``fields`` projects values, as with :meth:`top`.
+        """
+        return self.proxy_method('scan', prefix, start, stop,
+                                 limit, reverse, fields)
+
+    def project(self, fields, keys=None):
+        """
+        Return list of ``(key, fields)``, a tuple of only ``fields`` of values.
+
+        When ``keys`` is ``None``, all records are returned.
+        """
+        return self.proxy_method('project', fields,
+                                 None if keys is None else list(keys))
+
+    def batch(self):
+        """
+        Return a :class:`DBBatch` for this database.
+
+        Operations queued to the batch are sent as a single request when
+        it is executed, and are performed within a single transaction.
+        """
+        return DBBatch(self)
+
     def copy(self):
         # https://github.com/piskvorky/sqlitedict/issues/20
         # @jquast: should sqlitedict have a .copy() method? "no."
         return dict(self.proxy_method('items'))
     copy.__doc__ = dict.copy.__doc__
+
+
+class DBBatch(object):
+
+    """
+    Queue dictionary methods of a :class:`DBProxy`, sent as a single request.
+
+    Used as a context manager, the operations are executed on exit, unless
+    an exception was raised::
+
+        with DBProxy('userbase', 'attrs').batch() as batch:
+            batch.get(u'biff')
+            batch[u'chip'] = dict()
+        attrs, _ = batch.results
+
+    Each method returns the index of its return value in :attr:`results`.
+    All operations are performed within a single database transaction: when
+    any operation raises an exception, no changes are made.
+    """
+
+    def __init__(self, proxy):
+        """
+        Class initializer.
+
+        :param DBProxy proxy: database of operations.
+        """
+        self.proxy = proxy
+        self.operations = list()
+        #: list of return values of operations, set by :meth:`execute`.
+        self.results = None
+
+    def queue(self, method, *args):
+        """ Queue dictionary ``method`` with arguments ``args``. """
+        self.operations.append((method, args))
+        return len(self.operations) - 1
+
+    def execute(self):
+        """ Send queued operations, returning list of their results. """
+        operations, self.operations = self.operations, list()
+        self.results = list()
+        if operations:
+            self.results = self.proxy.proxy_method('batch', operations)
+        return self.results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is None:
+            self.execute()
+
+    # pylint: disable=C0111
+    #        Missing docstring
+    def has_key(self, key):
+        return self.queue('has_key', key)
+
+    def __getitem__(self, key):
+        return self.queue('__getitem__', key)
+
+    def __setitem__(self, key, value):
+        return self.queue('__setitem__', key, value)
+
+    def __delitem__(self, key):
+        return self.queue('__delitem__', key)
+
+    def get(self, key, default=None):
+        return self.queue('get', key, default)
+
+    def setdefault(self, key, default=None):
+        return self.queue('setdefault', key, default)
+
+    def pop(self, key, *args):
+        return self.queue('pop', key, *args)
+
+    def update(self, items):
+        return self.queue('update', dict(items))
+
+    def atomic_update(self, key, operation, arg, field=None):
+        return self.queue('atomic_update', key, operation, arg, field)
+
+
+class DBFuture(object):
+
+    """
+    Result of an asynchronous :class:`DBProxy` request.
+
+    The result is received by :meth:`x84.bbs.session.Session.buffer_event`,
+    which is called by any ``read_event`` or ``read_events`` of the session,
+    such as when waiting for keyboard input.  Callbacks registered by
+    :meth:`add_done_callback` are then called with this future.
+    """
+
+    def __init__(self, session, event):
+        """
+        Class initializer.
+
+        :param x84.bbs.session.Session session: session receiving result.
+        :param str event: unique reply event name of request.
+        """
+        self._session = session
+        self.event = event
+        self._done = False
+        self._result = None
+        self._callbacks = list()
+
+    def done(self):
+        """ Whether the result has been received. """
+        return self._done
+
+    def set_result(self, data):
+        """ Resolve future with ``data``, calling any callbacks. """
+        self._done, self._result = True, data
+        callbacks, self._callbacks = self._callbacks, list()
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        """ Call ``callback(future)`` once resolved, or at once if done. """
+        if self._done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def result(self, timeout=None):
+        """
+        Return result of request, waiting up to ``timeout`` seconds.
+
+        :raises Exception: the exception raised by the request.
+        :raises RuntimeError: the result was not received within timeout.
+        """
+        if not self._done:
+            self._session.read_events((self.event,), timeout=timeout)
+        if not self._done:
+            raise RuntimeError('{0}: no result within {1}s'
+                               .format(self.event, timeout))
+        if isinstance(self._result, AsyncError):
+            raise self._result.error
+        return self._result
+
+
+class DBCache(object):
+
+    """
+    Least-recently-used read cache of a database table, for a session.
+
+    Enabled for database schemas listed by option ``db_cache`` of section
+    ``[session]``.  The engine broadcasts an event to all sessions when any
+    session or engine thread modifies a cached schema, which is received by
+    :meth:`x84.bbs.session.Session.buffer_event` and passed to
+    :func:`invalidate_db_cache`.  Values are copied, so that modifying a
+    returned value does not modify the cache.
+    """
+
+    #: methods answered by a single record, ``(method, args[0])``.
+    RECORD_METHODS = ('get', '__getitem__', '__contains__', 'has_key')
+
+    #: methods answered by the whole table, ``(method,)``.
+    TABLE_METHODS = ('keys', 'values', 'items', '__len__')
+
+    def __init__(self, size):
+        """
+        Class initializer.
+
+        :param int size: maximum number of cached entries.
+        """
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = dict()
+        self._tick = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _lookup(self, key):
+        """ Return ``(found, value)`` of cache entry ``key``. """
+        if key not in self._entries:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        self._tick += 1
+        self._entries[key][0] = self._tick
+        return True, copy.deepcopy(self._entries[key][1])
+
+    def _store(self, key, value):
+        """ Store cache entry ``key``, evicting the least recently used. """
+        if len(self._entries) >= self.size and key not in self._entries:
+            oldest = min(self._entries,
+                         key=lambda _key: self._entries[_key][0])
+            del self._entries[oldest]
+        self._tick += 1
+        self._entries[key] = [self._tick, copy.deepcopy(value)]
+
+    def invalidate(self, keys):
+        """ Discard entries of ``keys``, or all entries when ``None``. """
+        if keys is None:
+            self._entries.clear()
+            return
+        for key in keys:
+            self._entries.pop(('record', key), None)
+        for method in self.TABLE_METHODS:
+            self._entries.pop((method,), None)
+
+    def proxy_method(self, proxy, method, *args):
+        """ Return result of ``method`` of ``proxy`` from cache, if able. """
+        if method in self.RECORD_METHODS:
+            found, record = self._lookup(('record', args[0]))
+            if not found:
+                record = proxy.proxy_method_session(
+                    'batch', [('__contains__', (args[0],)),
+                              ('get', (args[0], None))])
+                self._store(('record', args[0]), record)
+            exists, value = record
+            if method in ('__contains__', 'has_key'):
+                return exists
+            if method == 'get':
+                return value if exists else args[1]
+            if not exists:
+                raise KeyError(args[0])
+            return value
+
+        if method in self.TABLE_METHODS:
+            found, value = self._lookup((method,))
+            if not found:
+                value = proxy.proxy_method_session(method)
+                self._store((method,), value)
+            return value
+
+        result = proxy.proxy_method_session(method, *args)
+        # invalidate our own writes at once, the broadcast of the engine
+        # may not be received until later.
+        keys = get_written_keys(method, args)
+        if keys is None or keys:
+            self.invalidate(keys)
+        return result
+
+
+def get_db_cache(schema, table):
+    """ Return :class:`DBCache` of this session for ``(schema, table)``. """
+    key = (schema, table)
+    if key not in DBCACHES:
+        DBCACHES[key] = DBCache(
+            size=get_ini('session', 'db_cache_size', getter='getint') or 256)
+    return DBCACHES[key]
+
+
+def invalidate_db_cache(schema, table, keys):
+    """ Discard modified ``keys`` of cache, or all keys when ``None``. """
+    if (schema, table) in DBCACHES:
+        DBCACHES[(schema, table)].invalidate(keys)
+
+
+def get_db_cache_stats():
+    """
+    Return hit and miss counters of session read caches.
+
+    :rtype: dict
+    :returns: dictionary keyed by ``(schema, table)`` of dictionaries with
+              keys ``hits``, ``misses`` and ``size`` (number of entries).
+    """
+    return dict((key, dict(hits=cache.hits, misses=cache.misses,
+                           size=len(cache)))
+                for key, cache in DBCACHES.items())
@@ -120,6 +120,10 @@ def init_bbs_ini():
     cfg_bbs.set('system', 'datapath', os.path.expanduser(os.path.join(
         os.path.join('~', '.x84', 'data'))))
     cfg_bbs.set('system', 'timeout', '1984')
+    # number of database worker threads of the engine
+    cfg_bbs.set('system', 'db_workers', '4')
+    # number of items of each chunk of database iterators
+    cfg_bbs.set('system', 'db_chunk_size', '256')
 
     try:
         # pylint: disable=W0612
@@ -219,6 +223,9 @@ def init_bbs_ini():
     cfg_bbs.set('session', 'tap_events', 'no')
     cfg_bbs.set('session', 'tap_db', 'no')
     cfg_bbs.set('session', 'default_encoding', 'utf8')
+    # database schemas cached by each session, such as 'userbase, tags'
+    cfg_bbs.set('session', 'db_cache', '')
+    cfg_bbs.set('session', 'db_cache_size', '256')
 
     cfg_bbs.add_section('irc')
     cfg_bbs.set('irc', 'server', 'efnet.portlane.se')
@@ -256,6 +263,14 @@ def init_bbs_ini():
     # those of the groups specified may.
     cfg_bbs.set('msg', 'moderated_tags', 'no')
     cfg_bbs.set('msg', 'tag_moderators', 'sysop, moderator')
+    # messages of a tag are archived after a number of days, such as
+    # 'public: 365', or beyond a number of newest messages, 'x84net: 5000'.
+    cfg_bbs.set('msg', 'retain_days', '')
+    cfg_bbs.set('msg', 'retain_count', '')
+    cfg_bbs.set('msg', 'archive_interval', '86400')
+    # message bodies of at least this many bytes are stored compressed,
+    # or '0' to disable.
+    cfg_bbs.set('msg', 'body_compress_min', '512')
 
     return cfg_bbs
 
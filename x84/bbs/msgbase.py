@@ -1,10 +1,18 @@
 """ Messaging database package for x/84. """
 # std imports
+import collections
+import threading
 import datetime
 import logging
+import cPickle
+import struct
+import time
+import zlib
+import os
 
 # local
 from x84.bbs.dbproxy import DBProxy
+from x84.dbindex import split_terms
 from x84.bbs.session import getsession
 from x84.bbs.ini import get_ini
 
@@ -13,11 +21,32 @@ import dateutil.tz
 
 MSGDB = 'msgbase'
 TAGDB = 'tags'
+TAGIDX = 'tagindex'
+READIDX = 'readindex'
+BODYDB = 'bodies'
+SEARCHIDX = 'searchindex'
+THREADIDX = 'threadindex'
 PRIVDB = 'privmsg'
+ARCHIVEDB = 'msgarchive'
+ARCHIVEIDX = 'archiveindex'
+TRANSIDX = 'transindex'
+
+#: header of each message of the archive file: its index and length.
+ARCHIVE_HEADER = struct.Struct('>QI')
+
+#: bodies of at least this many bytes are stored compressed, by default.
+BODY_COMPRESS_MIN = 512
+
+#: notified of new messages saved, see :func:`wait_newmsg`.
+NEWMSG_CONDITION = threading.Condition()
+
+#: number of new messages saved of each tag, see :func:`notify_newmsg`.
+NEWMSG_COUNT = collections.Counter()
 
 # TODO(jquast, maze): Use modeling to construct rfc-compliant mail messaging
 # formats.  It would be possible to use standard mbox-formatted mail boxes,
-# and integrate with external systems.  This is a v3.0 release.
+# and integrate with external systems.  This is a v3.0 release.  For now,
+# messages may be imported and exported in bulk by x84.msgmail.
 
 
 def to_localtime(tm_value):
@@ -56,17 +85,166 @@ def get_msg(idx=0):
     return DBProxy(MSGDB)['%d' % int(idx)]
 
 
+def get_msg_body(idx):
+    """ Return body of message by index ``idx``. """
+    return decompress_body(
+        DBProxy(MSGDB, table=BODYDB).get('%d' % int(idx), u''))
+
+
+def compress_body(body, min_length=None):
+    """
+    Return message ``body`` as stored by table ``bodies``.
+
+    Bodies of at least ``min_length`` bytes, default is configuration item
+    ``body_compress_min`` of section ``[msg]``, are stored as a tuple of
+    ``('zlib', data)``, and others are stored unchanged.  A value of ``0``
+    disables compression.
+    """
+    if min_length is None:
+        min_length = get_ini(section='msg', key='body_compress_min',
+                             getter='getint')
+        if min_length == u'':
+            min_length = BODY_COMPRESS_MIN
+    data = (body or u'').encode('utf8')
+    if min_length and len(data) >= min_length:
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data):
+            return ('zlib', compressed)
+    return body
+
+
+def decompress_body(value):
+    """ Return message body of ``value`` as stored by table ``bodies``. """
+    if isinstance(value, tuple) and value[0] == 'zlib':
+        return zlib.decompress(value[1]).decode('utf8')
+    return value
+
+
 def list_msgs(tags=None):
     """ Return set of indices matching ``tags``, or all by default. """
     if tags is not None and 0 != len(tags):
-        msgs = set()
-        db_tag = DBProxy(TAGDB)
-        for tag in (_tag for _tag in tags if _tag in db_tag):
-            msgs.update(db_tag[tag])
-        return msgs
+        return DBProxy(TAGDB, table=TAGIDX).proxy_method(
+            'list_msgs', list(tags))
     return set(int(key) for key in DBProxy(MSGDB).keys())
 
 
+def filter_msgs(indices, tags):
+    """
+    Return set of messages of ``indices`` tagged by any of ``tags``.
+
+    Unlike intersecting with :func:`list_msgs`, only the tags of the given
+    messages are read.
+    """
+    if not indices or not tags:
+        return set()
+    return DBProxy(TAGDB, table=TAGIDX).proxy_method(
+        'filter_msgs', list(indices), list(tags))
+
+
+def search_msgs(query, tags=None):
+    """
+    Return set of indices of messages matching all words of ``query``.
+
+    Words are matched against the subject and body of messages, without
+    regard to case.  A word ending with ``*`` matches any word it begins,
+    such as ``pyth*``.  When ``tags`` is given, only messages of any of
+    those tags are returned.
+    """
+    terms, prefixes = set(), set()
+    for word in query.split():
+        if word.endswith(u'*'):
+            prefixes.update(split_terms(word[:-1]))
+        else:
+            terms.update(split_terms(word))
+    msgs = DBProxy(MSGDB, table=SEARCHIDX).proxy_method(
+        'search', list(terms), list(prefixes))
+    if msgs and tags is not None and 0 != len(tags):
+        msgs &= list_msgs(tags)
+    return msgs
+
+
+def get_thread(root):
+    """
+    Return thread of message ``root``, depth-first.
+
+    :rtype: list
+    :returns: ``(idx, depth)`` of ``root`` and all replies beneath it,
+              each message followed by its replies in the order they were
+              saved.  ``depth`` is relative to ``root``.
+    """
+    return DBProxy(MSGDB, table=THREADIDX).proxy_method(
+        'get_thread', int(root))
+
+
+def get_thread_root(idx):
+    """ Return index of first message of thread of message ``idx``. """
+    return DBProxy(MSGDB, table=THREADIDX).proxy_method(
+        'get_root', int(idx))
+
+
+def mark_read(handle, indices):
+    """ Mark messages ``indices`` as read by user ``handle``. """
+    DBProxy(TAGDB, table=READIDX).proxy_method(
+        'mark_read', handle, list(indices))
+
+
+def mark_tags_read(handle, tags, until=None):
+    """
+    Mark all messages of ``tags`` as read by user ``handle``.
+
+    When ``until`` is given, only messages up to that index are marked.
+    """
+    DBProxy(TAGDB, table=READIDX).proxy_method(
+        'mark_tags_read', handle, list(tags), until)
+
+
+def is_read(handle, idx):
+    """ Whether message ``idx`` has been read by user ``handle``. """
+    return DBProxy(TAGDB, table=READIDX).proxy_method(
+        'is_read', handle, int(idx))
+
+
+def list_read(handle, indices):
+    """ Return subset of messages ``indices`` read by user ``handle``. """
+    return DBProxy(TAGDB, table=READIDX).proxy_method(
+        'list_read', handle, list(indices))
+
+
+def unread_count(handle, tags):
+    """ Return number of messages of ``tags`` not read by user ``handle``. """
+    return DBProxy(TAGDB, table=READIDX).proxy_method(
+        'unread_count', handle, list(tags))
+
+
+def count_subscribed(handle, subscriptions):
+    """
+    Return number of public messages of each subscription.
+
+    Counts are kept by the database as messages are saved and read, and
+    do not depend on the number of messages.
+
+    :param list subscriptions: lists of tag patterns, such as
+        ``[[u'public'], [u'lang-*', u'python']]``.
+    :rtype: list
+    :returns: ``(unread, total)`` for each subscription, for user ``handle``.
+    """
+    return DBProxy(TAGDB, table=READIDX).proxy_method(
+        'get_views', handle, [list(patterns) for patterns in subscriptions])
+
+
+def migrate_readmsgs(user):
+    """
+    Move messages read by ``user`` from user attribute ``readmsgs``.
+
+    Previous versions stored a set of all messages read by each user as
+    attribute ``readmsgs``, see :func:`mark_read`.
+    """
+    readmsgs = user.get('readmsgs', None)
+    if readmsgs is not None:
+        mark_read(user.handle, readmsgs)
+        del user['readmsgs']
+
+
 def list_privmsgs(handle=None):
     """ Return all private messages for given user handle. """
     db_priv = DBProxy(PRIVDB)
@@ -78,7 +256,119 @@ def list_privmsgs(handle=None):
 
 def list_tags():
     """ Return set of available tags. """
-    return [_tag.decode('utf8') for _tag in DBProxy(TAGDB).keys()]
+    return [_tag.decode('utf8') for _tag in
+            DBProxy(TAGDB, table=TAGIDX).proxy_method('list_tags')]
+
+
+def count_msgs_by_tag():
+    """ Return dictionary of number of messages, keyed by tag. """
+    return dict((_tag.decode('utf8'), count) for _tag, count in
+                DBProxy(TAGDB, table=TAGIDX).proxy_method(
+                    'count_msgs').items())
+
+
+def get_archive_filepath():
+    """ Return filesystem path of the message archive file. """
+    return os.path.join(get_ini('system', 'datapath'),
+                        '{0}.dat'.format(ARCHIVEDB))
+
+
+def dump_archived_msg(msg):
+    """ Return message ``msg`` and its body, compressed for the archive. """
+    return zlib.compress(cPickle.dumps((msg, msg.body),
+                                       cPickle.HIGHEST_PROTOCOL))
+
+
+def load_archived_msg(data):
+    """ Return Msg instance of archive record ``data``, with its body. """
+    msg, body = cPickle.loads(zlib.decompress(data))
+    msg.body = body
+    return msg
+
+
+def get_archived_msg(idx):
+    """
+    Return archived Msg instance by index ``idx``.
+
+    :raises KeyError: message ``idx`` is not archived.
+    """
+    location = DBProxy(ARCHIVEDB, table=ARCHIVEIDX).proxy_method(
+        'locate', int(idx))
+    if location is None:
+        raise KeyError(idx)
+    offset, length = location
+    with open(get_archive_filepath(), 'rb') as fobj:
+        fobj.seek(offset)
+        return load_archived_msg(fobj.read(length))
+
+
+def list_archived_msgs(tags=None):
+    """ Return set of archived messages matching ``tags``, or all. """
+    return DBProxy(ARCHIVEDB, table=ARCHIVEIDX).proxy_method(
+        'list_msgs', list(tags) if tags else None)
+
+
+def broadcast_newmsg(msg, session=None):
+    """
+    Broadcast event ``newmsg`` of new message ``msg`` to all sessions.
+
+    The event data is a dictionary of the message's ``idx``, ``tags``,
+    ``recipient`` and ``parent``, so that sessions may update their view
+    of the message base without querying it.  When not called by a
+    session, such as by the message network poller, the event is sent
+    directly to the sessions of the engine.
+    """
+    data = {'idx': msg.idx,
+            'tags': set(msg.tags),
+            'recipient': msg.recipient,
+            'parent': msg.parent}
+    if session is not None:
+        session.send_event('global', ('newmsg', data))
+        return
+    notify_newmsg(data)
+    from x84.terminal import get_terminals
+    for _, tty in get_terminals():
+        try:
+            tty.master_write.send(('global', ('newmsg', data)))
+        except (IOError, OSError):
+            # session is disconnecting
+            pass
+
+
+def notify_newmsg(data):
+    """
+    Count new message of ``newmsg`` event ``data``, waking any waiting.
+
+    Called within the engine process for each new message, whether saved
+    by a session or by the engine, see :func:`broadcast_newmsg`.
+    """
+    with NEWMSG_CONDITION:
+        NEWMSG_COUNT.update(data['tags'])
+        NEWMSG_CONDITION.notify_all()
+
+
+def get_newmsg_count(tag):
+    """ Return number of new messages of ``tag``, see :func:`wait_newmsg`. """
+    with NEWMSG_CONDITION:
+        return NEWMSG_COUNT[tag]
+
+
+def wait_newmsg(tag, count, timeout):
+    """
+    Wait up to ``timeout`` seconds for a new message of ``tag``.
+
+    Only messages saved within the engine process, or by its sessions, are
+    noticed.
+
+    :param int count: value of :func:`get_newmsg_count` when last checked.
+    :rtype: bool
+    :returns: whether a new message was saved since ``count``.
+    """
+    deadline = time.time() + timeout
+    with NEWMSG_CONDITION:
+        while NEWMSG_COUNT[tag] == count and time.time() < deadline:
+            NEWMSG_CONDITION.wait(deadline - time.time())
+        return NEWMSG_COUNT[tag] != count
 
 
 class Msg(object):
@@ -98,7 +388,13 @@ class Msg(object):
 
     - ``parent`` points to the message this message directly refers to.
 
-    - ``children`` is a set of indices replied by this message.
+    - ``children`` is a set of indices replied by this message, retrieved
+      from the thread index of the msgbase.
+
+    The ``body`` of a saved message is stored apart from the other
+    properties, by table ``bodies`` of the msgbase, and is only retrieved
+    when first accessed; listing messages by their headers does not
+    transfer their bodies.
     """
 
     # pylint: disable=R0902
@@ -121,6 +417,50 @@ class Msg(object):
         """
         return self._stime
 
+    @property
+    def body(self):
+        """
+        Message body, retrieved from database when first accessed.
+
+        :rtype: unicode
+        """
+        if self._body is None:
+            self._body = (u'' if self.idx is None
+                          else get_msg_body(self.idx))
+        return self._body
+
+    @body.setter
+    def body(self, value):
+        # pylint: disable=C0111
+        #         Missing docstring
+        self._body = value
+
+    @property
+    def children(self):
+        """
+        Indices of messages replying to this message.
+
+        :rtype: set
+        """
+        if self.idx is None:
+            return set()
+        return set(DBProxy(MSGDB, table=THREADIDX).proxy_method(
+            'get_children', self.idx))
+
+    def __getstate__(self):
+        # the body is stored apart, see save().
+        state = self.__dict__.copy()
+        state['_body'] = None
+        return state
+
+    def __setstate__(self, state):
+        if 'body' in state:
+            # records saved by previous versions include their body.
+            state['_body'] = state.pop('body')
+        # children are now retrieved from the thread index.
+        state.pop('children', None)
+        self.__dict__.update(state)
+
     def __init__(self, recipient=None, subject=u'', body=u''):
         self.author = None
         session = getsession()
@@ -131,9 +471,8 @@ class Msg(object):
         self._stime = None
         self.recipient = recipient
         self.subject = subject
-        self.body = body
+        self._body = body
         self.tags = set()
-        self.children = set()
         self.parent = None
         self.idx = None
 
@@ -150,57 +489,45 @@ class Msg(object):
         new = self.idx is None or self._stime is None
 
         # persist message record to MSGDB
-        with DBProxy(MSGDB, use_session=use_session) as db_msg:
-            if new:
-                self.idx = max(map(int, db_msg.keys()) or [-1]) + 1
-                if ctime is not None:
-                    self._ctime = self._stime = ctime
-                else:
-                    self._stime = datetime.datetime.now()
-                new = True
-            db_msg['%d' % (self.idx,)] = self
-
-        # persist message idx to TAGDB
-        with DBProxy(TAGDB, use_session=use_session) as db_tag:
-            for tag in db_tag.keys():
-                msgs = db_tag[tag]
-                if tag in self.tags and self.idx not in msgs:
-                    msgs.add(self.idx)
-                    db_tag[tag] = msgs
-                    log.debug("msg {self.idx} tagged '{tag}'"
-                              .format(self=self, tag=tag))
-                elif tag not in self.tags and self.idx in msgs:
-                    msgs.remove(self.idx)
-                    db_tag[tag] = msgs
-                    log.info("msg {self.idx} removed tag '{tag}'"
-                             .format(self=self, tag=tag))
-            for tag in [_tag for _tag in self.tags if _tag not in db_tag]:
-                db_tag[tag] = set([self.idx])
-
-        # persist message as child to parent;
-        assert self.parent not in self.children, ('circular reference',
-                                                  self.parent, self.children)
-        if self.parent is not None:
-            try:
-                parent_msg = get_msg(self.parent)
-            except KeyError:
-                log.warn('Child message {0}.parent = {1}: '
-                         'parent does not exist!'.format(self.idx, self.parent))
+        db_msg = DBProxy(MSGDB, use_session=use_session)
+        db_body = DBProxy(MSGDB, table=BODYDB, use_session=use_session)
+        if new:
+            self.idx = db_msg.next_id()
+            if ctime is not None:
+                self._ctime = self._stime = ctime
             else:
-                if self.idx != parent_msg.idx:
-                    parent_msg.children.add(self.idx)
-                    parent_msg.save()
-                else:
-                    log.error('Parent idx same as message idx; stripping')
-                    self.parent = None
-                    with db_msg:
-                        db_msg['%d' % (self.idx)] = self
+                self._stime = datetime.datetime.now()
+            new = True
+        if self.parent is not None and self.parent == self.idx:
+            log.error('Parent idx same as message idx; stripping')
+            self.parent = None
+
+        # persist message to thread index beneath its parent, first, as
+        # it refuses a circular reference.
+        _, depth = DBProxy(MSGDB, table=THREADIDX,
+                           use_session=use_session).proxy_method(
+            'set_parent', self.idx, self.parent)
+        if self.parent is not None and depth == 0:
+            log.warn('Child message {0}.parent = {1}: '
+                     'parent does not exist!'.format(self.idx, self.parent))
+
+        if self._body is not None:
+            # body is written first, to be found by readers of the record.
+            db_body['%d' % (self.idx,)] = compress_body(self._body)
+            DBProxy(MSGDB, table=SEARCHIDX,
+                    use_session=use_session).proxy_method(
+                'set_terms', self.idx, list(split_terms(self.subject) |
+                                            split_terms(self._body)))
+        db_msg['%d' % (self.idx,)] = self
+
+        # persist message idx to TAGDB, updating views of unread messages.
+        DBProxy(TAGDB, table=READIDX, use_session=use_session).proxy_method(
+            'set_tags', self.idx, list(self.tags))
 
         # persist message record to PRIVDB
         if 'public' not in self.tags:
-            with DBProxy(PRIVDB, use_session=use_session) as db_priv:
-                db_priv[self.recipient] = (
-                    db_priv.get(self.recipient, set()) | set([self.idx]))
+            DBProxy(PRIVDB, use_session=use_session).atomic_update(
+                self.recipient, 'set-add', (self.idx,))
 
         # if either any of 'server_tags' or 'network_tags' are enabled,
         # then queue for potential delivery.
@@ -210,6 +537,10 @@ class Msg(object):
         ):
             self.queue_for_network()
 
+        # broadcast once queued, waking msgpoll to publish it.
+        if new:
+            broadcast_newmsg(self, session)
+
         log.info(
             u"saved {new} {public_or_private} {message_or_reply}"
             u", addressed to '{self.recipient}'."
@@ -220,6 +551,34 @@ class Msg(object):
                                       else 'reply'),
                     self=self))
 
+    def delete(self):
+        """
+        Remove message from database, and from all of its indices.
+
+        Replies to this message are moved to its parent, see
+        :meth:`x84.dbindex.ThreadIndex.remove`.
+        """
+        use_session = bool(getsession() is not None)
+        key = '%d' % (self.idx,)
+        networks = set(get_ini(section='msg', key='server_tags', split=True) +
+                       get_ini(section='msg', key='network_tags', split=True))
+
+        # removed from tags first, so that it is no longer listed.
+        DBProxy(TAGDB, table=READIDX, use_session=use_session).proxy_method(
+            'set_tags', self.idx, [])
+        DBProxy(MSGDB, table=SEARCHIDX, use_session=use_session).proxy_method(
+            'remove', self.idx)
+        DBProxy(MSGDB, table=THREADIDX, use_session=use_session).proxy_method(
+            'remove', self.idx)
+        if 'public' not in self.tags:
+            DBProxy(PRIVDB, use_session=use_session).atomic_update(
+                self.recipient, 'set-discard', (self.idx,))
+        for tag in networks & set(self.tags):
+            DBProxy('{0}trans'.format(tag), table=TRANSIDX,
+                    use_session=use_session).proxy_method('remove', self.idx)
+        DBProxy(MSGDB, table=BODYDB, use_session=use_session).pop(key, None)
+        DBProxy(MSGDB, use_session=use_session).pop(key, None)
+
     def queue_for_network(self):
         """ Queue message for networks, hosting or sending. """
         log = logging.getLogger(__name__)
@@ -231,10 +590,10 @@ class Msg(object):
             # server networks offered by this server,
             # message is for a network we host
             if tag in get_ini(section='msg', key='server_tags', split=True):
-                with DBProxy('{0}trans'.format(tag)) as transdb:
-                    self.body = u''.join((self.body, format_origin_line()))
-                    self.save()
-                    transdb[self.idx] = self.idx
+                self.body = u''.join((self.body, format_origin_line()))
+                self.save()
+                DBProxy('{0}trans'.format(tag), table=TRANSIDX).proxy_method(
+                    'add', self.idx, self.idx)
                 log.info('[{tag}] Stored for network (msgid {self.idx}).'
                          .format(tag=tag, self=self))
 
@@ -140,6 +140,9 @@ class Session(object):
         # create event buffer
         self._buffer = dict()
 
+        # pending asynchronous database requests, keyed by reply event
+        self._futures = dict()
+
     def to_dict(self):
         """ Dictionary describing this session. """
         retval = {
@@ -437,7 +440,8 @@ class Session(object):
 
         - ``global``: events where the first index of ``data`` is ``AYT``.
           This is sent by other sessions using the ``broadcast`` event, to
-          discover "who is online".
+          discover "who is online".  All other ``global`` events are
+          buffered by the name of their first index, such as ``newmsg``.
 
         - ``info-req``: Where the first data value is the remote session-id
           that requested it, expecting a return value event of ``info-ack``
@@ -446,6 +450,13 @@ class Session(object):
 
         - ``gosub``: Allows one session to send another to a different script,
           this is used by the default board ``chat.py`` for a chat request.
+
+        - ``db-invalidate``: records of a database schema, cached by
+          :class:`x84.bbs.dbproxy.DBCache`, were modified.
+
+        - replies of asynchronous database requests, registered by
+          :meth:`add_future`, which resolve a
+          :class:`x84.bbs.dbproxy.DBFuture`.
         """
         # exceptions aren't buffered; they are thrown!
         if event == 'exception':
@@ -464,6 +475,25 @@ class Session(object):
                 self.sid, self.user.handle,))
             return True
 
+        # events broadcast by other sessions, such as ('newmsg', data), are
+        # buffered by their own name.  They are meant to be disregarded when
+        # not read, and are discarded once their (shorter) queue is full.
+        maxlen = 65534
+        if event == 'global':
+            event, data = self._unpack_global(event, data)
+            maxlen = 128
+
+        # resolve asynchronous database requests
+        if event in self._futures:
+            self._futures.pop(event).set_result(data)
+            return True
+
+        # discard records of our database read cache modified by others
+        if event == 'db-invalidate':
+            from x84.bbs.dbproxy import invalidate_db_cache
+            invalidate_db_cache(*data)
+            return True
+
         # accept 'gosub' as a literal command to run a new script directly
         # from this buffer_event method.  I'm sure it's fine ...
         if event == 'gosub':
@@ -501,9 +531,7 @@ class Session(object):
             # shorter queue length is used. only the foremost refresh event is
             # important in the case of screen resize.
             self._buffer[event] = collections.deque(
-                maxlen={'global': 128,
-                        'refresh': 1,
-                        }.get(event, 65534))
+                maxlen={'refresh': 1}.get(event, maxlen))
 
         # buffer input
         if event == 'input':
@@ -640,9 +668,17 @@ class Session(object):
                 # side-effects may occur by doing so.  When buffer_event
                 # returns True, those side-effects caused no data to be
                 # buffered, and one should not try to return any data for it.
-                if not self.buffer_event(event, data):
+                handled = self.buffer_event(event, data)
+                # events broadcast by other sessions are matched by their
+                # own name, such as 'newmsg', as they are buffered.
+                event, data = self._unpack_global(event, data)
+                if not handled:
                     if event in events:
                         return event, self._buffer[event].pop()
+                elif event in events:
+                    # handled without buffering, such as the reply of an
+                    # asynchronous database request awaited by its future.
+                    return event, data
             else:
                 event, data = self._pop_event_buffer(events)
                 if event is not None:
@@ -652,6 +688,28 @@ class Session(object):
             waitfor = timeleft(stime)
         return (None, None)
 
+    def add_future(self, event, future):
+        """
+        Resolve ``future`` by data of ``event``, when received.
+
+        :param str event: unique event name of reply.
+        :param x84.bbs.dbproxy.DBFuture future: future to resolve.
+        """
+        self._futures[event] = future
+
+    @staticmethod
+    def _unpack_global(event, data):
+        """
+        Return ``(event, data)`` of a ``global`` event by its own name.
+
+        Events broadcast by other sessions, such as ``('newmsg', data)``,
+        are named by the first index of their data.  Other events are
+        returned unchanged.
+        """
+        if event == 'global':
+            return data[0], (data[1] if len(data) == 2 else data[1:])
+        return event, data
+
     def _pop_event_buffer(self, events):
         """
         Return immediately any event-data already buffered.
@@ -711,7 +769,16 @@ class Session(object):
         return value
 
     def close(self):
-        """ Close session, currently releases ``node`` lock.. """
+        """
+        Close session, currently releases ``node`` lock..
+
+        Counters of database read caches of the session are logged.
+        """
+        from x84.bbs.dbproxy import get_db_cache_stats
+        for (schema, table), stats in get_db_cache_stats().items():
+            self.log.debug('db cache {schema}/{table}: {hits} hits, '
+                           '{misses} misses, {size} entries.'
+                           .format(schema=schema, table=table, **stats))
         if self._node is not None:
             self.send_event(
                 event='lock-node/%d' % (self._node),
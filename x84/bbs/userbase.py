@@ -172,13 +172,7 @@ class User(object):
             log.debug("set attr {!r} not possible for 'anonymous'".format(key))
             return
 
-        with adb:
-            if self.handle not in adb:
-                adb[self.handle] = dict([(key, value), ])
-            else:
-                attrs = adb[self.handle]
-                attrs.__setitem__(key, value)
-                adb[self.handle] = attrs
+        adb.atomic_update(self.handle, 'dict-merge', {key: value})
         log.debug("set attr {!r} for user {!r}.".format(key, self.handle))
     __setitem__.__doc__ = dict.__setitem__.__doc__
 
@@ -189,13 +183,13 @@ class User(object):
         log = logging.getLogger(__name__)
         adb = DBProxy(USERDB, 'attrs')
 
-        if self.handle not in adb:
+        attrs = adb.get(self.handle, None)
+        if attrs is None:
             if ini.CFG.getboolean('session', 'tap_db'):
                 log.debug('User({!r}).get(key={!r}) returns default={!r}'
                           .format(self.handle, key, default))
             return default
 
-        attrs = adb.get(self.handle, {})
         if key not in attrs:
             if ini.CFG.getboolean('session', 'tap_db'):
                 log.debug('User({!r}.get(key={!r}) returns default={!r}'
@@ -219,17 +213,26 @@ class User(object):
         #        Missing docstring
         log = logging.getLogger(__name__)
         uadb = DBProxy(USERDB, 'attrs')
-        with uadb:
-            # retrieve attributes from uadb,
-            attrs = uadb.get(self.handle, {})
-            # delete attribute if exists
-            if key in attrs:
-                attrs.__delitem__(key)
-                uadb[self.handle] = attrs
-                log.info("User({!r}) delete attr {!r}."
-                         .format(self.handle, key))
+        # delete attribute if exists
+        if key in uadb.get(self.handle, {}):
+            uadb.atomic_update(self.handle, 'dict-delete', (key,))
+            log.info("User({!r}) delete attr {!r}.".format(self.handle, key))
     __delitem__.__doc__ = dict.__delitem__.__doc__
 
+    def atomic_update(self, key, operation, arg):
+        """
+        Modify user attribute ``key`` by ``operation``, without racing.
+
+        See :meth:`x84.bbs.dbproxy.DBProxy.atomic_update` for operations,
+        such as ``'set-add'``.  Returns the new value of the attribute.
+        """
+        log = logging.getLogger(__name__)
+        if self.handle == 'anonymous':
+            log.debug("set attr {!r} not possible for 'anonymous'".format(key))
+            return None
+        return DBProxy(USERDB, 'attrs').atomic_update(
+            self.handle, operation, arg, field=key)
+
     @property
     def groups(self):
         """ Set of groups user is a member of (set of strings). """
@@ -256,14 +259,12 @@ class User(object):
                 log.warn('{!r}: First new user becomes sysop.'
                          .format(self.handle))
                 self.group_add(u'sysop')
-            is_new = self.handle not in udb
-            udb[self.handle] = self
-            if is_new:
+            with udb.batch() as batch:
+                batch.has_key(self.handle)
+                batch[self.handle] = self
+            if not batch.results[0]:
                 log.info("saved new user '%s'.", self.handle)
-        adb = DBProxy(USERDB, 'attrs')
-        with adb:
-            if self.handle not in adb:
-                adb[self.handle] = dict()
+        DBProxy(USERDB, 'attrs').setdefault(self.handle, dict())
         self._apply_groups()
 
     def delete(self):
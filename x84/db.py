@@ -3,31 +3,429 @@
 import multiprocessing
 import threading
 import logging
+import sqlite3
+import heapq
+import itertools
 import errno
+import Queue
+import time
 import os
+from UserDict import DictMixin
 
 # 3rd-party
-import sqlitedict
+from sqlitedict import encode, decode
+
+# local
+from x84.dbindex import TABLES
 
 FILELOCK = multiprocessing.Lock()
-DATALOCK = {}
+
+#: singleton, see :func:`get_db_service`
+DBSERVICE = None
+
+#: default number of database worker threads, ``[system]`` option
+#: ``db_workers`` may be used to override it.
+DB_WORKERS = 4
+
+#: a warning is logged each time a worker's queue depth reaches
+#: a multiple of this value.
+DB_QUEUE_WARN = 100
+
+#: per-thread cache of sqlite3 connections, keyed by file path.
+_LOCAL = threading.local()
+
+#: default number of items in each chunk of an iterable result,
+#: ``[system]`` option ``db_chunk_size`` may be used to override it.
+DB_CHUNK_SIZE = 256
+
+#: number of chunks of an iterable result sent ahead of the session.
+DB_STREAM_WINDOW = 2
+
+#: DBProxy command requesting the next chunk of a stream.
+DB_STREAM_NEXT = 'stream-next'
+
+#: DBProxy command discarding the remaining chunks of a stream.
+DB_STREAM_CLOSE = 'stream-close'
+
+#: incomplete streams are discarded after this many seconds unread.
+DB_STREAM_TIMEOUT = 600
+
+#: incomplete streams of iterable results, keyed by stream id.
+STREAMS = dict()
+STREAMS_LOCK = threading.Lock()
+STREAM_IDS = itertools.count()
+
+#: DBProxy command acquiring the lock of a database table.
+DB_LOCK_ACQUIRE = 'lock-acquire'
+
+#: DBProxy command releasing the lock of a database table.
+DB_LOCK_RELEASE = 'lock-release'
+
+#: dictionary methods which modify a database table.
+WRITE_COMMANDS = ('__setitem__', '__delitem__', 'update', 'setdefault',
+                  'pop', 'popitem', 'clear', 'atomic_update', 'batch')
+
+#: event broadcast to sessions when records of a cached schema are written,
+#: see :class:`x84.bbs.dbproxy.DBCache`.
+DB_INVALIDATE = 'db-invalidate'
+
+#: database table locks, keyed by ``(schema, table)``, of ``[holder, depth]``.
+#: Only accessed by the worker of a schema, see :meth:`DBService.get_worker`.
+DBLOCKS = dict()
+
+
+class SqliteTable(object, DictMixin):
+
+    """
+    Dictionary interface to a table of a sqlite3 database.
+
+    The table layout and pickled values are the same as those of
+    :class:`sqlitedict.SqliteDict`, so that existing database files
+    remain compatible.  Unlike ``SqliteDict``, no writer thread is
+    spawned: an instance may only be used by the thread that created
+    its connection, see :func:`get_database`.
+    """
+
+    def __init__(self, conn, tablename='unnamed'):
+        """
+        Class initializer.
+
+        :param sqlite3.Connection conn: database connection.
+        :param str tablename: database table name.
+        """
+        assert tablename.replace('_', '').isalnum(), (
+            'table name {0!r} must be alpha-numeric'.format(tablename))
+        self.conn = conn
+        self.tablename = tablename
+        self.conn.execute('CREATE TABLE IF NOT EXISTS {0} '
+                          '(key TEXT PRIMARY KEY, value BLOB)'
+                          .format(self.tablename))
+
+    def _select(self, query, args=()):
+        """ Execute ``query`` and return cursor. """
+        return self.conn.execute(query.format(table=self.tablename), args)
+
+    def __len__(self):
+        return self._select('SELECT COUNT(*) FROM {table}').fetchone()[0]
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def iterkeys(self):
+        for (key,) in self._select('SELECT key FROM {table} ORDER BY rowid'):
+            yield key
+
+    def itervalues(self):
+        for (value,) in self._select(
+                'SELECT value FROM {table} ORDER BY rowid'):
+            yield decode(value)
+
+    def iteritems(self):
+        for key, value in self._select(
+                'SELECT key, value FROM {table} ORDER BY rowid'):
+            yield key, decode(value)
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def __contains__(self, key):
+        return self._select('SELECT 1 FROM {table} WHERE key = ?',
+                            (key,)).fetchone() is not None
+
+    def __getitem__(self, key):
+        item = self._select('SELECT value FROM {table} WHERE key = ?',
+                            (key,)).fetchone()
+        if item is None:
+            raise KeyError(key)
+        return decode(item[0])
+
+    def __setitem__(self, key, value):
+        self._select('REPLACE INTO {table} (key, value) VALUES (?, ?)',
+                     (key, encode(value)))
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._select('DELETE FROM {table} WHERE key = ?', (key,))
+
+    def update(self, items=(), **kwds):
+        # pylint: disable=W0221
+        #         Arguments number differs from overridden method
+        if hasattr(items, 'iteritems'):
+            items = items.iteritems()
+        self.conn.executemany(
+            'REPLACE INTO {0} (key, value) VALUES (?, ?)'
+            .format(self.tablename),
+            ((key, encode(value)) for key, value in items))
+        if kwds:
+            self.update(kwds)
+
+    def clear(self):
+        self._select('DELETE FROM {table}')
+
+    def get_many(self, keys, default=None):
+        """ Return list of values for each of ``keys``, or ``default``. """
+        return [self.get(key, default) for key in keys]
+
+    def top(self, count=None, field=None, reverse=True, fields=None):
+        """
+        Return list of ``(key, value)`` items, sorted by ``field`` of values.
+
+        :param int count: maximum number of items, ``None`` for all.
+        :param field: value item or attribute to sort by, see
+                      :func:`get_field`.  By default, values are compared.
+        :param bool reverse: largest values first.
+        :param tuple fields: when set, values are projected to a tuple of
+                             only these fields, see :meth:`project`.
+        :rtype: list
+        """
+        sortkey = lambda item: get_field(item[1], field)
+        if count is None:
+            items = sorted(self.iteritems(), key=sortkey, reverse=reverse)
+        elif reverse:
+            items = heapq.nlargest(count, self.iteritems(), key=sortkey)
+        else:
+            items = heapq.nsmallest(count, self.iteritems(), key=sortkey)
+        return project_items(items, fields)
+
+    def scan(self, prefix=None, start=None, stop=None, limit=None,
+             reverse=False, fields=None):
+        """
+        Return list of ``(key, value)`` items, sorted by key.
+
+        :param str prefix: only keys beginning with ``prefix``.
+        :param str start: only keys greater than or equal to ``start``.
+        :param str stop: only keys less than ``stop``.
+        :param int limit: maximum number of items, ``None`` for all.
+        :param bool reverse: descending order of keys.
+        :param tuple fields: when set, values are projected to a tuple of
+                             only these fields, see :meth:`project`.
+        :rtype: list
+        """
+        clauses, args = list(), list()
+        if prefix:
+            # the range allows the primary key index to be used, the
+            # substr() comparison is exact.
+            clauses.append('key >= ? AND substr(key, 1, length(?)) = ?')
+            args.extend((prefix, prefix, prefix))
+            if ord(prefix[-1]) < (0xff if isinstance(prefix, str)
+                                  else 0xffff):
+                clauses.append('key < ?')
+                args.append(prefix[:-1] + type(prefix)(
+                    (chr if isinstance(prefix, str) else unichr)(
+                        ord(prefix[-1]) + 1)))
+        if start is not None:
+            clauses.append('key >= ?')
+            args.append(start)
+        if stop is not None:
+            clauses.append('key < ?')
+            args.append(stop)
+        query = 'SELECT key, value FROM {table}'
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        query += ' ORDER BY key{0}'.format(' DESC' if reverse else '')
+        if limit is not None:
+            query += ' LIMIT {0:d}'.format(limit)
+        items = [(key, decode(value))
+                 for key, value in self._select(query, args)]
+        return project_items(items, fields)
+
+    def project(self, fields, keys=None):
+        """
+        Return list of ``(key, fields)`` items, where fields is a tuple.
+
+        :param tuple fields: value items or attributes to return, see
+                             :func:`get_field`.
+        :param list keys: only these keys, ``None`` for all.  Missing keys
+                          are not returned.
+        :rtype: list
+        """
+        if keys is None:
+            items = self.iteritems()
+        else:
+            items = ((key, self[key]) for key in keys if key in self)
+        return project_items(items, fields)
+
+    def atomic_update(self, key, operation, arg, field=None):
+        """
+        Modify value of ``key`` by ``operation``, returning the new value.
+
+        :param str operation: one of :data:`ATOMIC_OPERATIONS`.
+        :param arg: argument of operation: an iterable of items to add or
+                    discard (``'set-add'``, ``'set-discard'``), a number to
+                    increment by (``'incr'``), a dictionary to merge
+                    (``'dict-merge'``), or an iterable of keys to delete
+                    (``'dict-delete'``).
+        :param field: when set, the value is a dictionary, and the operation
+                      is performed on its item ``field``.
+        :raises AssertionError: not a valid operation.
+        """
+        assert operation in ATOMIC_OPERATIONS, (
+            '{0!r} not a valid operation'.format(operation))
+        default, func = ATOMIC_OPERATIONS[operation]
+        if field is None:
+            value = func(self.get(key, default()), arg)
+            self[key] = value
+            return value
+        record = self.get(key, dict())
+        value = record[field] = func(record.get(field, default()), arg)
+        self[key] = record
+        return value
+
+    def batch(self, operations):
+        """
+        Execute a sequence of dictionary methods, returning their results.
+
+        :param list operations: sequence of ``(method, args)``.
+        :rtype: list
+        :raises AssertionError: method is not valid or returns an iterator.
+        """
+        results = list()
+        for cmd, args in operations:
+            assert cmd != 'batch' and not cmd.startswith('iter'), (
+                '{0!r} may not be batched'.format(cmd))
+            results.append(get_db_func(self, cmd)(*args))
+        return results
+
+    def close(self):
+        """ Does nothing, connections are owned by :func:`get_database`. """
+        pass
+
+
+def _dict_merge(value, arg):
+    """ Return dictionary ``value`` updated by ``arg``. """
+    value.update(arg)
+    return value
+
+
+def _dict_delete(value, arg):
+    """ Return dictionary ``value`` without keys of ``arg``. """
+    for key in arg:
+        value.pop(key, None)
+    return value
+
+
+#: operations of :meth:`SqliteTable.atomic_update`, of ``(default, func)``,
+#: where ``default`` returns the value of a missing key, and ``func``
+#: returns the new value of ``(value, arg)``.
+ATOMIC_OPERATIONS = {
+    'set-add': (set, lambda value, arg: value | set(arg)),
+    'set-discard': (set, lambda value, arg: value - set(arg)),
+    'incr': (int, lambda value, arg: value + arg),
+    'dict-merge': (dict, _dict_merge),
+    'dict-delete': (dict, _dict_delete),
+}
+
+
+def get_field(value, field):
+    """
+    Return ``field`` of a database value.
+
+    :param value: database record.
+    :param field: integer index of a sequence, key of a dictionary, or
+                  name of an attribute.  When ``None``, ``value`` is
+                  returned.
+    """
+    if field is None:
+        return value
+    if isinstance(field, (int, long)) or isinstance(value, dict):
+        return value[field]
+    return getattr(value, field)
+
+
+def project_items(items, fields=None):
+    """
+    Return list of ``(key, value)`` with values projected to ``fields``.
+
+    When ``fields`` is ``None``, values are unchanged.
+    """
+    if fields is None:
+        return list(items)
+    return [(key, tuple(get_field(value, field) for field in fields))
+            for key, value in items]
+
+
+def get_connection(filepath):
+    """
+    Return sqlite3 connection of calling thread for given database.
+
+    Connections are opened once for each thread and kept for its lifetime,
+    using sqlite "autocommit" mode: transactions must be explicitly
+    started, see :func:`transaction`.
+    """
+    connections = getattr(_LOCAL, 'connections', None)
+    if connections is None:
+        connections = _LOCAL.connections = dict()
+    if filepath not in connections:
+        # pylint: disable=W0602
+        #          Using global for 'FILELOCK' but no assignment is done
+        global FILELOCK
+        with FILELOCK:
+            # if the bbs is run as root, file ownerships become read-only
+            # and db transactions will throw 'read-only database' errors,
+            # exit earlier if we know that file permissions are to blame
+            check_db(filepath)
+            conn = sqlite3.connect(filepath, isolation_level=None)
+        conn.text_factory = str
+        conn.execute('PRAGMA synchronous=OFF')
+        connections[filepath] = conn
+    return connections[filepath]
 
 
 def get_database(filepath, table):
-    """ Return :class:`sqlitedict.SqliteDict` instance for given database. """
-    # pylint: disable=W0602
-    #          Using global for 'FILELOCK' but no assignment is done
-    global FILELOCK
-    with FILELOCK:
-        # if the bbs is run as root, file ownerships become read-only
-        # and db transactions will throw 'read-only database' errors,
-        # exit earlier if we know that file permissions are to blame
-        check_db(filepath)
-
-        dictdb = sqlitedict.SqliteDict(filename=filepath,
-                                       tablename=table,
-                                       autocommit=True)
-    return dictdb
+    """
+    Return :class:`SqliteTable` instance for given database.
+
+    Tables registered by :mod:`x84.dbindex` are returned as instances of
+    their index table class, instead.  The connection of the calling thread
+    is cached, see :func:`get_connection`.
+    """
+    tables = getattr(_LOCAL, 'tables', None)
+    if tables is None:
+        tables = _LOCAL.tables = dict()
+    key = (filepath, table)
+    if key not in tables:
+        table_cls = TABLES.get(table, SqliteTable)
+        tables[key] = table_cls(conn=get_connection(filepath),
+                                tablename=table)
+    return tables[key]
+
+
+class transaction(object):
+
+    """
+    Context manager of a database transaction for ``conn``.
+
+    Changes are committed on exit, or rolled back if an exception is raised.
+    """
+
+    # pylint: disable=C0103
+    #         Invalid class name "transaction"
+
+    def __init__(self, conn, begin='BEGIN'):
+        self.conn = conn
+        self.begin = begin
+
+    def __enter__(self):
+        self.conn.execute(self.begin)
+        return self.conn
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is None:
+            self.conn.execute('COMMIT')
+        else:
+            try:
+                self.conn.execute('ROLLBACK')
+            except sqlite3.Error:
+                # sqlite may have already rolled back the transaction,
+                # such as on SQLITE_FULL; the original exception is raised.
+                pass
 
 
 def check_db(filepath):
@@ -54,16 +452,45 @@ def get_db_filepath(schema):
     return os.path.join(folder, '{0}.sqlite3'.format(schema))
 
 
-def get_db_lock(schema, table):
-    """ Return database lock for given ``(schema, table)``. """
-    key = (schema, table)
-    # pylint: disable=W0602
-    #          Using global for 'FILELOCK' but no assignment is done
-    global DATALOCK, FILELOCK
-    with FILELOCK:
-        if key not in DATALOCK:
-            DATALOCK[key] = multiprocessing.Lock()
-    return DATALOCK[key]
+def get_written_keys(cmd, args):
+    """
+    Return keys modified by database command ``cmd``.
+
+    :rtype: list or None
+    :returns: list of keys, empty when nothing is written, or ``None`` when
+              any key may have been modified (such as ``clear``).
+    """
+    if cmd not in WRITE_COMMANDS:
+        return []
+    if cmd in ('__setitem__', '__delitem__', 'setdefault',
+               'pop', 'atomic_update'):
+        return [args[0]]
+    if cmd == 'update':
+        return list(args[0].keys() if hasattr(args[0], 'keys') else
+                    [key for key, _ in args[0]])
+    if cmd == 'batch':
+        keys = list()
+        for _cmd, _args in args[0]:
+            _keys = get_written_keys(_cmd, _args)
+            if _keys is None:
+                return None
+            keys.extend(_keys)
+        return keys
+    return None
+
+
+def is_lock_holder_active(holder):
+    """
+    Whether the holder of a database lock is still active.
+
+    A holder is either the session id of a tty, or ``'thread-<ident>'`` of
+    a thread of the engine process (such as web modules, or msgpoll).
+    """
+    if holder.startswith('thread-'):
+        ident = int(holder.split('-', 1)[1])
+        return any(thread.ident == ident for thread in threading.enumerate())
+    from x84.terminal import get_tty
+    return get_tty(holder) is not None
 
 
 def get_db_func(dictdb, cmd):
@@ -87,13 +514,15 @@ def parse_dbevent(event):
     Parse a database event into ``(iterable, schema)``.
 
     Called by class initializer, to determine if the event should return
-    an iterable, and for what database name (``schema``).
+    an iterable, and for what database name (``schema``).  The event of an
+    asynchronous request is suffixed by a request id, ``'db-schema#1'``.
 
     :rtype: tuple
     """
     assert event[2] in ('-', '='), ('event name must match db[-=]event')
     iterable = event[2] == '='
-    schema = event[3:]
+    # asynchronous requests are suffixed by '#<request-id>'
+    schema = event[3:].split('#', 1)[0]
     assert schema.isalnum() and os.path.sep not in schema, (
         'database schema {!r} must be alpha-numeric and not contain {!r}'
         .format(schema, os.path.sep))
@@ -111,7 +540,16 @@ def log_db_cmd(log, schema, cmd, args):
                                             args=s_args))
 
 
-class DBHandler(threading.Thread):
+class AsyncError(object):
+
+    """ Exception of an asynchronous database request, see ``DBFuture``. """
+
+    def __init__(self, error):
+        """ Class initializer. """
+        self.error = error
+
+
+class DBHandler(object):
 
     """
     This handler receives and handles a dictionary-based "database command".
@@ -120,9 +558,21 @@ class DBHandler(threading.Thread):
     dictionary and "packs" command iterables through an IPC event queue which
     is then dispatched by the engine.
 
-    The return values are sent to the session queue with equal 'event' name.
+    Handlers are queued to, and executed by, a :class:`DBWorker` thread of
+    the :class:`DBService`.  The return values are sent to the session queue
+    with equal 'event' name.
+
+    Iterable results are sent as a stream of ``(stream_id, items, done)``
+    chunks of up to ``db_chunk_size`` items (``[system]`` option).  Only
+    :data:`DB_STREAM_WINDOW` chunks are sent ahead of the session: each
+    following chunk is sent in reply to a :data:`DB_STREAM_NEXT` command,
+    and :data:`DB_STREAM_CLOSE` discards the remaining items, acknowledged
+    by ``(stream_id, None, True)``.
     """
 
+    #: number of chunks sent ahead of the session, ``None`` sends all.
+    window = DB_STREAM_WINDOW
+
     def __init__(self, queue, event, data):
         """
         Class initializer.
@@ -143,40 +593,61 @@ class DBHandler(threading.Thread):
         self.table, self.cmd, self.args = data
 
         self.iterable, self.schema = parse_dbevent(event)
+        self.is_async = '#' in event
         self.filepath = get_db_filepath(self.schema)
 
         from x84.bbs.ini import get_ini
         self._tap_db = self.log.isEnabledFor(logging.DEBUG) and (
             get_ini('session', 'tab_db', getter='getboolean'))
-
-        threading.Thread.__init__(self)
+        self.chunk_size = (get_ini('system', 'db_chunk_size', getter='getint')
+                           or DB_CHUNK_SIZE)
+        self.cached = self.schema in get_ini('session', 'db_cache',
+                                             split=True)
 
     def run(self):
         """ Execute database command and return results to session queue. """
-        dictdb = get_database(self.filepath, self.table)
-        func = get_db_func(dictdb, self.cmd)
-        if self._tap_db:
-            log_db_cmd(self.log, self.schema, self.cmd, self.args)
-
         try:
+            if self.iterable and self.cmd in (DB_STREAM_NEXT,
+                                              DB_STREAM_CLOSE):
+                self.continue_stream(*self.args)
+                return
+
+            if self.cmd in (DB_LOCK_ACQUIRE, DB_LOCK_RELEASE):
+                self.queue.send((self.event, self.handle_lock(*self.args)))
+                return
+
+            dictdb = get_database(self.filepath, self.table)
+            func = get_db_func(dictdb, self.cmd)
+            if self._tap_db:
+                log_db_cmd(self.log, self.schema, self.cmd, self.args)
+
             # single value result,
             if not self.iterable:
-                result = func(*self.args)
+                with transaction(dictdb.conn):
+                    result = func(*self.args)
                 self.queue.send((self.event, result))
+                if self.cached:
+                    self.invalidate(get_written_keys(self.cmd, self.args))
 
             # iterable value result,
             else:
-                self.queue.send((self.event, (None, 'StartIteration'),))
-                for item in func(*self.args):
-                    self.queue.send((self.event, item,))
-                self.queue.send((self.event, (None, StopIteration,),))
+                # the result is read in full, so that the transaction is
+                # not held open for as long as the session is iterating.
+                with transaction(dictdb.conn):
+                    items = list(func(*self.args))
+                self.start_stream(items)
 
         # pylint: disable=W0703
         #         Catching too general exception
         except Exception as err:
             # Pokemon exception, send to session
             try:
-                self.queue.send(('exception', err,))
+                if self.is_async:
+                    # raised by DBFuture.result(), rather than by whatever
+                    # the session happens to be reading at the time.
+                    self.queue.send((self.event, AsyncError(err)))
+                else:
+                    self.queue.send(('exception', err,))
             except IOError as err:
                 if err.errno == errno.EBADF:
                     # our pipe/queue has been disconnected (the session
@@ -185,5 +656,305 @@ class DBHandler(threading.Thread):
                     return
                 raise
 
-        finally:
-            dictdb.close()
+    def invalidate(self, keys):
+        """ Broadcast modified ``keys`` to the read cache of all sessions. """
+        if keys is not None and not keys:
+            return
+        try:
+            from x84.terminal import get_terminals
+            for _, tty in get_terminals():
+                try:
+                    tty.master_write.send(
+                        (DB_INVALIDATE, (self.schema, self.table, keys)))
+                except (IOError, OSError):
+                    # session is disconnecting
+                    pass
+        # pylint: disable=W0703
+        #         Catching too general exception
+        except Exception as err:
+            # the result has already been sent, it must not be followed
+            # by an exception.
+            self.log.exception(err)
+
+    def handle_lock(self, holder):
+        """
+        Acquire or release lock of database table for ``holder``.
+
+        Locks are re-entrant.  A lock held by a session that has since
+        disconnected, or a thread that has exited, is re-acquired.
+
+        :returns: whether the lock was acquired or released.
+        :rtype: bool
+        """
+        key = (self.schema, self.table)
+        lock = DBLOCKS.get(key)
+        if self.cmd == DB_LOCK_ACQUIRE:
+            if lock is None or lock[0] != holder:
+                if lock is not None:
+                    if is_lock_holder_active(lock[0]):
+                        return False
+                    self.log.warn('{0}/{1}: re-acquiring stale lock of {2}'
+                                  .format(self.schema, self.table, lock[0]))
+                lock = DBLOCKS[key] = [holder, 0]
+            lock[1] += 1
+            return True
+
+        if lock is None or lock[0] != holder:
+            self.log.error('{0}/{1}: lock not held by {2}, cannot release.'
+                           .format(self.schema, self.table, holder))
+            return False
+        lock[1] -= 1
+        if lock[1] == 0:
+            del DBLOCKS[key]
+        return True
+
+    def send_chunk(self, stream):
+        """ Send next chunk of ``stream``, return ``True`` when complete. """
+        items = stream['items'][:self.chunk_size]
+        del stream['items'][:self.chunk_size]
+        done = not stream['items']
+        self.queue.send((self.event, (stream['id'], items, done)))
+        return done
+
+    def start_stream(self, items):
+        """ Send first chunks of ``items``, registering any remaining. """
+        with STREAMS_LOCK:
+            expire_streams()
+            stream = dict(id=next(STREAM_IDS), items=items,
+                          queue=self.queue, atime=time.time())
+        num = 0
+        while not self.send_chunk(stream):
+            num += 1
+            if self.window is not None and num >= self.window:
+                with STREAMS_LOCK:
+                    STREAMS[stream['id']] = stream
+                break
+
+    def continue_stream(self, stream_id):
+        """ Send next chunk, or discard remaining items of ``stream_id``. """
+        with STREAMS_LOCK:
+            stream = STREAMS.get(stream_id)
+            if stream is not None and stream['queue'] is not self.queue:
+                stream = None
+            if self.cmd == DB_STREAM_CLOSE and stream is not None:
+                del STREAMS[stream_id]
+            elif stream is not None:
+                stream['atime'] = time.time()
+        if self.cmd == DB_STREAM_CLOSE:
+            # acknowledged, whether or not the stream remained, so that
+            # the session may discard any chunks sent before it.
+            self.queue.send((self.event, (stream_id, None, True)))
+            return
+        if stream is None:
+            # completed, or expired.
+            return
+        if self.send_chunk(stream):
+            with STREAMS_LOCK:
+                STREAMS.pop(stream_id, None)
+
+
+class DBFuncHandler(DBHandler):
+
+    """
+    Handler calling a function within a transaction of a database.
+
+    Queued by :meth:`DBService.call_func`, so that a function of the engine
+    may write several tables of a database at once, using the connection of
+    the worker responsible for it.
+    """
+
+    def __init__(self, queue, schema, tables, func, args):
+        """
+        Class initializer.
+
+        :param queue: stand-in of a session pipe, see :class:`_ResultQueue`.
+        :param str schema: database schema.
+        :param tuple tables: names of tables given to ``func``.
+        :param callable func: function called by the worker.
+        :param tuple args: arguments of ``func``, following the tables.
+        """
+        DBHandler.__init__(self, queue, 'db-{0}'.format(schema),
+                           ('unnamed', func, args))
+        self.tables = tables
+
+    def run(self):
+        """ Call function and return its result to queue. """
+        # pylint: disable=W0703
+        #         Catching too general exception
+        try:
+            # tables are retrieved first, as index tables are created and
+            # migrated by a transaction of their own.
+            dbs = tuple(get_database(self.filepath, table)
+                        for table in self.tables)
+            with transaction(get_connection(self.filepath)):
+                result = self.cmd(*(dbs + self.args))
+        except Exception as err:
+            self.queue.send(('exception', err,))
+            return
+        self.queue.send((self.event, result))
+        if self.cached:
+            # any table or key may have been modified.
+            self.invalidate(None)
+
+
+def expire_streams():
+    """ Discard streams that were not read for ``DB_STREAM_TIMEOUT``. """
+    # caller must hold STREAMS_LOCK
+    expired = time.time() - DB_STREAM_TIMEOUT
+    for stream_id, stream in STREAMS.items():
+        if stream['atime'] < expired:
+            del STREAMS[stream_id]
+
+
+class DBWorker(threading.Thread):
+
+    """
+    Long-lived database worker thread.
+
+    Handlers queued to a worker are executed in FIFO order, using database
+    connections owned and cached by this thread.
+    """
+
+    def __init__(self, name):
+        """ Class initializer. """
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.queue = Queue.Queue()
+        #: number of handlers executed
+        self.processed = 0
+        #: highest queue depth observed
+        self.max_depth = 0
+        #: total seconds spent executing handlers
+        self.busy_time = 0.0
+
+    def run(self):
+        """ Execute queued handlers, forever. """
+        log = logging.getLogger(__name__)
+        while True:
+            handler = self.queue.get()
+            stime = time.time()
+            try:
+                handler.run()
+            # pylint: disable=W0703
+            #         Catching too general exception
+            except Exception as err:
+                # the worker must survive errors that could not be
+                # delivered to the session (such as a broken pipe).
+                log.exception('{self.name}: {err}'
+                              .format(self=self, err=err))
+            self.busy_time += time.time() - stime
+            self.processed += 1
+
+
+class DBService(object):
+
+    """
+    A bounded pool of :class:`DBWorker` threads.
+
+    All requests for the same database ``schema`` are executed by the same
+    worker, in the order they were received.  This replaces the spawning of
+    a new thread, and opening of a new sqlite connection, for each request.
+    """
+
+    def __init__(self, num_workers=DB_WORKERS):
+        """ Class initializer. """
+        self.log = logging.getLogger(__name__)
+        self.workers = [DBWorker(name='db-worker-{0}'.format(num))
+                        for num in range(max(1, num_workers))]
+        for worker in self.workers:
+            worker.start()
+
+    def get_worker(self, schema):
+        """ Return worker responsible for ``schema``. """
+        return self.workers[hash(schema) % len(self.workers)]
+
+    def submit(self, handler):
+        """ Queue :class:`DBHandler` instance for execution. """
+        worker = self.get_worker(handler.schema)
+        worker.queue.put(handler)
+        depth = worker.queue.qsize()
+        if depth > worker.max_depth:
+            worker.max_depth = depth
+        if depth and depth % DB_QUEUE_WARN == 0:
+            self.log.warn('{worker.name}: queue depth is {depth}'
+                          .format(worker=worker, depth=depth))
+
+    def call(self, schema, table, cmd, args=(), iterable=False):
+        """
+        Execute database command and return its result, blocking.
+
+        Used by threads of the main engine process (such as the web server),
+        which have no session IPC pipe.  Iterable results are returned as a
+        list.
+        """
+        results = _ResultQueue()
+        event = 'db{0}{1}'.format('=' if iterable else '-', schema)
+        handler = DBHandler(results, event, (table, cmd, args))
+        handler.window = None
+        self.submit(handler)
+        return results.receive(iterable)
+
+    def call_func(self, schema, tables, func, *args):
+        """
+        Call ``func`` by the worker of ``schema``, returning its result.
+
+        The function is given the :func:`get_database` instance of each of
+        ``tables``, followed by ``args``, and is called within a single
+        transaction of the database, in order with all other requests of
+        ``schema``.  Used by threads of the main engine process to write
+        many records at once.
+        """
+        results = _ResultQueue()
+        self.submit(DBFuncHandler(results, schema, tables, func, args))
+        return results.receive(False)
+
+    def stats(self):
+        """
+        Return list of dictionaries describing each worker.
+
+        Keys are ``name``, ``depth`` (current queue depth), ``max_depth``,
+        ``processed`` (number of requests executed) and ``busy_time``.
+        """
+        return [dict(name=worker.name,
+                     depth=worker.queue.qsize(),
+                     max_depth=worker.max_depth,
+                     processed=worker.processed,
+                     busy_time=worker.busy_time)
+                for worker in self.workers]
+
+
+class _ResultQueue(object):
+
+    """ Stand-in for the session pipe used by :meth:`DBService.call`. """
+
+    def __init__(self):
+        self.queue = Queue.Queue()
+
+    def send(self, data):
+        """ Receive ``(event, data)`` from :class:`DBHandler`. """
+        self.queue.put(data)
+
+    def receive(self, iterable):
+        """ Return result of handler, raising any exception. """
+        result, done = list(), False
+        while not done:
+            event, data = self.queue.get()
+            if event == 'exception':
+                raise data
+            if not iterable:
+                return data
+            _, items, done = data
+            result.extend(items)
+        return result
+
+
+def get_db_service():
+    """ Return :class:`DBService` instance of the engine process. """
+    # pylint: disable=W0603
+    #         Using the global statement
+    global DBSERVICE
+    if DBSERVICE is None:
+        from x84.bbs.ini import get_ini
+        num_workers = get_ini('system', 'db_workers', getter='getint')
+        DBSERVICE = DBService(num_workers=num_workers or DB_WORKERS)
+    return DBSERVICE
@@ -0,0 +1,925 @@
+"""
+Indexed database tables for x/84.
+
+Most tables of x/84 databases are dictionaries of pickled values, see
+:class:`x84.db.SqliteTable`.  The tables of this module are instead
+normalized into sqlite3 columns and indexes, so that they may be queried
+without unpickling (or transferring) whole records.
+
+Each class is registered by table name, and is returned by
+:func:`x84.db.get_database` in place of a dictionary table.  Their public
+methods are called through :meth:`x84.bbs.dbproxy.DBProxy.proxy_method`,
+within a transaction of the database worker.
+"""
+# std imports
+import fnmatch
+import re
+
+
+#: index table classes, keyed by table name.
+TABLES = dict()
+
+
+def register(cls):
+    """ Class decorator, registering index table ``cls`` by its name. """
+    TABLES[cls.tablename] = cls
+    return cls
+
+
+def encode_text(value):
+    """ Return ``value`` as utf8-encoded bytes, as stored by sqlite3. """
+    if isinstance(value, unicode):
+        return value.encode('utf8')
+    return value
+
+
+#: pipe color codes, such as ``|13``, removed from text before indexing.
+PIPE_CODES = re.compile(r'\|\d{2}')
+
+#: words of text, as indexed by :class:`SearchIndex`.
+WORDS = re.compile(r'\w+', re.UNICODE)
+
+#: length of shortest and longest words indexed.
+WORD_MINLEN, WORD_MAXLEN = 2, 32
+
+
+def split_terms(text):
+    """ Return set of lowercase search terms of unicode ``text``. """
+    return set(word for word in WORDS.findall(
+        PIPE_CODES.sub(u' ', text or u'').lower())
+        if WORD_MINLEN <= len(word) <= WORD_MAXLEN)
+
+
+class IndexTable(object):
+
+    """
+    Base class of index tables.
+
+    Sub-classes declare ``tablename`` and the ``create`` statements of
+    their tables and indexes.  When the table does not yet exist, it is
+    created and :meth:`migrate` is called to populate it from any legacy
+    records of the same database.
+    """
+
+    #: table name, as given to DBProxy.
+    tablename = None
+
+    #: CREATE statements of tables and indexes.
+    create = ()
+
+    def __init__(self, conn, tablename):
+        """
+        Class initializer.
+
+        :param sqlite3.Connection conn: database connection.
+        :param str tablename: database table name.
+        """
+        assert tablename == self.tablename, (tablename, self.tablename)
+        self.conn = conn
+        exists = self.table_exists(self.tablename)
+        for statement in self.create:
+            self.conn.execute(statement)
+        if not exists:
+            self.conn.execute('BEGIN')
+            try:
+                self.migrate()
+            except:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+
+    def table_exists(self, tablename):
+        """ Whether ``tablename`` exists in this database. """
+        return self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?",
+            (tablename,)).fetchone() is not None
+
+    def legacy_table(self, tablename='unnamed'):
+        """ Return dictionary table ``tablename``, empty if not found. """
+        if not self.table_exists(tablename):
+            return dict()
+        from x84.db import SqliteTable
+        return SqliteTable(self.conn, tablename)
+
+    def legacy_items(self, tablename='unnamed'):
+        """ Return iterator of ``(key, value)`` of a dictionary table. """
+        return self.legacy_table(tablename).iteritems()
+
+    def migrate(self):
+        """ Populate a newly created table from legacy records, if any. """
+        pass
+
+    def close(self):
+        """ Does nothing, connections are owned by ``get_database``. """
+        pass
+
+
+@register
+class TagIndex(IndexTable):
+
+    """
+    Index of ``(tag, idx)`` rows, for messages of ``msgbase``.
+
+    Replaces the pickled set of message indices stored for each tag by the
+    ``unnamed`` table of the ``tags`` database, which is migrated when this
+    table is first created (and otherwise left unmodified).
+    """
+
+    tablename = 'tagindex'
+
+    create = (
+        'CREATE TABLE IF NOT EXISTS tagindex ('
+        ' tag TEXT NOT NULL,'
+        ' idx INTEGER NOT NULL,'
+        ' PRIMARY KEY (tag, idx))',
+        'CREATE INDEX IF NOT EXISTS tagindex_idx ON tagindex (idx)',
+    )
+
+    def migrate(self):
+        """ Insert rows of pickled sets of legacy ``unnamed`` table. """
+        self.conn.executemany(
+            'INSERT OR IGNORE INTO tagindex (tag, idx) VALUES (?, ?)',
+            ((tag, int(idx))
+             for tag, indices in self.legacy_items()
+             for idx in indices))
+
+    def __len__(self):
+        return self.conn.execute(
+            'SELECT COUNT(*) FROM tagindex').fetchone()[0]
+
+    def set_tags(self, idx, tags):
+        """ Set tags of message ``idx``, removing any others. """
+        tags = set(encode_text(tag) for tag in tags)
+        current = self.get_tags(idx)
+        self.conn.executemany(
+            'DELETE FROM tagindex WHERE tag = ? AND idx = ?',
+            ((tag, idx) for tag in current - tags))
+        self.conn.executemany(
+            'INSERT OR IGNORE INTO tagindex (tag, idx) VALUES (?, ?)',
+            ((tag, idx) for tag in tags - current))
+
+    def remove(self, idx):
+        """ Remove all tags of message ``idx``. """
+        self.conn.execute('DELETE FROM tagindex WHERE idx = ?', (idx,))
+
+    def get_tags(self, idx):
+        """ Return set of tags of message ``idx``. """
+        return set(tag for (tag,) in self.conn.execute(
+            'SELECT tag FROM tagindex WHERE idx = ?', (idx,)))
+
+    def list_tags(self):
+        """ Return list of all tags, sorted. """
+        return [tag for (tag,) in self.conn.execute(
+            'SELECT DISTINCT tag FROM tagindex ORDER BY tag')]
+
+    def list_msgs(self, tags):
+        """ Return set of message indices tagged by any of ``tags``. """
+        tags = [encode_text(tag) for tag in tags]
+        result = set()
+        # sqlite is limited to 999 host parameters by default
+        for start in range(0, len(tags), 500):
+            chunk = tags[start:start + 500]
+            result.update(idx for (idx,) in self.conn.execute(
+                'SELECT idx FROM tagindex WHERE tag IN ({0})'
+                .format(', '.join('?' * len(chunk))), chunk))
+        return result
+
+    def filter_msgs(self, indices, tags):
+        """ Return set of messages of ``indices`` of any of ``tags``. """
+        tags = [encode_text(tag) for tag in tags]
+        indices = [int(idx) for idx in indices]
+        result = set()
+        # sought by index of idx, in chunks of the limit of 999 parameters.
+        size = 999 - len(tags)
+        for start in range(0, len(indices), size):
+            chunk = indices[start:start + size]
+            result.update(idx for (idx,) in self.conn.execute(
+                'SELECT DISTINCT idx FROM tagindex WHERE idx IN ({0}) '
+                'AND tag IN ({1})'.format(', '.join('?' * len(chunk)),
+                                          ', '.join('?' * len(tags))),
+                chunk + tags))
+        return result
+
+    def list_after(self, tag, after=None, limit=None):
+        """
+        Return sorted list of message indices of ``tag``, following ``after``.
+
+        Messages are sought by the primary key of ``(tag, idx)``, so that
+        a range is paged without reading the messages preceding it.
+        """
+        return [idx for (idx,) in self.conn.execute(
+            'SELECT idx FROM tagindex WHERE tag = ? AND idx > ? '
+            'ORDER BY idx LIMIT ?',
+            (encode_text(tag), -1 if after is None else int(after),
+             -1 if limit is None else int(limit)))]
+
+    def count_msgs(self):
+        """ Return dictionary of number of messages, keyed by tag. """
+        return dict(self.conn.execute(
+            'SELECT tag, COUNT(*) FROM tagindex GROUP BY tag'))
+
+
+@register
+class Sequences(IndexTable):
+
+    """
+    Named integer sequences, allocating increasing keys of other tables.
+
+    A sequence is usually named by the table of the same database whose
+    keys it allocates.  When first used, a sequence is seeded by the
+    greatest integer key of the table of its name, if any.
+    """
+
+    tablename = 'sequences'
+
+    create = (
+        'CREATE TABLE IF NOT EXISTS sequences ('
+        ' name TEXT PRIMARY KEY,'
+        ' value INTEGER NOT NULL)',
+    )
+
+    def __len__(self):
+        return self.conn.execute(
+            'SELECT COUNT(*) FROM sequences').fetchone()[0]
+
+    def current(self, name):
+        """ Return last value allocated by sequence ``name``, or -1. """
+        row = self.conn.execute(
+            'SELECT value FROM sequences WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return self.seed(name)
+        return row[0]
+
+    def next(self, name, count=1):
+        """
+        Allocate ``count`` values of sequence ``name``.
+
+        :rtype: int
+        :returns: first value allocated.
+        """
+        assert count > 0, count
+        value = self.current(name) + count
+        self.conn.execute('UPDATE sequences SET value = ? WHERE name = ?',
+                          (value, name))
+        return value - count + 1
+
+    def seed(self, name, value=None):
+        """
+        Seed sequence ``name``, so that it does not allocate ``value``.
+
+        When ``value`` is None, the greatest integer key of the table of
+        the same name is used.  A sequence is never moved backwards.
+
+        :returns: last value allocated by sequence.
+        """
+        if value is None:
+            value = -1
+            for (key,) in self.legacy_keys(name):
+                try:
+                    value = max(value, int(key))
+                except ValueError:
+                    pass
+        self.conn.execute('INSERT OR IGNORE INTO sequences (name, value) '
+                          'VALUES (?, ?)', (name, value))
+        self.conn.execute('UPDATE sequences SET value = MAX(value, ?) '
+                          'WHERE name = ?', (value, name))
+        return self.conn.execute(
+            'SELECT value FROM sequences WHERE name = ?',
+            (name,)).fetchone()[0]
+
+    def legacy_keys(self, tablename):
+        """ Return iterator of key rows of a dictionary table. """
+        if not tablename.isalnum() or not self.table_exists(tablename):
+            return iter(())
+        return self.conn.execute('SELECT key FROM {0}'.format(tablename))
+
+
+@register
+class SearchIndex(IndexTable):
+
+    """
+    Inverted index of ``(term, idx)`` rows, for full-text message search.
+
+    Held by the ``msgbase`` database, terms are the words of the subject
+    and body of each message, see :func:`split_terms`.  When first
+    created, all existing messages are indexed.
+    """
+
+    tablename = 'searchindex'
+
+    create = (
+        'CREATE TABLE IF NOT EXISTS searchindex ('
+        ' term TEXT NOT NULL,'
+        ' idx INTEGER NOT NULL,'
+        ' PRIMARY KEY (term, idx))',
+        'CREATE INDEX IF NOT EXISTS searchindex_idx ON searchindex (idx)',
+    )
+
+    def migrate(self):
+        """ Index terms of all messages of legacy ``unnamed`` table. """
+        from x84.bbs.msgbase import decompress_body
+        bodies = self.legacy_table('bodies')
+        for key, msg in self.legacy_items():
+            # pylint: disable=W0212
+            #         Access to a protected member _body of a client class
+            body = (msg._body if msg._body is not None
+                    else decompress_body(bodies.get(key)))
+            self.set_terms(int(key), split_terms(msg.subject) |
+                           split_terms(body))
+
+    def __len__(self):
+        return self.conn.execute(
+            'SELECT COUNT(DISTINCT term) FROM searchindex').fetchone()[0]
+
+    def set_terms(self, idx, terms):
+        """ Set search terms of message ``idx``, removing any others. """
+        terms = set(encode_text(term) for term in terms)
+        current = set(term for (term,) in self.conn.execute(
+            'SELECT term FROM searchindex WHERE idx = ?', (idx,)))
+        self.conn.executemany(
+            'DELETE FROM searchindex WHERE term = ? AND idx = ?',
+            ((term, idx) for term in current - terms))
+        self.conn.executemany(
+            'INSERT OR IGNORE INTO searchindex (term, idx) VALUES (?, ?)',
+            ((term, idx) for term in terms - current))
+
+    def remove(self, idx):
+        """ Remove all search terms of message ``idx``. """
+        self.conn.execute('DELETE FROM searchindex WHERE idx = ?', (idx,))
+
+    def search(self, terms, prefixes=()):
+        """
+        Return set of message indices matching all ``terms`` and ``prefixes``.
+
+        :param terms: words, as returned by :func:`split_terms`.
+        :param prefixes: beginnings of words, such as ``'pyth'`` matching
+            ``'python'``.
+        """
+        conditions = []
+        for term in set(terms):
+            conditions.append(('term = ?', (encode_text(term),)))
+        for prefix in set(prefixes):
+            # no utf8-encoded character begins with byte 0xff.
+            conditions.append(('term >= ? AND term < ?',
+                               (encode_text(prefix),
+                                encode_text(prefix) + '\xff')))
+        if not conditions:
+            return set()
+
+        # begin with the rarest term, and only look up the remaining
+        # candidates of each following term, by primary key.
+        if len(conditions) > 1:
+            conditions.sort(key=lambda condition: self.conn.execute(
+                'SELECT COUNT(*) FROM searchindex WHERE ' + condition[0],
+                condition[1]).fetchone()[0])
+        where, args = conditions[0]
+        result = set(idx for (idx,) in self.conn.execute(
+            'SELECT idx FROM searchindex WHERE ' + where, args))
+        for where, args in conditions[1:]:
+            candidates, result = list(result), set()
+            # sqlite is limited to 999 host parameters by default
+            for start in range(0, len(candidates), 500):
+                chunk = candidates[start:start + 500]
+                result.update(idx for (idx,) in self.conn.execute(
+                    'SELECT idx FROM searchindex WHERE {0} AND idx IN ({1})'
+                    .format(where, ', '.join('?' * len(chunk))),
+                    args + tuple(chunk)))
+            if not result:
+                break
+        return result
+
+
+@register
+class ThreadIndex(IndexTable):
+
+    """
+    Thread tree of messages, one row for each message of the ``msgbase``.
+
+    Each row records the ``root`` message of its thread, its ``parent``,
+    ``depth``, and ``path``: the zero-padded indices of its ancestors and
+    itself, so that ordering a thread by path walks it depth-first, each
+    message followed by its replies in the order they were saved.  When
+    first created, all existing messages are indexed by their ``parent``.
+    """
+
+    tablename = 'threadindex'
+
+    create = (
+        'CREATE TABLE IF NOT EXISTS threadindex ('
+        ' idx INTEGER PRIMARY KEY,'
+        ' root INTEGER NOT NULL,'
+        ' parent INTEGER,'
+        ' depth INTEGER NOT NULL,'
+        ' path TEXT NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS threadindex_root '
+        ' ON threadindex (root, path)',
+        'CREATE INDEX IF NOT EXISTS threadindex_parent '
+        ' ON threadindex (parent)',
+    )
+
+    #: format of each message index of ``path``.
+    path_fmt = '{0:010d}'
+
+    def migrate(self):
+        """ Index all messages of legacy ``unnamed`` table by parent. """
+        parents = dict((int(key), msg.parent)
+                       for key, msg in self.legacy_items())
+        done = set()
+        for idx in sorted(parents):
+            # insert ancestors not yet indexed before their replies.
+            chain = []
+            while idx in parents and idx not in done and idx not in chain:
+                chain.append(idx)
+                idx = parents[idx]
+            # a circular reference is left as root of its thread.
+            circular = idx in chain
+            for num, idx in enumerate(reversed(chain)):
+                self.set_parent(idx, None if circular and num == 0
+                                else parents[idx])
+                done.add(idx)
+
+    def __len__(self):
+        return self.conn.execute(
+            'SELECT COUNT(*) FROM threadindex').fetchone()[0]
+
+    def _get_row(self, idx):
+        """ Return ``(root, parent, depth, path)`` of ``idx``, or None. """
+        return self.conn.execute(
+            'SELECT root, parent, depth, path FROM threadindex '
+            'WHERE idx = ?', (idx,)).fetchone()
+
+    def set_parent(self, idx, parent):
+        """
+        Set ``parent`` of message ``idx``, moving any replies along with it.
+
+        A ``parent`` that is not indexed is recorded, but ``idx`` becomes
+        the root of its own thread.
+
+        :rtype: tuple
+        :returns: ``(root, depth)`` of ``idx``.
+        :raises AssertionError: ``parent`` is ``idx`` or a reply of it.
+        """
+        parent_row = None if parent is None else self._get_row(parent)
+        if parent_row is None:
+            root, depth, path = idx, 0, self.path_fmt.format(idx)
+        else:
+            root, depth = parent_row[0], parent_row[2] + 1
+            path = '.'.join((parent_row[3], self.path_fmt.format(idx)))
+
+        row = self._get_row(idx)
+        if row is None:
+            self.conn.execute(
+                'INSERT INTO threadindex (idx, root, parent, depth, path) '
+                'VALUES (?, ?, ?, ?, ?)', (idx, root, parent, depth, path))
+            return root, depth
+
+        old_path = row[3]
+        assert parent_row is None or not (parent_row[3] + '.').startswith(
+            old_path + '.'), ('circular reference', idx, parent)
+        if row != (root, parent, depth, path):
+            # move replies, replacing the beginning of their path.
+            self.conn.execute(
+                'UPDATE threadindex SET root = ?, depth = depth + ?, '
+                ' path = ? || substr(path, ?) '
+                'WHERE root = ? AND path > ? AND path < ?',
+                (root, depth - row[2], path, len(old_path) + 1,
+                 row[0], old_path + '.', old_path + '/'))
+            self.conn.execute(
+                'UPDATE threadindex SET root = ?, parent = ?, depth = ?, '
+                ' path = ? WHERE idx = ?', (root, parent, depth, path, idx))
+        return root, depth
+
+    def remove(self, idx):
+        """
+        Remove message ``idx``, moving its replies beneath its parent.
+
+        Replies of the root of a thread each begin a thread of their own.
+        """
+        row = self._get_row(idx)
+        if row is None:
+            return
+        parent = None if row[0] == idx else row[1]
+        for child in self.get_children(idx):
+            self.set_parent(child, parent)
+        self.conn.execute('DELETE FROM threadindex WHERE idx = ?', (idx,))
+
+    def get_root(self, idx):
+        """ Return index of root message of thread of ``idx``, or None. """
+        row = self._get_row(idx)
+        return row[0] if row is not None else None
+
+    def get_children(self, idx):
+        """ Return list of indices of direct replies to ``idx``, in order. """
+        return [child for (child,) in self.conn.execute(
+            'SELECT idx FROM threadindex WHERE parent = ? ORDER BY idx',
+            (idx,))]
+
+    def get_thread(self, root):
+        """
+        Return thread of message ``root``, depth-first.
+
+        :rtype: list
+        :returns: ``(idx, depth)`` of ``root`` and all of its replies,
+                  depth relative to ``root``.
+        """
+        row = self._get_row(root)
+        if row is None:
+            return []
+        _, _, depth, path = row
+        return [(root, 0)] + [
+            (idx, _depth - depth) for (idx, _depth) in self.conn.execute(
+                'SELECT idx, depth FROM threadindex '
+                'WHERE root = ? AND path > ? AND path < ? ORDER BY path',
+                (row[0], path + '.', path + '/'))]
+
+
+@register
+class ReadIndex(IndexTable):
+
+    """
+    Messages read by each user, stored compactly.
+
+    Held by the ``tags`` database, alongside :class:`TagIndex`.  A message
+    is read when it is within one of the user's ranges of read message
+    indices (table ``readindex``), or when it is not greater than the
+    high-water mark of the user for any of its tags (``readindex_tags``).
+    Marking all messages of a tag as read therefore stores a single row,
+    and consecutive messages read one at a time are merged into ranges.
+
+    The number of unread and total public messages matching each
+    subscription of a user, a list of tag patterns, are kept by table
+    ``readindex_views``.  A view is counted when first requested, and is
+    then updated as messages are saved and read, so that counting does not
+    depend on the number of messages.  Tags of messages are therefore set
+    by :meth:`set_tags`, rather than by :class:`TagIndex`.
+    """
+
+    tablename = 'readindex'
+
+    #: tag of public messages, only public messages are counted by views.
+    public_tag = 'public'
+
+    create = (
+        'CREATE TABLE IF NOT EXISTS readindex ('
+        ' handle TEXT NOT NULL,'
+        ' lo INTEGER NOT NULL,'
+        ' hi INTEGER NOT NULL,'
+        ' PRIMARY KEY (handle, lo))',
+        'CREATE TABLE IF NOT EXISTS readindex_tags ('
+        ' handle TEXT NOT NULL,'
+        ' tag TEXT NOT NULL,'
+        ' hwm INTEGER NOT NULL,'
+        ' PRIMARY KEY (handle, tag))',
+        'CREATE TABLE IF NOT EXISTS readindex_views ('
+        ' handle TEXT NOT NULL,'
+        ' patterns TEXT NOT NULL,'
+        ' unread INTEGER NOT NULL,'
+        ' total INTEGER NOT NULL,'
+        ' PRIMARY KEY (handle, patterns))',
+    )
+
+    #: condition of a message ``tagindex.idx`` read by user ``handle``.
+    is_read_sql = (
+        '(EXISTS (SELECT 1 FROM readindex_tags r'
+        '  JOIN tagindex t2 ON t2.tag = r.tag'
+        '  WHERE r.handle = :handle AND t2.idx = tagindex.idx'
+        '  AND r.hwm >= tagindex.idx)'
+        ' OR IFNULL((SELECT hi FROM readindex'
+        '  WHERE handle = :handle AND lo <= tagindex.idx'
+        '  ORDER BY lo DESC LIMIT 1), -1) >= tagindex.idx)')
+
+    def __init__(self, conn, tablename):
+        # messages are queried by their tags, ensure the index exists.
+        self.tagindex = TagIndex(conn, TagIndex.tablename)
+        super(ReadIndex, self).__init__(conn, tablename)
+
+    def __len__(self):
+        return self.conn.execute(
+            'SELECT COUNT(DISTINCT handle) FROM readindex').fetchone()[0]
+
+    def mark_read(self, handle, indices):
+        """ Mark messages ``indices`` read by user ``handle``. """
+        handle = encode_text(handle)
+        indices = set(int(idx) for idx in indices)
+        self._views_read(handle, indices - self.list_read(handle, indices))
+        runs, indices = [], sorted(indices)
+        for idx in indices:
+            if runs and runs[-1][1] == idx - 1:
+                runs[-1][1] = idx
+            else:
+                runs.append([idx, idx])
+        for low, high in runs:
+            # merge with any overlapping or adjacent ranges: the range
+            # beginning before this one, and those beginning within it.
+            for _low, _high in self.conn.execute(
+                    'SELECT lo, hi FROM readindex WHERE handle = ? '
+                    'AND lo < ? ORDER BY lo DESC LIMIT 1',
+                    (handle, low)).fetchall() + self.conn.execute(
+                    'SELECT lo, hi FROM readindex WHERE handle = ? '
+                    'AND lo >= ? AND lo <= ?',
+                    (handle, low, high + 1)).fetchall():
+                if _high >= low - 1:
+                    low, high = min(low, _low), max(high, _high)
+            self.conn.execute(
+                'DELETE FROM readindex WHERE handle = ? '
+                'AND lo >= ? AND lo <= ?', (handle, low, high))
+            self.conn.execute(
+                'INSERT INTO readindex (handle, lo, hi) VALUES (?, ?, ?)',
+                (handle, low, high))
+
+    def mark_tags_read(self, handle, tags, until=None):
+        """
+        Mark all messages of ``tags`` read by user ``handle``.
+
+        When ``until`` is given, only messages up to that index are marked,
+        such as the last message displayed.
+        """
+        handle = encode_text(handle)
+        # views of this user are counted again when next requested.
+        self.conn.execute('DELETE FROM readindex_views WHERE handle = ?',
+                          (handle,))
+        for tag in set(encode_text(tag) for tag in tags):
+            (hwm,) = self.conn.execute(
+                'SELECT MAX(idx) FROM tagindex WHERE tag = ? AND idx <= ?',
+                (tag, until if until is not None else
+                 9223372036854775807)).fetchone()
+            if hwm is not None:
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO readindex_tags (handle, tag, hwm) '
+                    'VALUES (?, ?, MAX(?, IFNULL((SELECT hwm FROM '
+                    'readindex_tags WHERE handle = ? AND tag = ?), -1)))',
+                    (handle, tag, hwm, handle, tag))
+
+    def is_read(self, handle, idx):
+        """ Whether message ``idx`` is read by user ``handle``. """
+        return bool(self.list_read(handle, [idx]))
+
+    def list_read(self, handle, indices):
+        """ Return subset of messages ``indices`` read by user ``handle``. """
+        handle = encode_text(handle)
+        indices = sorted(set(int(idx) for idx in indices))
+        ranges = self.conn.execute(
+            'SELECT lo, hi FROM readindex WHERE handle = ? ORDER BY lo',
+            (handle,)).fetchall()
+        result, pos = set(), 0
+        for idx in indices:
+            while pos < len(ranges) and ranges[pos][1] < idx:
+                pos += 1
+            if pos < len(ranges) and ranges[pos][0] <= idx:
+                result.add(idx)
+        unread = [idx for idx in indices if idx not in result]
+        # sqlite is limited to 999 host parameters by default
+        for start in range(0, len(unread), 500):
+            chunk = unread[start:start + 500]
+            result.update(idx for (idx,) in self.conn.execute(
+                'SELECT DISTINCT t.idx FROM tagindex t '
+                'JOIN readindex_tags r ON r.tag = t.tag '
+                'WHERE r.handle = ? AND t.idx <= r.hwm '
+                'AND t.idx IN ({0})'.format(', '.join('?' * len(chunk))),
+                (handle,) + tuple(chunk)))
+        return result
+
+    def list_unread(self, handle, tags):
+        """ Return set of messages of ``tags`` not read by user ``handle``. """
+        return set(idx for (idx,) in self._select_unread(
+            'DISTINCT tagindex.idx', handle, tags))
+
+    def unread_count(self, handle, tags):
+        """ Return number of messages of ``tags`` unread by ``handle``. """
+        return self._select_unread(
+            'COUNT(DISTINCT tagindex.idx)', handle, tags).fetchone()[0]
+
+    def _select_unread(self, columns, handle, tags):
+        """ Return cursor selecting ``columns`` of unread messages. """
+        args = dict(('tag{0}'.format(num), encode_text(tag))
+                    for num, tag in enumerate(set(tags)))
+        query = ('SELECT {0} FROM tagindex WHERE tag IN ({1}) AND NOT {2}'
+                 .format(columns, ', '.join(':' + key for key in args),
+                         self.is_read_sql))
+        args['handle'] = encode_text(handle)
+        return self.conn.execute(query, args)
+
+    def set_tags(self, idx, tags):
+        """ Set tags of message ``idx``, updating subscription views. """
+        tags = set(encode_text(tag) for tag in tags)
+        current = self.tagindex.get_tags(idx)
+        if tags == current:
+            return
+        self.tagindex.set_tags(idx, tags)
+        if not current and self.public_tag in tags:
+            # a new public message is unread by all.
+            self.conn.executemany(
+                'UPDATE readindex_views SET unread = unread + 1, '
+                ' total = total + 1 WHERE patterns = ?',
+                ((patterns,) for patterns in self._matching_views(tags)))
+        elif self.public_tag in current | tags:
+            # views of modified messages are counted again when requested.
+            self.conn.executemany(
+                'DELETE FROM readindex_views WHERE patterns = ?',
+                ((patterns,) for patterns
+                 in self._matching_views(current | tags)))
+
+    def clear_views(self):
+        """ Remove all views, counted again when next requested. """
+        self.conn.execute('DELETE FROM readindex_views')
+
+    def get_views(self, handle, views):
+        """
+        Return number of public messages matching subscriptions ``views``.
+
+        :param list views: lists of tag patterns, such as ``['lang-*']``.
+        :rtype: list
+        :returns: ``(unread, total)`` of each view, for user ``handle``.
+        """
+        handle = encode_text(handle)
+        result = []
+        for patterns in views:
+            patterns = '\n'.join(sorted(set(
+                encode_text(pattern) for pattern in patterns)))
+            row = self.conn.execute(
+                'SELECT unread, total FROM readindex_views '
+                'WHERE handle = ? AND patterns = ?',
+                (handle, patterns)).fetchone()
+            if row is None:
+                row = self._count_view(handle, patterns)
+                self.conn.execute(
+                    'INSERT INTO readindex_views '
+                    '(handle, patterns, unread, total) VALUES (?, ?, ?, ?)',
+                    (handle, patterns) + row)
+            result.append(tuple(row))
+        return result
+
+    def _count_view(self, handle, patterns):
+        """ Return ``(unread, total)`` of messages of ``patterns``. """
+        args = dict(('pattern{0}'.format(num), pattern)
+                    for num, pattern in enumerate(patterns.split('\n')))
+        query = (
+            'SELECT IFNULL(SUM(NOT {0}), 0), COUNT(*) FROM ('
+            ' SELECT DISTINCT idx FROM tagindex WHERE ({1}) AND idx IN ('
+            '  SELECT idx FROM tagindex WHERE tag = :public)) AS tagindex'
+            .format(self.is_read_sql, ' OR '.join(
+                'tag GLOB :' + key for key in args)))
+        args.update(handle=handle, public=self.public_tag)
+        return tuple(self.conn.execute(query, args).fetchone())
+
+    def _matching_views(self, tags, views=None):
+        """
+        Return list of views matching any of ``tags``.
+
+        Views of all users are matched, or those of list ``views``.
+        """
+        if views is None:
+            views = [patterns for (patterns,) in self.conn.execute(
+                'SELECT DISTINCT patterns FROM readindex_views')]
+        return [patterns for patterns in views
+                if any(fnmatch.fnmatchcase(tag, pattern)
+                       for pattern in patterns.split('\n')
+                       for tag in tags)]
+
+    def _views_read(self, handle, indices):
+        """ Decrement unread views of ``handle`` by messages now read. """
+        views = [patterns for (patterns,) in self.conn.execute(
+            'SELECT patterns FROM readindex_views WHERE handle = ?',
+            (handle,))]
+        if not indices or not views:
+            return
+        msg_tags, indices = dict(), list(indices)
+        # sqlite is limited to 999 host parameters by default
+        for start in range(0, len(indices), 500):
+            chunk = indices[start:start + 500]
+            for idx, tag in self.conn.execute(
+                    'SELECT idx, tag FROM tagindex WHERE idx IN ({0})'
+                    .format(', '.join('?' * len(chunk))), chunk):
+                msg_tags.setdefault(idx, set()).add(tag)
+        counts = dict()
+        for tags in msg_tags.values():
+            if self.public_tag in tags:
+                for patterns in self._matching_views(tags, views=views):
+                    counts[patterns] = counts.get(patterns, 0) + 1
+        self.conn.executemany(
+            'UPDATE readindex_views SET unread = unread - ? '
+            'WHERE handle = ? AND patterns = ?',
+            ((count, handle, patterns) for patterns, count in counts.items()))
+
+
+@register
+class ArchiveIndex(IndexTable):
+
+    """
+    Location of archived messages within the archive file.
+
+    Held by the ``msgarchive`` database, with a :class:`TagIndex` of the
+    archived messages.  Messages are appended to the archive file by
+    :mod:`x84.msgarchive`, and read by
+    :func:`x84.bbs.msgbase.get_archived_msg`.
+    """
+
+    tablename = 'archiveindex'
+
+    create = (
+        'CREATE TABLE IF NOT EXISTS archiveindex ('
+        ' idx INTEGER PRIMARY KEY,'
+        ' offset INTEGER NOT NULL,'
+        ' length INTEGER NOT NULL)',
+    )
+
+    def __init__(self, conn, tablename):
+        self.tagindex = TagIndex(conn, TagIndex.tablename)
+        super(ArchiveIndex, self).__init__(conn, tablename)
+
+    def __len__(self):
+        return self.conn.execute(
+            'SELECT COUNT(*) FROM archiveindex').fetchone()[0]
+
+    def add(self, records):
+        """
+        Record messages stored by the archive file.
+
+        :param list records: ``(idx, offset, length, tags)`` of messages.
+        """
+        for idx, offset, length, tags in records:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO archiveindex (idx, offset, length) '
+                'VALUES (?, ?, ?)', (idx, offset, length))
+            self.tagindex.set_tags(idx, tags)
+
+    def locate(self, idx):
+        """ Return ``(offset, length)`` of message ``idx``, or None. """
+        return self.conn.execute(
+            'SELECT offset, length FROM archiveindex WHERE idx = ?',
+            (idx,)).fetchone()
+
+    def list_msgs(self, tags=None):
+        """ Return set of archived messages of any of ``tags``, or all. """
+        if tags:
+            return self.tagindex.list_msgs(tags)
+        return set(idx for (idx,) in self.conn.execute(
+            'SELECT idx FROM archiveindex'))
+
+    def clear(self):
+        """ Remove all archived messages from the index. """
+        self.conn.execute('DELETE FROM archiveindex')
+        self.conn.execute('DELETE FROM tagindex')
+
+
+@register
+class TransIndex(IndexTable):
+
+    """
+    Translation of message network ids to and from local message indices.
+
+    Held by the ``<network>trans`` database of each message network,
+    replacing the pickled local index stored for each network id by its
+    ``unnamed`` table, which is migrated when this table is first created.
+    Network ids are stored as text; a hub's network ids are its own
+    message indices.
+    """
+
+    tablename = 'transindex'
+
+    create = (
+        'CREATE TABLE IF NOT EXISTS transindex ('
+        ' net_id TEXT PRIMARY KEY,'
+        ' idx INTEGER NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS transindex_idx ON transindex (idx)',
+    )
+
+    def migrate(self):
+        """ Insert rows of legacy ``unnamed`` table. """
+        self.conn.executemany(
+            'INSERT OR IGNORE INTO transindex (net_id, idx) VALUES (?, ?)',
+            ((encode_text(u'{0}'.format(net_id)), int(idx))
+             for net_id, idx in self.legacy_items()))
+
+    def __len__(self):
+        return self.conn.execute(
+            'SELECT COUNT(*) FROM transindex').fetchone()[0]
+
+    def add(self, net_id, idx):
+        """
+        Translate network id ``net_id`` to local message ``idx``.
+
+        :rtype: bool
+        :returns: False if ``net_id`` is already translated, and unchanged.
+        """
+        return self.conn.execute(
+            'INSERT OR IGNORE INTO transindex (net_id, idx) VALUES (?, ?)',
+            (encode_text(u'{0}'.format(net_id)), int(idx))).rowcount == 1
+
+    def get_idx(self, net_id):
+        """ Return local message index of network id ``net_id``, or None. """
+        row = self.conn.execute(
+            'SELECT idx FROM transindex WHERE net_id = ?',
+            (encode_text(u'{0}'.format(net_id)),)).fetchone()
+        return row and row[0]
+
+    def remove(self, idx):
+        """ Remove translations of local message ``idx``. """
+        self.conn.execute('DELETE FROM transindex WHERE idx = ?', (int(idx),))
+
+    def get_net_id(self, idx):
+        """ Return network id of local message ``idx``, or None. """
+        row = self.conn.execute(
+            'SELECT net_id FROM transindex WHERE idx = ? ORDER BY rowid',
+            (int(idx),)).fetchone()
+        return row and row[0]
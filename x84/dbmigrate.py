@@ -0,0 +1,240 @@
+"""
+Database migration tool for x/84.
+
+Usage::
+
+    python -m x84.dbmigrate [--config <filepath>] [--logger <filepath>] \\
+        <migration> [<migration> ...]
+
+Migrations should be run while the bbs is not running.  Each migration is
+idempotent, and may be run again at any time.
+"""
+# std imports
+import getopt
+import logging
+import sys
+import os
+
+#: migration functions, keyed by name.
+MIGRATIONS = dict()
+
+
+def migration(func):
+    """ Decorator, registering migration function ``func`` by its name. """
+    MIGRATIONS[func.__name__] = func
+    return func
+
+
+@migration
+def tags():
+    """ Rebuild tag index of all messages, from tags of their records. """
+    from x84.db import get_database, get_db_filepath, transaction
+    from x84.bbs.msgbase import MSGDB, TAGDB, TAGIDX, READIDX
+    log = logging.getLogger(__name__)
+    db_msg = get_database(get_db_filepath(MSGDB), 'unnamed')
+    db_tag = get_database(get_db_filepath(TAGDB), TAGIDX)
+    db_read = get_database(get_db_filepath(TAGDB), READIDX)
+    num_msgs = 0
+    with transaction(db_tag.conn):
+        for idx, msg in db_msg.iteritems():
+            db_tag.set_tags(int(idx), list(msg.tags))
+            num_msgs += 1
+        db_read.clear_views()
+    log.info('tags: indexed {0} messages, {1} tags.'
+             .format(num_msgs, len(db_tag.list_tags())))
+
+
+@migration
+def bodies():
+    """ Move bodies of messages saved by previous versions to own table. """
+    from x84.db import get_database, get_db_filepath, transaction
+    from x84.bbs.msgbase import MSGDB, BODYDB, compress_body
+    log = logging.getLogger(__name__)
+    db_msg = get_database(get_db_filepath(MSGDB), 'unnamed')
+    db_body = get_database(get_db_filepath(MSGDB), BODYDB)
+    num_msgs = 0
+    with transaction(db_msg.conn):
+        for key, msg in db_msg.items():
+            # pylint: disable=W0212
+            #         Access to a protected member _body of a client class
+            if msg._body is not None:
+                db_body[key] = compress_body(msg._body)
+                db_msg[key] = msg
+                num_msgs += 1
+    log.info('bodies: moved {0} message bodies.'.format(num_msgs))
+
+
+@migration
+def recompress():
+    """ Compress message bodies by current setting 'body_compress_min'. """
+    from x84.db import get_database, get_db_filepath, transaction
+    from x84.bbs.msgbase import (MSGDB, BODYDB, compress_body,
+                                 decompress_body)
+    log = logging.getLogger(__name__)
+    db_body = get_database(get_db_filepath(MSGDB), BODYDB)
+    num_msgs = num_compressed = 0
+    with transaction(db_body.conn):
+        for key in db_body.keys():
+            value = db_body[key]
+            stored = compress_body(decompress_body(value))
+            if stored != value:
+                db_body[key] = stored
+                num_msgs += 1
+            num_compressed += isinstance(stored, tuple)
+    log.info('recompress: stored {0} message bodies, {1} compressed.'
+             .format(num_msgs, num_compressed))
+
+
+@migration
+def search():
+    """ Rebuild full-text search index of all messages. """
+    from x84.db import get_database, get_db_filepath, transaction
+    from x84.bbs.msgbase import MSGDB, SEARCHIDX
+    log = logging.getLogger(__name__)
+    db_search = get_database(get_db_filepath(MSGDB), SEARCHIDX)
+    with transaction(db_search.conn):
+        db_search.conn.execute('DELETE FROM {0}'.format(SEARCHIDX))
+        db_search.migrate()
+    log.info('search: indexed {0} terms.'.format(len(db_search)))
+
+
+@migration
+def threads():
+    """ Rebuild thread index of all messages, from their parents. """
+    from x84.db import get_database, get_db_filepath, transaction
+    from x84.bbs.msgbase import MSGDB, THREADIDX
+    log = logging.getLogger(__name__)
+    db_thread = get_database(get_db_filepath(MSGDB), THREADIDX)
+    with transaction(db_thread.conn):
+        db_thread.conn.execute('DELETE FROM {0}'.format(THREADIDX))
+        db_thread.migrate()
+    log.info('threads: indexed {0} messages.'.format(len(db_thread)))
+
+
+@migration
+def readmsgs():
+    """ Move messages read by each user from user attribute 'readmsgs'. """
+    from x84.db import get_database, get_db_filepath, transaction
+    from x84.bbs.msgbase import TAGDB, READIDX
+    from x84.bbs.userbase import USERDB
+    log = logging.getLogger(__name__)
+    db_attrs = get_database(get_db_filepath(USERDB), 'attrs')
+    db_read = get_database(get_db_filepath(TAGDB), READIDX)
+    handles = [handle for handle, attrs in db_attrs.iteritems()
+               if 'readmsgs' in attrs]
+    for handle in handles:
+        # marked read first, so that an interrupted migration loses nothing.
+        with transaction(db_read.conn):
+            db_read.mark_read(handle, db_attrs[handle]['readmsgs'])
+        with transaction(db_attrs.conn):
+            attrs = db_attrs[handle]
+            del attrs['readmsgs']
+            db_attrs[handle] = attrs
+    log.info('readmsgs: moved messages read by {0} users.'
+             .format(len(handles)))
+
+
+@migration
+def sequences():
+    """ Seed key sequences of messages and automsgs from existing keys. """
+    from x84.db import get_database, get_db_filepath, transaction
+    from x84.bbs.msgbase import MSGDB
+    from x84.dbindex import Sequences
+    log = logging.getLogger(__name__)
+    for schema, table in ((MSGDB, 'unnamed'), ('automsg', 'unnamed')):
+        db_seq = get_database(get_db_filepath(schema), Sequences.tablename)
+        with transaction(db_seq.conn):
+            value = db_seq.seed(table)
+        log.info('sequences: {0}/{1} seeded at {2}.'
+                 .format(schema, table, value))
+
+
+@migration
+def archive():
+    """ Rebuild index of archived messages, from the archive file. """
+    from x84.db import get_database, get_db_filepath, transaction
+    from x84.bbs.msgbase import (ARCHIVEDB, ARCHIVEIDX, get_archive_filepath,
+                                 load_archived_msg)
+    from x84.msgarchive import iter_archive
+    log = logging.getLogger(__name__)
+    db_archive = get_database(get_db_filepath(ARCHIVEDB), ARCHIVEIDX)
+    if not os.path.exists(get_archive_filepath()):
+        log.info('archive: {0} not found.'.format(get_archive_filepath()))
+        return
+    with open(get_archive_filepath(), 'rb') as fobj, \
+            transaction(db_archive.conn):
+        db_archive.clear()
+        for idx, offset, length in iter_archive(fobj):
+            # records of the same message are indexed by the latest.
+            msg = load_archived_msg(fobj.read(length))
+            db_archive.add([(idx, offset, length, list(msg.tags))])
+    log.info('archive: indexed {0} messages.'.format(len(db_archive)))
+
+
+@migration
+def compact():
+    """ Reclaim space of all databases, such as after archiving messages. """
+    from x84.db import get_db_filepath
+    import sqlite3
+    import glob
+    log = logging.getLogger(__name__)
+    folder = os.path.dirname(get_db_filepath('unnamed'))
+    for filepath in sorted(glob.glob(os.path.join(folder, '*.sqlite3'))):
+        size = os.path.getsize(filepath)
+        conn = sqlite3.connect(filepath, isolation_level=None)
+        try:
+            conn.execute('VACUUM')
+        finally:
+            conn.close()
+        log.info('compact: {0}, {1} to {2} bytes.'.format(
+            os.path.basename(filepath), size, os.path.getsize(filepath)))
+
+
+def parse_args():
+    """ Parse system arguments, return lookup paths and migration names. """
+    from x84 import cmdline
+    lookup_bbs, lookup_log = None, None
+    try:
+        opts, tail = getopt.getopt(sys.argv[1:], u'', (
+            'config=', 'logger=', 'help'))
+    except getopt.GetoptError as err:
+        sys.stderr.write('{0}\n'.format(err))
+        sys.exit(1)
+    for opt, arg in opts:
+        if opt in ('--config',):
+            lookup_bbs = (arg,)
+        elif opt in ('--logger',):
+            lookup_log = (arg,)
+        elif opt in ('--help',):
+            tail = []
+    if not tail or set(tail) - set(MIGRATIONS):
+        sys.stderr.write(
+            'Usage: \n'
+            '{0} [--config <filepath>] [--logger <filepath>] '
+            '<migration> [<migration> ...]\n\n'
+            'Available migrations:\n'
+            .format(os.path.basename(sys.argv[0])))
+        for name, func in sorted(MIGRATIONS.items()):
+            sys.stderr.write('  {0:<12} {1}\n'.format(
+                name, func.__doc__.strip()))
+        sys.exit(1)
+    # use default lookup paths of the bbs for those not given.
+    _argv, sys.argv = sys.argv, sys.argv[:1]
+    try:
+        default_bbs, default_log = cmdline.parse_args()
+    finally:
+        sys.argv = _argv
+    return (lookup_bbs or default_bbs, lookup_log or default_log, tail)
+
+
+def main():
+    """ Run migrations named by command-line arguments. """
+    lookup_bbs, lookup_log, names = parse_args()
+    import x84.bbs.ini
+    x84.bbs.ini.init(lookup_bbs, lookup_log)
+    for name in names:
+        MIGRATIONS[name]()
+
+
+if __name__ == '__main__':
+    main()
@@ -41,12 +41,12 @@ call_record = collections.namedtuple(
 
 def get_lastcallers(last):
     timenow = time.time()
-    return sorted([call_record(timeago=timenow - time_called,
-                               num_calls=num_calls,
-                               location=location,
-                               handle=handle.decode('utf8'))
-                   for handle, (time_called, num_calls, location)
-                   in DBProxy('lastcalls').items()])[:last]
+    return [call_record(timeago=timenow - time_called,
+                        num_calls=num_calls,
+                        location=location,
+                        handle=handle.decode('utf8'))
+            for handle, (time_called, num_calls, location)
+            in DBProxy('lastcalls').top(last, field=0)]
 
 
 def main(last=10):
@@ -129,10 +129,8 @@ def main():
             if msg is not None and msg.strip():
                 echo(u''.join((u'\r\n\r\n', write_msg,)))
                 autodb = DBProxy('automsg')
-                autodb.acquire()
-                idx = max([int(ixx) for ixx in autodb.keys()] or [-1]) + 1
+                idx = autodb.next_id()
                 autodb[idx] = (time.time(), handle, msg.strip())
-                autodb.release()
                 session.send_event('global', ('automsg', True,))
                 refresh_automsg(idx)
                 echo(u''.join((u'\r\n\r\n', commit_msg,)))
@@ -26,7 +26,16 @@ from x84.bbs import (
     LineEditor,
     list_users,
     list_msgs,
+    filter_msgs,
     list_tags,
+    count_msgs_by_tag,
+    count_subscribed,
+    search_msgs,
+    mark_read,
+    mark_tags_read,
+    list_read,
+    get_thread,
+    get_thread_root,
     get_ini,
     get_msg,
     timeago,
@@ -35,6 +44,7 @@ from x84.bbs import (
     echo,
     Msg,
 )
+from x84.bbs.msgbase import migrate_readmsgs, decompress_body
 from common import (
     render_menu_entries,
     show_description,
@@ -100,23 +110,25 @@ subject_max_length = get_ini(
 ) or 40
 
 
-def get_menu(messages):
-    """ Return list of menu items by given dict ``messages``. """
+def get_menu(counts):
+    """ Return list of menu items by given dict of message ``counts``. """
     MenuItem = collections.namedtuple('MenuItem', ['inp_key', 'text'])
     items = []
-    if messages['new']:
+    if counts['new']:
         items.extend([
-            MenuItem(u'n', u'new ({0})'.format(len(messages['new']))),
+            MenuItem(u'n', u'new ({0})'.format(counts['new'])),
             MenuItem(u'm', u'mark all read'),
         ])
-    if messages['all']:
+    if counts['all']:
         items.append(
-            MenuItem(u'a', u'all ({0})'.format(len(messages['all'])))
+            MenuItem(u'a', u'all ({0})'.format(counts['all']))
         )
-    if messages['private']:
+    if counts['private']:
         items.append(
-            MenuItem(u'v', u'private ({0})'.format(len(messages['private'])))
+            MenuItem(u'v', u'private ({0})'.format(counts['private']))
         )
+    if counts['all'] or counts['private']:
+        items.append(MenuItem(u's', u'search'))
     items.extend([
         MenuItem(u'p', u'post public'),
         MenuItem(u'w', u'write private'),
@@ -129,49 +141,105 @@ def get_menu(messages):
 
 def do_mark_as_read(session, message_indicies):
     """ Mark all given messages read. """
-    session.user['readmsgs'] = (
-        session.user.get('readmsgs', set()) | set(message_indicies)
-    )
+    if session.user.handle != 'anonymous':
+        mark_read(session.user.handle, message_indicies)
+
+
+def do_mark_all_as_read(session, messages):
+    """ Mark all messages of subscription read. """
+    if session.user.handle != 'anonymous':
+        if messages['all']:
+            mark_tags_read(session.user.handle, messages['tags'],
+                           until=max(messages['all']))
+        mark_read(session.user.handle, messages['new'] - messages['all'])
 
 
 def get_messages_by_subscription(session, subscription):
-    all_tags = list_tags()
-    messages = {'all': set(), 'new': set()}
-    messages_bytag = {}
-    messages_read = session.user.get('readmsgs', set())
+    """
+    Return dict of sets of message indices of ``subscription``.
 
-    # now occlude all private messages :)
-    all_private = list_privmsgs(None)
+    Only public messages are matched by tag, while private messages are
+    only those addressed to the user.  Used when messages are to be read,
+    the menu is displayed by :func:`get_message_counts`.
+    """
+    all_tags = list_tags()
+    messages = {'all': set(), 'new': set(), 'tags': set()}
 
     # this looks like perl code
     for tag_pattern in subscription:
-        messages_bytag[tag_pattern] = collections.defaultdict(set)
         for tag_match in fnmatch.filter(all_tags, tag_pattern):
-            msg_indicies = list_msgs(tags=(tag_match,))
-            messages['all'].update(msg_indicies - all_private)
-            messages_bytag[tag_pattern]['all'].update(msg_indicies - all_private)
-        messages_bytag[tag_pattern]['new'] = (
-            messages_bytag[tag_pattern]['all'] - messages_read)
+            messages['all'].update(list_msgs(tags=(tag_match,)))
+            messages['tags'].add(tag_match)
+
+    # occlude all private messages :)
+    messages['all'] &= list_msgs(tags=(u'public',))
 
     # and make a list of only our own
     messages['private'] = list_privmsgs(session.user.handle)
 
     # and calculate 'new' messages
-    messages['new'] = (messages['all'] | messages['private']) - messages_read
+    messages['new'] = (messages['all'] | messages['private']) - list_read(
+        session.user.handle, messages['all'] | messages['private'])
 
-    return messages, messages_bytag
+    return messages
 
 
-def describe_message_area(term, subscription, messages_bytags, colors):
-    get_num = lambda lookup, tag_pattern, grp: len(lookup[tag_pattern][grp])
+def get_message_counts(session, subscription):
+    """
+    Return number of messages of ``subscription``, and of each tag pattern.
+
+    Counts of public messages are kept by the message base, so that the
+    menu may be displayed without listing messages of each tag.
+    """
+    views = count_subscribed(session.user.handle,
+                             [[tag_pattern] for tag_pattern in subscription] +
+                             [subscription])
+    counts_bytags = dict(
+        (tag_pattern, {'new': num_new, 'all': num_all})
+        for tag_pattern, (num_new, num_all) in zip(subscription, views))
+
+    private = list_privmsgs(session.user.handle)
+    num_new, num_all = views[-1]
+    counts = {'all': num_all,
+              'private': len(private),
+              'new': num_new + len(private - list_read(
+                  session.user.handle, private))}
+    return counts, counts_bytags
+
+
+def count_new_message(session, subscription, counts, counts_bytags, data):
+    """
+    Update message ``counts`` by data of a ``newmsg`` event.
+
+    Returns True when the new message is of our subscription, or addressed
+    to us, and the counts were incremented.
+    """
+    if u'public' in data['tags']:
+        matched = [tag_pattern for tag_pattern in subscription
+                   if fnmatch.filter(data['tags'], tag_pattern)]
+        for tag_pattern in matched:
+            counts_bytags[tag_pattern]['new'] += 1
+            counts_bytags[tag_pattern]['all'] += 1
+        if matched:
+            counts['new'] += 1
+            counts['all'] += 1
+        return bool(matched)
+    elif data['recipient'] == session.user.handle:
+        counts['new'] += 1
+        counts['private'] += 1
+        return True
+    return False
+
+
+def describe_message_area(term, subscription, counts_bytags, colors):
     return u''.join((
         colors['highlight'](u'msgarea: '),
         colors['text'](u', ').join((
             u''.join((
                 quote(tag_pattern, colors),
                 u'({num_new}/{num_all})'.format(
-                    num_new=get_num(messages_bytags, tag_pattern, 'new'),
-                    num_all=get_num(messages_bytags, tag_pattern, 'all'))
+                    num_new=counts_bytags[tag_pattern]['new'],
+                    num_all=counts_bytags[tag_pattern]['all'])
             )) for tag_pattern in subscription)),
         u'\r\n\r\n',
     ))
@@ -192,8 +260,9 @@ def quote(txt, colors):
 
 
 def do_describe_available_tags(term, colors):
-    sorted_tags = sorted([(len(list_msgs(tags=(tag,))), tag)
-                          for tag in list_tags() or [u'public']
+    num_msgs_by_tag = count_msgs_by_tag() or {u'public': 0}
+    sorted_tags = sorted([(num_msgs, tag)
+                          for tag, num_msgs in num_msgs_by_tag.items()
                           ], reverse=True)
     decorated_tags = [
         colors['text'](tag) +
@@ -424,13 +493,14 @@ def quote_body(msg):
                     msg=msg))
 
 
-def display_message(session, term, msg_index, colors):
-    """ Format message of index ``idx``. """
+def display_message(session, term, msg_index, colors, msg=None):
+    """ Format message of index ``idx``, or ``msg`` when prefetched. """
     color_handle = lambda handle: (
         colors['highlight'](handle)
         if handle == session.user.handle
         else handle)
-    msg = get_msg(msg_index)
+    if msg is None:
+        msg = get_msg(msg_index)
     txt_sent = msg.stime.replace(
         tzinfo=dateutil.tz.tzlocal()
     ).astimezone(dateutil.tz.tzutc()).strftime(TIME_FMT)
@@ -479,29 +549,7 @@ def can_delete(session):
 
 def delete_message(msg):
     """ Experimental message delete! """
-    # ! belongs as msg.delete() function !
-    msg.recipient = u''
-    msg.subject = u''
-    msg.body = u''
-    msg.children = set()
-    msg.parent = None
-    msg.tags = set()
-    msg.save()
-    with DBProxy('tags') as tag_db:
-        for key, values in tag_db.items()[:]:
-            if msg.idx in values:
-                newvalue = values - set([msg.idx])
-                if newvalue:
-                    tag_db[key] = newvalue
-                else:
-                    # no more messages by this tag, delete it
-                    del tag_db[key]
-    with DBProxy('privmsg') as priv_db:
-        for key, values in priv_db.items()[:]:
-            if msg.idx in values:
-                priv_db[key] = values - set([msg.idx])
-    with DBProxy('msgbase') as msg_db:
-        del msg_db['%d' % int(msg.idx)]
+    msg.delete()
 
 
 def do_reader_prompt(session, term, index, message_indices, colors):
@@ -511,6 +559,7 @@ def do_reader_prompt(session, term, index, message_indices, colors):
         opts += (('p', 'rev'),)
     if index < len(message_indices) - 1:
         opts += (('n', 'ext'),)
+    opts += (('t', 'hread'),)
     if allow_tag(session, message_indices[index]):
         opts += (('e', 'dit tags'),)
     if can_delete(session):
@@ -550,6 +599,21 @@ def do_reader_prompt(session, term, index, message_indices, colors):
             # prev
             echo(term.move_x(xpos) + term.clear_eol)
             return index - 1
+        elif inp == u't':
+            # read thread of this message, then return to it.
+            thread_indices = get_readable_thread(
+                session, message_indices[index])
+            if len(thread_indices) > 1:
+                read_messages(session=session, term=term,
+                              message_indices=thread_indices,
+                              colors=colors,
+                              index=thread_indices.index(
+                                  message_indices[index]))
+                return index
+            echo(u''.join((term.move_x(xpos),
+                           colors['highlight'](u'No replies.'),
+                           term.clear_eol)))
+            term.inkey(1)
         elif inp == u'e' and allow_tag(session, message_indices[index]):
             msg = get_msg(message_indices[index])
             echo(u'\r\n')
@@ -600,15 +664,43 @@ def do_reader_prompt(session, term, index, message_indices, colors):
                 continue
 
 
-def read_messages(session, term, message_indices, colors):
-    """ Read list of given messages. """
-    index = 0
+def get_readable_thread(session, idx):
+    """
+    Return list of messages of thread of ``idx``, in threaded order.
+
+    Only public messages and those addressed to the user are returned.
+    """
+    root = get_thread_root(idx)
+    if root is None:
+        return [idx]
+    thread = get_thread(root)
+    readable = (filter_msgs([_idx for _idx, _ in thread], tags=(u'public',)) |
+                list_privmsgs(session.user.handle))
+    return [_idx for _idx, _ in thread if _idx in readable or _idx == idx]
+
+
+def read_messages(session, term, message_indices, colors, index=0):
+    """ Read list of given messages, beginning at ``index``. """
+    prefetched = dict()
     while True:
         session.activity = ('reading msgs [{0}/{1}]'
                             .format(index + 1, len(message_indices)))
+        msg, futures = None, prefetched.pop(index, None)
+        if futures is not None:
+            msg_future, body_future = futures
+            msg, body = msg_future.result(), body_future.result()
+            if body is not None:
+                msg.body = decompress_body(body)
         display_message(session=session, term=term,
                         msg_index=message_indices[index],
-                        colors=colors)
+                        colors=colors, msg=msg)
+
+        # request the next message and its body while this one is read
+        if index + 1 < len(message_indices):
+            key = '%d' % (message_indices[index + 1],)
+            prefetched = {index + 1: (
+                DBProxy('msgbase').get_async(key),
+                DBProxy('msgbase', table='bodies').get_async(key, None))}
         index = do_reader_prompt(session=session, term=term, index=index,
                                  message_indices=message_indices,
                                  colors=colors)
@@ -621,6 +713,7 @@ def main(quick=False):
 
     session, term = getsession(), getterminal()
     session.activity = 'checking for new messages'
+    migrate_readmsgs(session.user)
 
     # set syncterm font, if any
     if term.kind.startswith('ansi'):
@@ -640,6 +733,7 @@ def main(quick=False):
     yloc = top_margin = 0
     subscription = session.user.get('msg_subscription', [])
     dirty = 2
+    recount = True
 
     while True:
         if dirty == 2:
@@ -664,18 +758,21 @@ def main(quick=False):
                         subscription=subscription, colors=colors))
                 continue
 
-            messages, messages_bytags = get_messages_by_subscription(
-                session, subscription)
+            if recount:
+                # counts are otherwise updated by 'newmsg' events.
+                counts, counts_bytags = get_message_counts(
+                    session, subscription)
+                recount = False
 
             # When quick login ('y') selected in top.py, return immediately
             # when no new messages are matched any longer.
-            if quick and not messages['new']:
+            if quick and not counts['new']:
                 echo(term.move_x(xloc) + u'\r\nNo new messages.\r\n')
                 return waitprompt(term)
 
             txt = describe_message_area(
                 term=term, subscription=subscription,
-                messages_bytags=messages_bytags, colors=colors)
+                counts_bytags=counts_bytags, colors=colors)
 
             yloc = top_margin + show_description(
                 term=term, description=txt, color=None,
@@ -683,7 +780,7 @@ def main(quick=False):
 
             echo(render_menu_entries(
                 term=term, top_margin=yloc,
-                menu_items=get_menu(messages),
+                menu_items=get_menu(counts),
                 colors=colors, max_cols=2))
             echo(display_prompt(term=term, colors=colors))
             echo(colors['backlight'](u' \b'))
@@ -697,14 +794,13 @@ def main(quick=False):
             continue
 
         elif event == 'newmsg':
-            # When a new message is sent, 'newmsg' event is broadcasted.
-            session.flush_event('newmsg')
-            nxt_msgs, nxt_bytags = get_messages_by_subscription(
-                session, subscription)
-            if nxt_msgs['new'] - messages['new']:
+            # When a new message is sent, 'newmsg' event is broadcasted,
+            # describing the message; our counts are updated by it.
+            if any([count_new_message(session, subscription,
+                                      counts, counts_bytags, _data)
+                    for _data in [data] + session.flush_event('newmsg')]):
                 # beep and re-display when a new message has arrived.
                 echo(u'\b')
-                messages, messages_bytags = nxt_msgs, nxt_bytags
                 dirty = True
                 continue
 
@@ -720,6 +816,10 @@ def main(quick=False):
                 continue
 
             inp = given_inp.strip()
+            recount = True
+            if inp.lower() in (u'n', u'a', u'v', u's', u'm'):
+                # list messages only when they are to be read.
+                messages = get_messages_by_subscription(session, subscription)
             if inp.lower() in (u'n', 'a', 'v'):
                 # read new/all/private messages
                 message_indices = sorted(list(
@@ -732,10 +832,20 @@ def main(quick=False):
                     read_messages(session=session, term=term,
                                   message_indices=message_indices,
                                   colors=colors)
-            elif inp.lower() == u'm' and messages['new']:
+            elif inp.lower() == u's':
+                # search all readable messages
+                message_indices = prompt_search(
+                    term=term, colors=colors,
+                    message_indices=messages['all'] | messages['private'])
+                if message_indices:
+                    read_messages(session=session, term=term,
+                                  message_indices=message_indices,
+                                  colors=colors)
+                dirty = 2
+            elif inp.lower() == u'm' and counts['new']:
                 # mark all messages as read
                 dirty = 1
-                do_mark_as_read(session, messages['new'])
+                do_mark_all_as_read(session, messages)
             elif inp.lower() in (u'p', u'w'):
                 # write new public/private message
                 dirty = 2
@@ -859,6 +969,40 @@ def prompt_subject(term, msg, colors):
     return True
 
 
+def prompt_search(term, colors, message_indices):
+    """
+    Prompt for search query, return sorted list of matching messages.
+
+    Only messages of ``message_indices`` are returned.
+    """
+    xpos = max(0, (term.width // 2) - (80 // 2))
+    echo(u''.join((term.move_x(xpos),
+                   term.clear_eos,
+                   u'Enter words to search for, ',
+                   colors['highlight'](u'*'),
+                   u' to match the beginning of a word.\r\n',
+                   term.move_x(xpos),
+                   u':: ')))
+    inp = LineEditor(subject_max_length,
+                     colors={'highlight': colors['backlight']}
+                     ).read()
+
+    if inp is None or not inp.strip():
+        echo(u''.join((term.move_x(xpos),
+                       colors['highlight']('Canceled.'),
+                       term.clear_eol)))
+        term.inkey(1)
+        return []
+
+    matches = sorted(search_msgs(inp.strip()) & message_indices)
+    if not matches:
+        echo(u''.join((u'\r\n', term.move_x(xpos),
+                       colors['highlight']('No match.'),
+                       term.clear_eol)))
+        term.inkey(1)
+    return matches
+
+
 def prompt_body(term, msg, colors):
     """ Prompt for and set 'body' of message by executing 'editor' script. """
     with term.fullscreen():
@@ -942,5 +1086,4 @@ def do_send_message(session, term, msg, colors):
     echo(u''.join((u'\r\n',
                    term.move_x(xpos),
                    colors['highlight']('message sent!'))))
-    session.send_event('global', ('newmsg', msg.idx,))
     term.inkey(1)
@@ -359,13 +359,13 @@ def generate_recent_oneliners(term, n_liners, offset):
     # for relative 'time ago'
     now = time.time()
 
-    # fetch all liners in database, sorted ascending by time
-    oneliners = sorted(DBProxy('oneliner').values(), key=keysort_by_datetime)
+    udb = DBProxy('oneliner')
+    total = len(udb)
 
     # decide the start/end by given offset, to allow paging, bounds check to
     # ensure that it does not scroll out of range
-    offset = min(offset, len(oneliners))
-    start, end = len(oneliners) - (n_liners + offset), len(oneliners) - offset
+    offset = min(offset, total)
+    start, end = total - (n_liners + offset), total - offset
     if start < 0:
         offset += start
         start, end = 0, end - start
@@ -373,6 +373,12 @@ def generate_recent_oneliners(term, n_liners, offset):
         start, end = start + offset, end + offset
         offset = 0
 
+    # fetch only the most recent liners, up to 'start', sorted ascending by
+    # time ('%Y-%m-%d %H:%M:%S' timestamps sort as strings).
+    oneliners = [oneliner for _, oneliner in
+                 reversed(udb.top(total - start, field='timestamp'))]
+    start, end = 0, end - start
+
     # build up one large text field; refresh is smoother when
     # all text is received as a single packet
     final_text_field = u''
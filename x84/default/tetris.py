@@ -39,7 +39,7 @@ def show_scores():
     from x84.bbs import DBProxy, Pager, getterminal
     from x84.bbs import echo, getsession, ini
     session, term = getsession(), getterminal()
-    allscores = DBProxy('tetris').items()
+    allscores = DBProxy('tetris').top(fields=(0, 1))
     if 0 == len(allscores):
         return
     # line up over tetris game, but logo & 'made by jojo' in view
@@ -61,10 +61,8 @@ def show_scores():
     pager.alignment = 'center'
     # pre-fesh pager border before fetch
     echo(pager.border() + pager.title(pager_title) + pager.clear())
-    highscores = sorted(
-        [(_score, _level, _handle.decode('utf8'))
-         for (_handle, (_score, _level, _)) in allscores],
-        reverse=True)
+    highscores = [(_score, _level, _handle.decode('utf8'))
+                  for (_handle, (_score, _level)) in allscores]
     pager.append(score_fmt % (
         term.bold_blue_underline('No'.ljust(len_pos)),
         term.bold_blue_underline('SCORE'.ljust(len_score)),
@@ -15,9 +15,7 @@ class LastCallersApi(object):
         """ Return last x callers """
 
         num = int(num)
-        callers = DBProxy('lastcalls', use_session=False).items()
-        last = sorted(callers[-num:], reverse=True,
-                      key=lambda caller: caller[1][0])
+        last = DBProxy('lastcalls', use_session=False).top(num, field=0)
 
         # output JSON instead?
         if 'json' in web.input(_method='get'):
@@ -30,10 +30,20 @@ import sys
 # local
 __import__('encodings')  # provides alternate encodings
 from x84 import cmdline
-from x84.db import DBHandler
-from x84.terminal import get_terminals, kill_session, find_tty
+from x84.db import DBHandler, get_db_service
+from x84.reactor import get_reactor
+from x84.terminal import get_terminals, get_tty, kill_session, find_tty
 from x84.fail2ban import get_fail2ban_function
 
+#: polling time while client output remains undelivered (20ms)
+SELECT_POLL = 0.02
+
+#: seconds between reaping of disconnected clients and idle sessions
+HOUSEKEEPING_INTERVAL = 1.0
+
+#: seconds between logging of database worker statistics
+DB_STATS_INTERVAL = 600
+
 
 def main():
     """
@@ -77,6 +87,12 @@ def main():
         from x84 import msgpoll
         msgpoll.main()
 
+    if (get_ini(section='msg', key='retain_days') or
+            get_ini(section='msg', key='retain_count')):
+        # start background timer to archive messages no longer retained.
+        from x84 import msgarchive
+        msgarchive.main()
+
     try:
         # begin main event loop
         _loop(servers)
@@ -127,13 +143,6 @@ def get_servers(CFG):
     return servers
 
 
-def find_server(servers, fd):
-    """ Find matching ``server.server_socket`` for given file descriptor. """
-    for server in servers:
-        if fd == server.server_socket.fileno():
-            return server
-
-
 def accept(log, server, check_ban):
     """
     Accept new connection from server, spawning an unmanaged thread.
@@ -144,6 +153,9 @@ def accept(log, server, check_ban):
     dictionary server.clients, and spawning an unmanaged thread
     using connect_factory, with optional keyword arguments
     server.connect_factory_kwargs.
+
+    The client's file descriptor, when available, is registered with
+    the :class:`x84.reactor.Reactor` of the main event loop.
     """
     if None in (server.client_factory, server.connect_factory):
         raise NotImplementedError(
@@ -189,6 +201,9 @@ def accept(log, server, check_ban):
         # spawn on-connect negotiation thread.  When successful,
         # a new sub-process is spawned and registered as a session tty.
         server.clients[client.sock.fileno()] = client
+        client_fd = client.fileno()
+        if client_fd is not None:
+            get_reactor().register(client, client_fd, 'client')
         thread = server.connect_factory(client, **connect_factory_kwargs)
         log.info('{client.kind} connection from {client.addrport} '
                  '(*{thread.name}).'.format(client=client, thread=thread))
@@ -199,34 +214,21 @@ def accept(log, server, check_ban):
         log.error('accept error {0}:{1}'.format(*err))
 
 
-def get_session_output_fds(servers):
-    """ Return file descriptors of all ``tty.master_read`` pipes. """
-    session_fds = []
-    for server in servers:
-        for client in server.clients.values():
-            tty = find_tty(client)
-            if tty is not None:
-                session_fds.append(tty.master_read.fileno())
-    return session_fds
-
-
-def client_recv(servers, ready_fds, log):
+def client_recv(clients, log):
     """
-    Test all clients for recv_ready().
+    Receive data from all ``clients`` ready for reading.
 
-    If any data is available, then ``client.socket_recv()`` is called,
-    buffering the data for the session which is exhausted by
-    :func:`session_send`.
+    ``client.socket_recv()`` is called, buffering the data for the session
+    which is exhausted by :func:`session_send`.
     """
     from x84.bbs.exception import Disconnected
-    for server in servers:
-        for client in server.clients_ready(ready_fds):
-            try:
-                client.socket_recv()
-            except Disconnected as err:
-                log.debug('{client.addrport}: disconnect on recv: {err}'
-                          .format(client=client, err=err))
-                kill_session(client, 'disconnected: {err}'.format(err=err))
+    for client in clients:
+        try:
+            client.socket_recv()
+        except Disconnected as err:
+            log.debug('{client.addrport}: disconnect on recv: {err}'
+                      .format(client=client, err=err))
+            kill_session(client, 'disconnected: {err}'.format(err=err))
 
 
 def client_send(terminals, log):
@@ -282,18 +284,16 @@ def handle_lock(locks, tty, event, data, tap_events, log):
         if event in locks:
             # check if lock held by an active session,
             holder = locks[event][1]
-            for _sid, _ in get_terminals():
-                if _sid == holder and _sid != tty.sid:
-                    # acquire the lock from a now-deceased session.
-                    log.debug('[{tty.sid}] {event} not acquired, '
-                              'held by active session: {holder}'
-                              .format(tty=tty, event=event, holder=holder))
-                    break
-                elif _sid == holder and _sid == tty.sid:
-                    # acquire the lock from ourselves!  We'll allow it
-                    # (this is termed, "re-entrant locking").
-                    log.debug('{tty.sid}] {event} is re-acquired!'
-                              .format(tty=tty, event=event))
+            if holder != tty.sid and get_tty(holder) is not None:
+                log.debug('[{tty.sid}] {event} not acquired, '
+                          'held by active session: {holder}'
+                          .format(tty=tty, event=event, holder=holder))
+            elif holder == tty.sid:
+                # acquire the lock from ourselves!  We'll allow it
+                # (this is termed, "re-entrant locking").
+                log.debug('[{tty.sid}] {event} is re-acquired!'
+                          .format(tty=tty, event=event))
+                del locks[event]
             else:
                 # lock is held by a now-defunct session, re-acquired.
                 log.debug('[{tty.sid}] {event} re-acquiring stale lock, '
@@ -354,8 +354,11 @@ def session_recv(locks, terminals, log, tap_events):
     """
     Receive data waiting for terminal sessions.
 
-    All data received from subprocess is handled here.
+    All data received from subprocess is handled here.  Only the sessions
+    given by ``terminals`` are read, though events such as ``global`` and
+    ``route`` may be delivered to any other registered session.
     """
+    from x84.bbs.msgbase import notify_newmsg
     for sid, tty in terminals:
         while tty.master_read.poll():
             try:
@@ -386,28 +389,28 @@ def session_recv(locks, terminals, log, tap_events):
 
             # 'remote-disconnect' event, hunt and destroy
             elif event == 'remote-disconnect':
-                for _sid, _tty in terminals:
-                    # data[0] is 'send-to' address.
-                    if data[0] == _sid:
-                        kill_session(
-                            tty.client, 'remote-disconnect by {0}'.format(sid))
-                        break
+                # data (or data[0]) is 'send-to' address.
+                _tty = get_tty(data[0] if isinstance(data, tuple) else data)
+                if _tty is not None:
+                    kill_session(
+                        _tty.client, 'remote-disconnect by {0}'.format(sid))
 
             # 'route': message passing directly from one session to another
             elif event == 'route':
                 if tap_events:
                     log.debug('route {0!r}'.format(data))
                 tgt_sid, send_event, send_val = data[0], data[1], data[2:]
-                for _sid, _tty in terminals:
-                    if tgt_sid == _sid:
-                        _tty.master_write.send((send_event, send_val))
-                        break
+                _tty = get_tty(tgt_sid)
+                if _tty is not None:
+                    _tty.master_write.send((send_event, send_val))
 
             # 'global': message broadcasting to all sessions
             elif event == 'global':
                 if tap_events:
                     log.debug('broadcast: {data!r}'.format(data=data))
-                for _sid, _tty in terminals:
+                if data[0] == 'newmsg':
+                    notify_newmsg(data[1])
+                for _sid, _tty in get_terminals():
                     if sid != _sid:
                         _tty.master_write.send((event, data,))
 
@@ -418,9 +421,10 @@ def session_recv(locks, terminals, log, tap_events):
                               .format(tty=tty, data=data))
                 tty.timeout = data
 
-            # 'db*': access DBProxy API for shared sqlitedict
+            # 'db*': access DBProxy API for shared sqlite databases
             elif event.startswith('db'):
-                DBHandler(tty.master_write, event, data).start()
+                get_db_service().submit(
+                    DBHandler(tty.master_write, event, data))
 
             # 'lock': access fine-grained bbs-global locking
             elif event.startswith('lock'):
@@ -432,19 +436,56 @@ def session_recv(locks, terminals, log, tap_events):
                           .format(tty=tty, event=event, data=data))
 
 
+def reap_clients(servers):
+    """ Remove inactive clients and completed on-connect threads. """
+    for server in servers:
+        # bbs sessions that are no longer active on the socket
+        # level -- send them a 'kill signal'
+        for key, client in server.clients.items()[:]:
+            if not client.is_active():
+                kill_session(client, 'socket shutdown')
+                del server.clients[key]
+        # on-connect negotiations that have completed or failed.
+        # delete their thread instance from further evaluation
+        for thread in [_thread for _thread in server.threads
+                       if _thread.stopped][:]:
+            server.threads.remove(thread)
+
+
+def log_db_stats(log):
+    """ Log number of requests, busy time and queue depth of db workers. """
+    for stats in get_db_service().stats():
+        log.debug('{name}: {processed} requests, {busy_time:0.1f}s busy, '
+                  'queue depth {depth} (max {max_depth}).'.format(**stats))
+
+
+def get_poll_timeout(servers, pending, win32=False):
+    """
+    Return time the main event loop may block awaiting i/o.
+
+    :param list servers: all managed servers.
+    :param dict pending: terminals with client output not yet delivered.
+    :param bool win32: whether sessions must be polled at every loop.
+    :returns: seconds as float, or ``None`` to block indefinitely.
+    """
+    if pending or win32:
+        return SELECT_POLL
+    if any(server.clients or server.threads for server in servers):
+        # connected clients must be periodically checked for
+        # inactivity, the timeout of idle users, and so on.
+        return HOUSEKEEPING_INTERVAL
+    return None
+
+
 def _loop(servers):
     """ Main event loop. Never returns. """
     # pylint: disable=R0912,R0914,R0915
     #         Too many local variables (24/15)
     from x84.bbs.ini import CFG
 
-    SELECT_POLL = 0.02  # polling time is 20ms
-
-    # WIN32 has no session_fds (multiprocess queues are not polled using
-    # select), use a persistently empty set; for WIN32, sessions are always
-    # polled for data at every loop.
+    # WIN32 has no session fds (multiprocess queues are not polled using
+    # select), for WIN32, sessions are always polled for data at every loop.
     WIN32 = sys.platform.lower().startswith('win32')
-    session_fds = set()
 
     log = logging.getLogger('x84.engine')
 
@@ -455,67 +496,81 @@ def _loop(servers):
     check_ban = get_fail2ban_function()
     locks = dict()
 
+    # server sockets are registered once; client sockets are registered by
+    # accept(), and session pipes by x84.terminal.register_tty().
+    reactor = get_reactor()
+    for server in servers:
+        reactor.register(server, server.server_socket.fileno(), 'server')
+
+    # terminals with tcp data remaining to be sent, (sid, tty)
+    pending = dict()
+    housekeeping_time = 0
+    db_stats_time = time.time()
+
     while True:
-        # shutdown, close & delete inactive clients,
-        for server in servers:
-            # bbs sessions that are no longer active on the socket
-            # level -- send them a 'kill signal'
-            for key, client in server.clients.items()[:]:
-                if not client.is_active():
-                    kill_session(client, 'socket shutdown')
-                    del server.clients[key]
-            # on-connect negotiations that have completed or failed.
-            # delete their thread instance from further evaluation
-            for thread in [_thread for _thread in server.threads
-                           if _thread.stopped][:]:
-                server.threads.remove(thread)
+        if time.time() - housekeeping_time >= HOUSEKEEPING_INTERVAL:
+            # shutdown, close & delete inactive clients,
+            reap_clients(servers)
+            # and poll about and kick off idle users
+            terms = get_terminals()
+            client_send(terms, log)
+            session_send(terms)
+            housekeeping_time = time.time()
+            if housekeeping_time - db_stats_time >= DB_STATS_INTERVAL:
+                log_db_stats(log)
+                db_stats_time = housekeeping_time
 
-        check_r = list()
-        for server in servers:
-            check_r.append(server.server_socket.fileno())
-            check_r.extend(server.client_fds())
-        if not WIN32:
-            # WIN32's IPC is not done using sockets, so it
-            # is not possible to use select.select() on them
-            session_fds = get_session_output_fds(servers)
-            check_r.extend(session_fds)
-
-        # We'd like to use timeout 'None', but the registration of
-        # a new client in terminal.start_process surprises us with new
-        # file descriptors for the session i/o.  Unless we loop for
-        # additional `session_fds', a connecting client would block.
         try:
-            ready_r, _, _ = select.select(check_r, [], [], SELECT_POLL)
-        except select.error as err:
+            ready = reactor.poll(get_poll_timeout(servers, pending, WIN32))
+        except (select.error, IOError, OSError) as err:
             # more than likely EBADF (9, 'Bad file descriptor'), it would seem
             # the socket we've just decided to poll has just gone bad.
-            log.debug('continue after select.error: {0}'.format(err))
+            log.debug('continue after poll error: {0}'.format(err))
             continue
 
-        for fd in ready_r:
-            # see if any new tcp connections were made
-            server = find_server(servers, fd)
-            if server is not None:
-                accept(log, server, check_ban)
+        ready_clients, ready_ttys = list(), dict()
+        for kind, obj in ready:
+            if kind == 'server':
+                # new tcp connections were made
+                accept(log, obj, check_ban)
+            elif kind == 'client':
+                ready_clients.append(obj)
+            elif kind == 'session':
+                ready_ttys[obj.sid] = obj
 
         # receive new data from tcp clients.
-        client_recv(servers, ready_r, log)
-        terms = get_terminals()
+        client_recv(ready_clients, log)
 
         # receive new data from session terminals
-        if WIN32 or set(session_fds) & set(ready_r):
+        if WIN32:
+            ready_ttys = dict(get_terminals())
+        if ready_ttys:
             try:
-                session_recv(locks, terms, log, tap_events)
+                session_recv(locks, ready_ttys.items(), log, tap_events)
             except IOError as err:
                 # if the ipc closes while we poll, warn and continue
                 log.warn(err)
 
+        # only terminals that received input or output, or have
+        # output remaining from a previous loop, require attention.
+        touched = dict(pending)
+        touched.update(ready_ttys)
+        for client in ready_clients:
+            tty = find_tty(client)
+            if tty is not None:
+                touched[tty.sid] = tty
+        terms = [(sid, _tty) for sid, _tty in touched.items()
+                 if get_tty(sid) is _tty]
+
         # send tcp data to clients
         client_send(terms, log)
 
         # send session data, poll for user-timeout and disconnect them
         session_send(terms)
 
+        pending = dict((sid, tty) for sid, tty in terms
+                       if get_tty(sid) is tty and tty.client.send_ready())
+
 
 if __name__ == '__main__':
     exit(main())
@@ -0,0 +1,239 @@
+#!/usr/bin/env python2.7
+"""
+Message retention and archival for x/84.
+
+Messages are archived by tag, by the configuration items ``retain_days``
+and ``retain_count`` of section ``[msg]``, such as::
+
+    [msg]
+    retain_days = public: 365, x84net: 90
+    retain_count = x84net: 5000
+    archive_interval = 86400
+
+A tag retains messages sent within ``retain_days``, and the newest
+``retain_count`` messages of the tag.  A message is archived once any of
+its tags retain it no longer, and none retain it still; tags without a
+policy are not considered.  Archived messages are appended,
+compressed, to file ``msgarchive.dat`` of the data folder, and are removed
+from the message base and its indices.  They remain available by
+:func:`x84.bbs.msgbase.get_archived_msg`.
+
+Each record of the archive file is a header of the message index and
+length, :data:`x84.bbs.msgbase.ARCHIVE_HEADER`, followed by the compressed
+message.  The index of the archive file may be rebuilt by
+``python -m x84.dbmigrate archive``.
+"""
+
+# std imports
+import datetime
+import logging
+import time
+import os
+
+# local
+from . import cmdline
+
+
+def get_retention():
+    """
+    Return retention policy of configuration section ``[msg]``.
+
+    :rtype: dict
+    :returns: ``(days, count)`` keyed by tag, either may be ``None``.
+    """
+    from x84.bbs.ini import get_ini
+    log = logging.getLogger(__name__)
+
+    retention = dict()
+    for num, key in enumerate(('retain_days', 'retain_count')):
+        for item in filter(None, get_ini(section='msg', key=key, split=True)):
+            tag, _, value = item.rpartition(':')
+            try:
+                value = int(value)
+            except ValueError:
+                log.error('[msg] {0}: invalid value, {1!r}'.format(key, item))
+                continue
+            policy = list(retention.get(tag.strip(), (None, None)))
+            policy[num] = value
+            retention[tag.strip()] = tuple(policy)
+    return retention
+
+
+def list_expired(retention, now=None):
+    """
+    Return sorted list of messages no longer retained by ``retention``.
+
+    A message expired by the policy of one of its tags is kept while the
+    policy of any other of its tags retains it.
+
+    :param dict retention: ``(days, count)`` keyed by tag, as returned by
+                           :func:`get_retention`.
+    :param datetime.datetime now: time of comparison, default is now.
+    """
+    from x84.bbs.dbproxy import DBProxy
+    from x84.bbs.msgbase import MSGDB, list_msgs
+
+    now = now or datetime.datetime.now()
+    db_msg = DBProxy(MSGDB, use_session=False)
+
+    expired, retained = set(), set()
+    for tag, (days, count) in retention.items():
+        indices = sorted(list_msgs(tags=(tag,)))
+        expired_tag = set()
+        if count is not None:
+            expired_tag.update(indices[:max(0, len(indices) - count)])
+            indices = indices[max(0, len(indices) - count):]
+        if days is not None:
+            # message indices are ascending by time sent, stop at the
+            # first message that is retained.  Those saved out of order,
+            # such as by message networks, are archived when next in line.
+            until = now - datetime.timedelta(days=days)
+            for start in range(0, len(indices), 100):
+                chunk = ['%d' % (idx,) for idx in indices[start:start + 100]]
+                newer = [int(key) for key, (stime,)
+                         in db_msg.project(('stime',), chunk)
+                         if stime is None or stime >= until]
+                expired_tag.update(idx for idx in indices[start:start + 100]
+                                   if not newer or idx < min(newer))
+                if newer:
+                    break
+        expired.update(expired_tag)
+        retained.update(idx for idx in indices if idx not in expired_tag)
+    return sorted(expired - retained)
+
+
+def archive_msgs(indices):
+    """
+    Append messages ``indices`` to the archive file, removing them.
+
+    Messages are written and synchronized to disk before they are
+    indexed, and indexed before they are removed from the message base,
+    so that an interrupted archival loses nothing.  Replies to archived
+    messages are moved to their parent, or begin threads of their own,
+    and network ids of archived messages are removed.
+
+    :rtype: int
+    :returns: number of messages archived.
+    """
+    from x84.bbs.dbproxy import DBProxy
+    from x84.bbs.msgbase import (ARCHIVEDB, ARCHIVEIDX, ARCHIVE_HEADER,
+                                 get_archive_filepath, dump_archived_msg,
+                                 get_msg)
+
+    log = logging.getLogger(__name__)
+    db_archive = DBProxy(ARCHIVEDB, table=ARCHIVEIDX, use_session=False)
+
+    num_msgs = 0
+    with open(get_archive_filepath(), 'ab') as fobj:
+        for start in range(0, len(indices), 100):
+            msgs, records = list(), list()
+            fobj.seek(0, os.SEEK_END)
+            offset = fobj.tell()
+            for idx in indices[start:start + 100]:
+                try:
+                    msg = get_msg(idx)
+                except KeyError:
+                    log.warn('archive: message {0} not found.'.format(idx))
+                    continue
+                data = dump_archived_msg(msg)
+                fobj.write(ARCHIVE_HEADER.pack(msg.idx, len(data)))
+                fobj.write(data)
+                offset += ARCHIVE_HEADER.size
+                records.append((msg.idx, offset, len(data), list(msg.tags)))
+                offset += len(data)
+                msgs.append(msg)
+            fobj.flush()
+            os.fsync(fobj.fileno())
+            db_archive.proxy_method('add', records)
+            for msg in msgs:
+                msg.delete()
+            num_msgs += len(msgs)
+    return num_msgs
+
+
+def iter_archive(fobj):
+    """ Generate ``(idx, offset, length)`` of each record of ``fobj``. """
+    from x84.bbs.msgbase import ARCHIVE_HEADER
+    offset = 0
+    while True:
+        fobj.seek(offset)
+        header = fobj.read(ARCHIVE_HEADER.size)
+        if len(header) < ARCHIVE_HEADER.size:
+            return
+        idx, length = ARCHIVE_HEADER.unpack(header)
+        offset += ARCHIVE_HEADER.size
+        if offset + length > os.fstat(fobj.fileno()).st_size:
+            # incomplete record of an interrupted archival.
+            return
+        yield idx, offset, length
+        offset += length
+
+
+def do_archive():
+    """
+    Message archival process.
+
+    Function is called periodically by :func:`archiver`.
+    """
+    log = logging.getLogger(__name__)
+    retention = get_retention()
+    if not retention:
+        log.warn('archive: no retention policy configured.')
+        return
+    stime = time.time()
+    num_msgs = archive_msgs(list_expired(retention))
+    log.info('archive: archived {0} messages in {1:0.2f}s.'
+             .format(num_msgs, time.time() - stime))
+
+
+def archiver(archive_interval):
+    """ Blocking function periodically archives expired messages. """
+    log = logging.getLogger(__name__)
+    while True:
+        # pylint: disable=W0703
+        #         Catching too general exception
+        try:
+            do_archive()
+        except Exception as err:
+            log.exception(err)
+        time.sleep(archive_interval)
+
+
+def main(background_daemon=True):
+    """
+    Entry point to configure and begin message archival.
+
+    Called by x84/engine.py, function main() as unmanaged thread.
+
+    :param bool background_daemon: When True (default), this function returns
+                and messages are archived by an unmanaged, background (daemon)
+                thread.  Otherwise, messages are archived once.
+    :rtype: None
+    """
+    from threading import Thread
+    from x84.bbs.ini import get_ini
+
+    log = logging.getLogger(__name__)
+
+    archive_interval = get_ini(section='msg',
+                               key='archive_interval',
+                               getter='getint'
+                               ) or 86400
+
+    if background_daemon:
+        t = Thread(target=archiver, args=(archive_interval,))
+        t.daemon = True
+        log.info('msgarchive at {0}s intervals.'.format(archive_interval))
+        t.start()
+    else:
+        do_archive()
+
+if __name__ == '__main__':
+    # as we are running outside of the 'engine' context, it is necessary
+    # for us to initialize the .ini configuration scheme so that the
+    # retention policy and data folder may be gathered.
+    import x84.bbs.ini
+    x84.bbs.ini.init(*cmdline.parse_args())
+
+    # archive expired messages once, not as a background thread.
+    main(background_daemon=False)
@@ -0,0 +1,344 @@
+#!/usr/bin/env python2.7
+"""
+Bulk import and export of messages as mbox or maildir mailboxes for x/84.
+
+Usage::
+
+    python -m x84.msgmail [--config <filepath>] [--logger <filepath>] \\
+        [--maildir] [--tags <tag>[,<tag>]] import|export <path>
+
+Messages are exported with their tags as header ``X-X84-Tags``, and with a
+``Message-ID`` of their index, so that replies of messages imported again
+are threaded by their ``In-Reply-To`` header.  Messages imported without
+tags are given those of option ``--tags``, ``public`` by default.  When
+exporting, ``--tags`` selects messages of any of those tags.
+
+Like :mod:`x84.dbmigrate`, it must be run while the bbs is not running: the
+databases are written directly, in transactions of :data:`BATCH_SIZE`
+messages, and threads are linked once all messages are imported.
+"""
+# std imports
+import email.header
+import email.mime.text
+import email.utils
+import datetime
+import mailbox
+import getopt
+import logging
+import time
+import sys
+import os
+
+#: number of messages written by each transaction.
+BATCH_SIZE = 10000
+
+#: format of ``Message-ID`` of exported messages.
+MESSAGE_ID = '<{0}.x84@{1}>'
+
+
+def get_hostname():
+    """ Return host name of ``Message-ID`` of exported messages. """
+    from x84.bbs.ini import get_ini
+    return ''.join(char for char in get_ini('system', 'bbsname').lower()
+                   if char.isalnum()) or 'x84'
+
+
+def decode_header(value):
+    """ Return unicode of RFC 2047-encoded header ``value``. """
+    if value is None:
+        return u''
+    return u''.join(
+        text.decode(charset or 'ascii', 'replace')
+        for text, charset in email.header.decode_header(value))
+
+
+def get_address_name(value):
+    """ Return name of address header ``value``, or its local part. """
+    name, addr = email.utils.parseaddr(decode_header(value))
+    return name or addr.partition(u'@')[0] or None
+
+
+def get_body(message):
+    """ Return unicode body of first text/plain part of ``message``. """
+    for part in message.walk():
+        if part.get_content_type() == 'text/plain':
+            payload = part.get_payload(decode=True) or ''
+            try:
+                return payload.decode(part.get_content_charset() or 'utf8',
+                                      'replace')
+            except LookupError:
+                return payload.decode('utf8', 'replace')
+    return u''
+
+
+def get_date(message):
+    """ Return local datetime of header ``Date``, or now. """
+    parsed = email.utils.parsedate_tz(message.get('Date', ''))
+    if parsed is None:
+        return datetime.datetime.now()
+    return datetime.datetime.fromtimestamp(email.utils.mktime_tz(parsed))
+
+
+def to_message(msg, hostname):
+    """ Return :class:`email.message.Message` of Msg instance ``msg``. """
+    message = email.mime.text.MIMEText(
+        msg.body.encode('utf8'), 'plain', 'utf-8')
+    message['From'] = email.header.Header(msg.author or u'', 'utf-8')
+    message['To'] = email.header.Header(msg.recipient or u'All', 'utf-8')
+    message['Subject'] = email.header.Header(msg.subject or u'', 'utf-8')
+    message['Date'] = email.utils.formatdate(
+        time.mktime((msg.stime or msg.ctime).timetuple()), localtime=True)
+    message['Message-ID'] = MESSAGE_ID.format(msg.idx, hostname)
+    if msg.parent is not None:
+        message['In-Reply-To'] = MESSAGE_ID.format(msg.parent, hostname)
+    message['X-X84-Tags'] = email.header.Header(
+        u', '.join(sorted(msg.tags)), 'utf-8')
+    return message
+
+
+def to_msg(message, default_tags):
+    """
+    Return Msg instance of ``message``, and ``Message-ID`` of its parent.
+
+    The returned message is not saved, and has no index.
+    """
+    from x84.bbs.msgbase import Msg
+    msg = Msg(recipient=get_address_name(message['To']),
+              subject=decode_header(message['Subject']),
+              body=get_body(message))
+    msg.author = get_address_name(message['From'])
+    # pylint: disable=W0212
+    #         Access to a protected member _ctime of a client class
+    msg._ctime = msg._stime = get_date(message)
+    tags = filter(None, (tag.strip() for tag in
+                         decode_header(message['X-X84-Tags']).split(u',')))
+    msg.tags = set(tags or default_tags)
+    if msg.recipient == u'All' and u'public' in msg.tags:
+        msg.recipient = None
+    # the parent is the last of References, when not In-Reply-To.
+    references = (message['In-Reply-To'] or message['References'] or
+                  '').split()
+    return msg, (references[0] if message['In-Reply-To'] else
+                 references[-1] if references else None)
+
+
+def open_mailbox(path, maildir=False):
+    """ Return mbox or maildir mailbox of ``path``. """
+    if maildir or os.path.isdir(path):
+        return mailbox.Maildir(path, factory=None, create=True)
+    return mailbox.mbox(path, factory=None, create=True)
+
+
+def import_msgs(path, maildir=False, tags=(u'public',)):
+    """
+    Import all messages of mailbox ``path`` to the message base.
+
+    :returns: number of messages imported.
+    """
+    # pylint: disable=R0914
+    #         Too many local variables
+    from x84.db import get_database, get_db_filepath, transaction
+    from x84.bbs.msgbase import (MSGDB, BODYDB, SEARCHIDX, THREADIDX, TAGDB,
+                                 TAGIDX, READIDX, PRIVDB, compress_body)
+    from x84.dbindex import Sequences, split_terms, encode_text
+    log = logging.getLogger(__name__)
+
+    filepath = get_db_filepath(MSGDB)
+    db_msg = get_database(filepath, 'unnamed')
+    db_body = get_database(filepath, BODYDB)
+    db_search = get_database(filepath, SEARCHIDX)
+    db_thread = get_database(filepath, THREADIDX)
+    db_seq = get_database(filepath, Sequences.tablename)
+    db_tag = get_database(get_db_filepath(TAGDB), TAGIDX)
+    db_priv = get_database(get_db_filepath(PRIVDB), 'unnamed')
+
+    # messages are linked to their parents by Message-ID once all are
+    # imported, as replies are not always found after the message.  Search
+    # terms are indexed once all are imported, in order of the index.
+    db_msg.conn.execute('CREATE TEMP TABLE IF NOT EXISTS import_ids ('
+                        ' msgid TEXT PRIMARY KEY, idx INTEGER NOT NULL)')
+    db_msg.conn.execute('CREATE TEMP TABLE IF NOT EXISTS import_parents ('
+                        ' idx INTEGER PRIMARY KEY, msgid TEXT NOT NULL)')
+    db_msg.conn.execute('CREATE TEMP TABLE IF NOT EXISTS import_terms ('
+                        ' term TEXT NOT NULL, idx INTEGER NOT NULL)')
+
+    def write_batch(batch):
+        """ Write ``(msg, msgid, parent_id)`` items of ``batch``. """
+        privmsgs = dict()
+        with transaction(db_msg.conn):
+            idx = db_seq.next('unnamed', len(batch))
+            for msg, msgid, parent_id in batch:
+                msg.idx, idx = idx, idx + 1
+                key = '%d' % (msg.idx,)
+                # pylint: disable=W0212
+                #         Access to a protected member _body of a client class
+                db_body[key] = compress_body(msg._body)
+                db_msg.conn.executemany(
+                    'INSERT INTO import_terms (term, idx) VALUES (?, ?)',
+                    ((encode_text(term), msg.idx) for term in
+                     split_terms(msg.subject) | split_terms(msg._body)))
+                db_thread.set_parent(msg.idx, None)
+                db_msg[key] = msg
+                if msgid:
+                    db_msg.conn.execute(
+                        'INSERT OR IGNORE INTO import_ids (msgid, idx) '
+                        'VALUES (?, ?)', (msgid, msg.idx))
+                if parent_id:
+                    db_msg.conn.execute(
+                        'INSERT INTO import_parents (idx, msgid) '
+                        'VALUES (?, ?)', (msg.idx, parent_id))
+                if u'public' not in msg.tags:
+                    privmsgs.setdefault(msg.recipient, set()).add(msg.idx)
+        with transaction(db_tag.conn):
+            for msg, _, _ in batch:
+                db_tag.set_tags(msg.idx, msg.tags)
+        with transaction(db_priv.conn):
+            for recipient, indices in privmsgs.items():
+                db_priv[recipient] = db_priv.get(recipient, set()) | indices
+
+    num_msgs, batch, stime = 0, list(), time.time()
+    for message in open_mailbox(path, maildir).itervalues():
+        msg, parent_id = to_msg(message, tags)
+        batch.append((msg, (message['Message-ID'] or '').strip(), parent_id))
+        if len(batch) == BATCH_SIZE:
+            write_batch(batch)
+            num_msgs += len(batch)
+            batch = list()
+            log.info('import: {0} messages, {1:0.1f}s.'
+                     .format(num_msgs, time.time() - stime))
+    if batch:
+        write_batch(batch)
+        num_msgs += len(batch)
+
+    # link replies to their parent, moving any replies of their own.
+    with transaction(db_msg.conn):
+        # secondary indexes are faster created again than updated.
+        db_search.conn.execute('DROP INDEX IF EXISTS searchindex_idx')
+        db_search.conn.execute(
+            'INSERT OR IGNORE INTO searchindex (term, idx) '
+            'SELECT term, idx FROM import_terms ORDER BY term, idx')
+        for statement in db_search.create:
+            db_search.conn.execute(statement)
+        for idx, parent in db_msg.conn.execute(
+                'SELECT p.idx, i.idx FROM import_parents p '
+                'JOIN import_ids i ON i.msgid = p.msgid').fetchall():
+            try:
+                db_thread.set_parent(idx, parent)
+            except AssertionError:
+                log.warn('import: message {0}, circular reply of {1}.'
+                         .format(idx, parent))
+                continue
+            msg = db_msg['%d' % (idx,)]
+            msg.parent = parent
+            db_msg['%d' % (idx,)] = msg
+        db_msg.conn.execute('DROP TABLE import_ids')
+        db_msg.conn.execute('DROP TABLE import_parents')
+        db_msg.conn.execute('DROP TABLE import_terms')
+
+    # subscription views are counted again when next requested.
+    db_read = get_database(get_db_filepath(TAGDB), READIDX)
+    with transaction(db_read.conn):
+        db_read.clear_views()
+
+    log.info('import: imported {0} messages in {1:0.1f}s.'
+             .format(num_msgs, time.time() - stime))
+    return num_msgs
+
+
+def export_msgs(path, maildir=False, tags=None):
+    """
+    Export messages of ``tags``, or all, to mailbox ``path``.
+
+    :returns: number of messages exported.
+    """
+    from x84.db import get_database, get_db_filepath
+    from x84.bbs.msgbase import (MSGDB, BODYDB, TAGDB, TAGIDX,
+                                 decompress_body)
+    log = logging.getLogger(__name__)
+
+    filepath = get_db_filepath(MSGDB)
+    db_msg = get_database(filepath, 'unnamed')
+    db_body = get_database(filepath, BODYDB)
+    if tags:
+        keys = ['%d' % (idx,) for idx in sorted(
+            get_database(get_db_filepath(TAGDB), TAGIDX).list_msgs(tags))]
+    else:
+        keys = sorted(db_msg.keys(), key=int)
+
+    hostname = get_hostname()
+    box = open_mailbox(path, maildir)
+    box.lock()
+    num_msgs, stime = 0, time.time()
+    try:
+        for key in keys:
+            msg = db_msg.get(key)
+            if msg is None:
+                continue
+            msg.body = decompress_body(db_body.get(key, u''))
+            box.add(to_message(msg, hostname))
+            num_msgs += 1
+            if num_msgs % BATCH_SIZE == 0:
+                box.flush()
+                log.info('export: {0} messages, {1:0.1f}s.'
+                         .format(num_msgs, time.time() - stime))
+        box.flush()
+    finally:
+        box.unlock()
+        box.close()
+    log.info('export: exported {0} messages in {1:0.1f}s.'
+             .format(num_msgs, time.time() - stime))
+    return num_msgs
+
+
+def parse_args():
+    """ Parse system arguments, return lookup paths, options and command. """
+    from x84 import cmdline
+    lookup_bbs, lookup_log, maildir, tags = None, None, False, None
+    try:
+        opts, tail = getopt.getopt(sys.argv[1:], u'', (
+            'config=', 'logger=', 'maildir', 'tags=', 'help'))
+    except getopt.GetoptError as err:
+        sys.stderr.write('{0}\n'.format(err))
+        sys.exit(1)
+    for opt, arg in opts:
+        if opt in ('--config',):
+            lookup_bbs = (arg,)
+        elif opt in ('--logger',):
+            lookup_log = (arg,)
+        elif opt in ('--maildir',):
+            maildir = True
+        elif opt in ('--tags',):
+            tags = filter(None, (tag.strip() for tag in
+                                 arg.decode('utf8').split(u',')))
+        elif opt in ('--help',):
+            tail = []
+    if len(tail) != 2 or tail[0] not in ('import', 'export'):
+        sys.stderr.write(
+            'Usage: \n'
+            '{0} [--config <filepath>] [--logger <filepath>] [--maildir] '
+            '[--tags <tag>[,<tag>]] import|export <path>\n'
+            .format(os.path.basename(sys.argv[0])))
+        sys.exit(1)
+    # use default lookup paths of the bbs for those not given.
+    _argv, sys.argv = sys.argv, sys.argv[:1]
+    try:
+        default_bbs, default_log = cmdline.parse_args()
+    finally:
+        sys.argv = _argv
+    return (lookup_bbs or default_bbs, lookup_log or default_log,
+            maildir, tags, tail[0], tail[1])
+
+
+def main():
+    """ Import or export messages by command-line arguments. """
+    lookup_bbs, lookup_log, maildir, tags, command, path = parse_args()
+    import x84.bbs.ini
+    x84.bbs.ini.init(lookup_bbs, lookup_log)
+    if command == 'import':
+        import_msgs(path, maildir, tags or (u'public',))
+    else:
+        export_msgs(path, maildir, tags)
+
+
+if __name__ == '__main__':
+    main()
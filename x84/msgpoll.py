@@ -2,8 +2,10 @@
 """ x84net message poll for x/84. """
 
 # std imports
+import threading
 import logging
 import hashlib
+import random
 import time
 import json
 import os
@@ -14,6 +16,26 @@ from . import cmdline
 # 3rd-party
 import requests
 
+#: seconds to wait for a network to respond, unless configured by option
+#: ``timeout`` of section ``[msgnet_<name>]``.
+NET_TIMEOUT = 30
+
+#: seconds a network may hold a poll until new messages arrive, unless
+#: configured by option ``poll_wait`` of section ``[msgnet_<name>]``, where
+#: ``0`` disables long-polling.
+POLL_WAIT = 60
+
+#: seconds to wait before the first retry of a failed poll or publish,
+#: doubled by each consecutive failure, up to ``poll_interval``.
+BACKOFF_BASE = 15
+
+#: maximum number of messages published by a single request.
+PUSH_BATCH = 50
+
+#: counters of requests made to each network, see :func:`get_network_stats`.
+NETWORK_STATS = dict()
+NETWORK_STATS_LOCK = threading.Lock()
+
 
 def get_token(network):
     """ get token for authentication """
@@ -39,33 +61,116 @@ def prepare_message(msg, network, parent):
     }
 
 
-def pull_rest(net, last_msg_id):
-    """ pull messages for a given network newer than the 'last' message idx """
+def get_http_session():
+    """
+    Return a :class:`requests.Session` for requests to a network.
+
+    Connections are kept alive, and pooled for its pull and publish
+    workers, which may make requests concurrently.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=2)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_network_stats():
+    """
+    Return counters of requests made to each network.
+
+    :rtype: dict
+    :returns: keyed by network name, a dictionary of ``'pull'`` and
+              ``'push'`` counters: number of ``requests`` and ``errors``,
+              ``latency`` of the last request, and ``total_latency`` in
+              seconds.
+    """
+    with NETWORK_STATS_LOCK:
+        return dict((name, dict((kind, counters.copy())
+                                for kind, counters in stats.items()))
+                    for name, stats in NETWORK_STATS.items())
+
+
+def count_request(net, kind, latency, error):
+    """ Count request of ``kind``, ``'pull'`` or ``'push'``, to ``net``. """
+    with NETWORK_STATS_LOCK:
+        counters = NETWORK_STATS.setdefault(net['name'], dict()).setdefault(
+            kind, dict(requests=0, errors=0, latency=0.0, total_latency=0.0))
+        counters['requests'] += 1
+        counters['errors'] += int(bool(error))
+        counters['latency'] = latency
+        counters['total_latency'] += latency
+
+
+def net_request(net, kind, method, url, **kwargs):
+    """
+    Request ``url`` of network ``net``, counting its latency and errors.
+
+    :param str kind: ``'pull'`` or ``'push'``, see :func:`count_request`.
+    :param str method: http method, such as ``'get'``.
+    :param tuple status: response codes of success, default ``(200,)``.
+    :rtype: requests.Response
+    :returns: response, or ``None`` when the response is not of ``status``.
+    :raises requests.RequestException: network is not reachable, or did
+                                       not respond within its timeout.
+    """
+    log = logging.getLogger(__name__)
+    status = kwargs.pop('status', (200,))
+    kwargs.setdefault('timeout', net['timeout'])
+    stime = time.time()
+    try:
+        req = net['session'].request(method, url,
+                                     headers={'Auth-X84net': get_token(net)},
+                                     verify=net['verify'], **kwargs)
+    except requests.RequestException as err:
+        count_request(net, kind, time.time() - stime, error=True)
+        log.warn('[{net[name]}] {err.__class__.__name__} in {kind}: {err}'
+                 .format(net=net, kind=kind, err=err))
+        raise
+
+    count_request(net, kind, time.time() - stime,
+                  error=req.status_code not in status)
+    if req.status_code not in status:
+        log.error('[{net[name]}] HTTP error, code={req.status_code}'
+                  .format(net=net, req=req))
+        return None
+    return req
+
+
+def pull_rest(net, last_msg_id, wait=0):
+    """
+    pull messages for a given network newer than the 'last' message idx
+
+    When ``wait`` is non-zero, the network may hold the request for up to
+    as many seconds until new messages arrive; whether it allows requests
+    to be held is stored as ``net['long_poll']``.
+
+    :returns: messages and the ``last`` index of the following request,
+              or ``None`` when no messages remain; False on error.
+    """
     url = '%smessages/%s/%s' % (net['url_base'], net['name'], last_msg_id)
+    params = {'wait': wait} if wait else None
 
     log = logging.getLogger(__name__)
 
     try:
-        req = requests.get(url,
-                           headers={'Auth-X84net': get_token(net)},
-                           verify=net['verify'])
-    except requests.ConnectionError as err:
-        log.warn('[{net[name]}] ConnectionError in pull_rest: {err}'
-                 .format(net=net, err=err))
+        req = net_request(net, 'pull', 'get', url, params=params,
+                          timeout=net['timeout'] + wait)
+    except requests.RequestException:
         return False
-    except Exception as err:
-        log.exception('[{net[name]}] exception in pull_rest: {err}'
-                      .format(net=net, err=err))
-        return False
-
-    if req.status_code != 200:
-        log.error('[{net[name]}] HTTP error, code={req.status_code}'
-                  .format(net=net, req=req))
+    if req is None:
         return False
 
     try:
         response = json.loads(req.text)
-        return response['messages'] if response['response'] else []
+        if not response['response']:
+            return [], None
+        # hubs of previous versions do not hold requests, and replies
+        # with messages of those that do also grant 'wait'.
+        if wait:
+            net['long_poll'] = bool(response.get('wait', 0))
+        return response['messages'], response.get('next', None)
     except Exception as err:
         log.exception('[{net[name]}] JSON error: {err}'
                       .format(net=net, err=err))
@@ -73,7 +178,12 @@ def pull_rest(net, last_msg_id):
 
 
 def push_rest(net, msg, parent):
-    """ push message for a given network and append an origin line """
+    """
+    push message for a given network and append an origin line
+
+    :returns: message id given by the network, False when the message was
+              not posted, or None when the network is not reachable.
+    """
     msg_data = prepare_message(msg, net, parent)
     url = '{net[url_base]}messages/{net[name]}/'.format(net=net)
     data = {'message': json.dumps(msg_data)}
@@ -81,18 +191,44 @@ def push_rest(net, msg, parent):
     log = logging.getLogger(__name__)
 
     try:
-        req = requests.put(url,
-                           headers={'Auth-X84net': get_token(net)},
-                           data=data,
-                           verify=net['verify'])
+        req = net_request(net, 'push', 'put', url, data=data,
+                          status=(200, 201))
+    except requests.RequestException:
+        return None
+    if req is None:
+        return False
+
+    try:
+        response = json.loads(req.text)
     except Exception as err:
-        log.exception('[{net[name]}] exception in push_rest: {err}'
+        log.exception('[{net[name]}] JSON error: {err}'
                       .format(net=net, err=err))
-        return False
+    else:
+        if response['response'] and 'id' in response:
+            return response['id']
+    return False
 
-    if req.status_code not in (200, 201):
-        log.error('{net[name]} HTTP error, code={req.status_code}'
-                  .format(net=net, req=req))
+
+def push_rest_batch(net, items):
+    """
+    push messages ``items``, ``(msg, parent)``, for a given network
+
+    :returns: list of message ids given by the network, or False, for each
+              message; False when the network does not accept batches, or
+              None when the network is not reachable.
+    """
+    msg_data = [prepare_message(msg, net, parent) for msg, parent in items]
+    url = '{net[url_base]}messages/{net[name]}/'.format(net=net)
+    data = {'messages': json.dumps(msg_data)}
+
+    log = logging.getLogger(__name__)
+
+    try:
+        req = net_request(net, 'push', 'put', url, data=data,
+                          status=(200, 201))
+    except requests.RequestException:
+        return None
+    if req is None:
         return False
 
     try:
@@ -101,8 +237,10 @@ def push_rest(net, msg, parent):
         log.exception('[{net[name]}] JSON error: {err}'
                       .format(net=net, err=err))
     else:
-        if response['response'] and 'id' in response:
-            return response['id']
+        if (response['response'] and
+                len(response.get('ids', ())) == len(items)):
+            return [trans_id if trans_id is not None else False
+                    for trans_id in response['ids']]
     return False
 
 
@@ -156,6 +294,14 @@ def get_networks():
             else:
                 net['verify'] = ca_path
 
+        net['timeout'] = get_ini(section=section, key='timeout',
+                                 getter='getint') or NET_TIMEOUT
+        net['poll_wait'] = POLL_WAIT
+        if get_ini(section=section, key='poll_wait'):
+            net['poll_wait'] = get_ini(section=section, key='poll_wait',
+                                       getter='getint')
+        net['session'] = get_http_session()
+
         networks.append(net)
     return networks
 
@@ -184,33 +330,32 @@ def get_last_msg_id(last_file):
     return last_msg_id
 
 
-def poll_network_for_messages(net):
-    """ Poll for new messages of network, ``net``. """
-    from x84.bbs import Msg, DBProxy
-    from x84.bbs.msgbase import to_localtime
+def long_poll_network_for_messages(net):
+    """
+    Poll for new messages of network, ``net``, by long-polling.
 
-    log = logging.getLogger(__name__)
+    Each request is held by the network for up to ``poll_wait`` seconds
+    until new messages arrive, and is repeated at once.  Returns when the
+    network could not be polled, or does not hold requests, such as hubs of
+    previous versions, or those holding too many requests.
 
-    log.debug(u'[{net[name]}] Polling for new messages.'.format(net=net))
+    :returns: False when the network could not be polled.
+    """
+    while True:
+        result = poll_network_for_messages(net, wait=net['poll_wait'])
+        if result is False or not net.get('long_poll'):
+            return result
 
-    try:
-        last_msg_id = get_last_msg_id(net['last_file'])
-    except (OSError, IOError) as err:
-        log.error('[{net[name]}] skipping network: {err}'
-                  .format(net=net, err=err))
-        return
 
-    msgs = pull_rest(net=net, last_msg_id=last_msg_id)
+def store_network_messages(net, msgs):
+    """ Store messages ``msgs`` received from network, ``net``. """
+    from x84.bbs import Msg, DBProxy
+    from x84.bbs.msgbase import to_localtime, TRANSIDX
 
-    if msgs:
-        log.info('[{net[name]}] Retrieved {num} messages.'
-                 .format(net=net, num=len(msgs)))
-    else:
-        log.debug('[{net[name]}] No messages.'.format(net=net))
-        return
+    log = logging.getLogger(__name__)
 
-    transdb = DBProxy('{0}trans'.format(net['name']), use_session=False)
-    transkeys = transdb.keys()
+    transdb = DBProxy('{0}trans'.format(net['name']), table=TRANSIDX,
+                      use_session=False)
     msgs = sorted(msgs, cmp=lambda x, y: cmp(int(x['id']), int(y['id'])))
 
     # store messages locally, saving their translated IDs to the transdb
@@ -228,51 +373,164 @@ def poll_network_for_messages(net):
                      "adding 'public' tag".format(net=net, msg=msg))
             store_msg.tags.add(u'public')
 
-        if (msg['parent'] is not None and
-                str(msg['parent']) not in transkeys):
-            log.warn('[{net[name]}] No such parent message ({msg[parent]}, '
-                     'msg_id={msg[id]}), removing reference.'
-                     .format(net=net, msg=msg))
-        elif msg['parent'] is not None:
-            store_msg.parent = int(transdb[msg['parent']])
+        if msg['parent'] is not None:
+            store_msg.parent = transdb.proxy_method('get_idx', msg['parent'])
+            if store_msg.parent is None:
+                log.warn('[{net[name]}] No such parent message '
+                         '({msg[parent]}, msg_id={msg[id]}), removing '
+                         'reference.'.format(net=net, msg=msg))
 
-        if msg['id'] in transkeys:
+        if transdb.proxy_method('get_idx', msg['id']) is not None:
             log.warn('[{net[name]}] dupe (msg_id={msg[id]}) discarded.'
                      .format(net=net, msg=msg))
         else:
             # do not save this message to network, we already received
             # it from the network, set send_net=False
             store_msg.save(send_net=False, ctime=to_localtime(msg['ctime']))
-            with transdb:
-                transdb[msg['id']] = store_msg.idx
-            transkeys.append(msg['id'])
+            transdb.proxy_method('add', msg['id'], store_msg.idx)
             log.info('[{net[name]}] Processed (msg_id={msg[id]}) => {new_id}'
                      .format(net=net, msg=msg, new_id=store_msg.idx))
 
-        if 'last' not in net.keys() or int(net['last']) < int(msg['id']):
-            net['last'] = msg['id']
 
-    if 'last' in net.keys():
-        with open(net['last_file'], 'w') as last_fp:
-            last_fp.write(str(net['last']))
+def poll_network_for_messages(net, wait=0):
+    """
+    Poll for new messages of network, ``net``.
 
-    return
+    Messages are pulled in batches, following the ``next`` cursor of each
+    reply, until none remain.  When none remain, the network may hold the
+    request for up to ``wait`` seconds until new messages arrive.
+
+    :returns: False when the network could not be polled.
+    """
+    log = logging.getLogger(__name__)
+
+    log.debug(u'[{net[name]}] Polling for new messages.'.format(net=net))
+
+    try:
+        last_msg_id = get_last_msg_id(net['last_file'])
+    except (OSError, IOError) as err:
+        log.error('[{net[name]}] skipping network: {err}'
+                  .format(net=net, err=err))
+        return False
+
+    while True:
+        response = pull_rest(net=net, last_msg_id=last_msg_id, wait=wait)
+        if response is False:
+            return False
+        msgs, cursor = response
+
+        if msgs:
+            log.info('[{net[name]}] Retrieved {num} messages.'
+                     .format(net=net, num=len(msgs)))
+            store_network_messages(net, msgs)
+        else:
+            log.debug('[{net[name]}] No messages.'.format(net=net))
+
+        # messages preceding the cursor of a reply, such as those sent
+        # by this board, are not requested again.
+        net['last'] = max([int(last_msg_id)] +
+                          [int(msg['id']) for msg in msgs] +
+                          [int(cursor or 0)])
+        advanced = net['last'] != int(last_msg_id)
+        if advanced:
+            with open(net['last_file'], 'w') as last_fp:
+                last_fp.write(str(net['last']))
+        last_msg_id = net['last']
+
+        # hubs of previous versions reply without a cursor.
+        if cursor is None or not advanced:
+            return True
+
+
+def push_messages(net, items):
+    """
+    Push messages ``items``, ``(msg, parent)``, to network ``net``.
+
+    Messages are posted in a single batch, unless the network does not
+    accept them, when each is posted by :func:`push_rest`.
+
+    :rtype: list
+    :returns: message id given by the network for each message, False
+              when it was not posted, or None when the network was not
+              reachable.
+    """
+    log = logging.getLogger(__name__)
+    if net.get('push_batch', True):
+        trans_ids = push_rest_batch(net=net, items=items)
+        if trans_ids is None:
+            return [None] * len(items)
+        elif trans_ids is not False:
+            return trans_ids
+        log.info('[{net[name]}] batches not accepted, posting singly.'
+                 .format(net=net))
+        net['push_batch'] = False
+
+    trans_ids = list()
+    for msg, parent in items:
+        trans_id = push_rest(net=net, msg=msg, parent=parent)
+        if trans_id is None:
+            # messages already posted are recorded.
+            return trans_ids + [None] * (len(items) - len(trans_ids))
+        trans_ids.append(trans_id)
+    return trans_ids
 
 
 def publish_network_messages(net):
-    """ Push messages to network, ``net``. """
+    """
+    Push messages to network, ``net``.
+
+    Queued messages are posted in batches of :data:`PUSH_BATCH`, a reply
+    ending its batch when its parent is also queued.
+
+    :returns: False when the network is not reachable.
+    """
     from x84.bbs import DBProxy
-    from x84.bbs.msgbase import format_origin_line, MSGDB
+    from x84.bbs.msgbase import (format_origin_line, compress_body, MSGDB,
+                                 BODYDB, TRANSIDX)
 
     log = logging.getLogger(__name__)
 
     log.debug(u'[{net[name]}] publishing new messages.'.format(net=net))
 
     queuedb = DBProxy('{0}queues'.format(net['name']), use_session=False)
-    transdb = DBProxy('{0}trans'.format(net['name']), use_session=False)
+    transdb = DBProxy('{0}trans'.format(net['name']), table=TRANSIDX,
+                      use_session=False)
     msgdb = DBProxy(MSGDB, use_session=False)
+    bodydb = DBProxy(MSGDB, table=BODYDB, use_session=False)
+
+    def publish(batch):
+        """ Publish ``batch`` of ``(msg_id, msg, trans_parent)``. """
+        trans_ids = push_messages(net, [(msg, trans_parent)
+                                        for _, msg, trans_parent in batch])
+        for (msg_id, msg, _), trans_id in zip(batch, trans_ids):
+            if trans_id is None:
+                # remaining messages are published when next reachable.
+                return False
+            elif trans_id is False:
+                log.error('[{net[name]}] Message not posted '
+                          '(msg_id={msg_id})'.format(net=net, msg_id=msg_id))
+                continue
+
+            if not transdb.proxy_method('add', trans_id, msg_id):
+                log.error('[{net[name]}] trans_id={trans_id} conflicts with '
+                          '(msg_id={msg_id})'
+                          .format(net=net, trans_id=trans_id, msg_id=msg_id))
+                with queuedb:
+                    del queuedb[msg_id]
+                continue
+
+            # transform, and possibly duplicate(?) message ..
+            with msgdb, queuedb:
+                bodydb[msg_id] = compress_body(
+                    u''.join((msg.body, format_origin_line())))
+                del queuedb[msg_id]
+            log.info('[{net[name]}] Published (msg_id={msg_id}) => '
+                     '{trans_id}'.format(net=net, msg_id=msg_id,
+                                         trans_id=trans_id))
+        return True
 
     # publish each message
+    batch = list()
     for msg_id in sorted(queuedb.keys(),
                          cmp=lambda x, y: cmp(int(x), int(y))):
         if msg_id not in msgdb:
@@ -283,40 +541,98 @@ def publish_network_messages(net):
 
         msg = msgdb[msg_id]
 
+        if msg.parent in [queued.idx for _, queued, _ in batch]:
+            # the network id of its parent is not yet known.
+            if not publish(batch):
+                return False
+            batch = list()
+
         trans_parent = None
         if msg.parent is not None:
-            matches = [key for key, data in transdb.items()
-                       if int(data) == msg.parent]
-
-            if len(matches) > 0:
-                trans_parent = matches[0]
-            else:
+            trans_parent = transdb.proxy_method('get_net_id', msg.parent)
+            if trans_parent is None:
                 log.warn('[{net[name]}] Parent ID {msg.parent} '
                          'not in translation-DB (msg_id={msg_id})'
                          .format(net=net, msg=msg, msg_id=msg_id))
 
-        trans_id = push_rest(net=net, msg=msg, parent=trans_parent)
-        if trans_id is False:
-            log.error('[{net[name]}] Message not posted (msg_id={msg_id})'
-                      .format(net=net, msg_id=msg_id))
-            continue
+        batch.append((msg_id, msg, trans_parent))
+        if len(batch) == PUSH_BATCH:
+            if not publish(batch):
+                return False
+            batch = list()
 
-        if trans_id in transdb.keys():
-            log.error('[{net[name]}] trans_id={trans_id} conflicts with '
-                      '(msg_id={msg_id})'
-                      .format(net=net, trans_id=trans_id, msg_id=msg_id))
-            with queuedb:
-                del queuedb[msg_id]
+    if batch:
+        return publish(batch)
+    return True
+
+
+def get_backoff(poll_interval, failures):
+    """
+    Return seconds to wait before next poll, after ``failures``.
+
+    Consecutive failures are retried after an exponentially increasing,
+    randomly jittered delay, up to ``poll_interval``.
+    """
+    if not failures:
+        return poll_interval
+    delay = min(poll_interval, BACKOFF_BASE * 2 ** (failures - 1))
+    return random.uniform(delay / 2.0, delay)
+
+
+def net_worker(net, func, poll_interval, notify=False):
+    """
+    Blocking function periodically calls ``func(net)``.
+
+    :param bool notify: when True, ``func`` is called again as soon as new
+                        messages of the network are saved.
+    """
+    from x84.bbs.msgbase import get_newmsg_count, wait_newmsg
+    log = logging.getLogger(__name__)
+    failures = 0
+    while True:
+        count = get_newmsg_count(net['name'])
+        # pylint: disable=W0703
+        #         Catching too general exception
+        try:
+            success = func(net) is not False
+        except Exception as err:
+            log.exception('[{net[name]}] {err}'.format(net=net, err=err))
+            success = False
+        failures = 0 if success else failures + 1
+        delay = get_backoff(poll_interval, failures)
+        if failures:
+            log.warn('[{net[name]}] {func} failed {num} time(s), retry in '
+                     '{delay:0.0f}s.'.format(net=net, func=func.__name__,
+                                             num=failures, delay=delay))
+        elif notify:
+            wait_newmsg(net['name'], count, delay)
             continue
+        time.sleep(delay)
 
-        # transform, and possibly duplicate(?) message ..
-        with transdb, msgdb, queuedb:
-            transdb[trans_id] = msg_id
-            msg.body = u''.join((msg.body, format_origin_line()))
-            msgdb[msg_id] = msg
-            del queuedb[msg_id]
-        log.info('[{net[name]}] Published (msg_id={msg_id}) => {trans_id}'
-                 .format(net=net, msg_id=msg_id, trans_id=trans_id))
+
+def start_workers(networks, poll_interval):
+    """
+    Start worker threads polling and publishing each of ``networks``.
+
+    Each network is polled and published by its own threads, so that an
+    unreachable network does not delay any other.  New messages are
+    published as they are saved.
+
+    :rtype: list
+    """
+    threads = list()
+    for net in networks:
+        poll_func = (long_poll_network_for_messages if net['poll_wait']
+                     else poll_network_for_messages)
+        for func, notify in ((poll_func, False),
+                             (publish_network_messages, True)):
+            thread = threading.Thread(
+                target=net_worker, args=(net, func, poll_interval, notify),
+                name='msgpoll-{0}-{1}'.format(net['name'], func.__name__))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+    return threads
 
 
 def poller(poll_interval):
@@ -327,9 +643,10 @@ def poller(poll_interval):
     networks = get_networks()
 
     if networks:
-        while True:
-            do_poll(networks)
-            time.sleep(poll_interval)
+        for thread in start_workers(networks, poll_interval):
+            # workers never return, join() is uninterruptible by ^C.
+            while thread.is_alive():
+                thread.join(poll_interval)
     else:
         log.error(u'No networks configured for poll/publish.')
 
@@ -363,19 +680,6 @@ def main(background_daemon=True):
     else:
         poller(poll_interval)
 
-
-def do_poll(networks):
-    """
-    Message polling process.
-
-    Function is called periodically by :func:`poller`.
-    """
-    # pull-from all networks
-    map(poll_network_for_messages, networks)
-
-    # publish-to all networks
-    map(publish_network_messages, networks)
-
 if __name__ == '__main__':
     # load only message polling module when executing this script directly.
     #
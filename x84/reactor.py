@@ -0,0 +1,191 @@
+"""
+Readiness notification for the main event loop of x/84.
+
+File descriptors of server sockets, client sockets and session pipes are
+registered once -- when a connection is accepted, or a session tty is
+registered -- and removed when they are closed.  The engine then blocks in
+:meth:`Reactor.poll` until any of them become ready, rather than building
+and scanning a new list of file descriptors every few milliseconds.
+
+``epoll(7)`` is preferred where available, then ``poll(2)``, and finally
+``select(2)`` as a last resort, which is limited to ``FD_SETSIZE``.
+"""
+# std imports
+import threading
+import logging
+import select
+import errno
+import os
+
+#: singleton, see :func:`get_reactor`
+REACTOR = None
+
+#: event kind of the self-pipe used by :meth:`Reactor.wakeup`
+KIND_WAKEUP = 'wakeup'
+
+
+def get_reactor():
+    """ Return :class:`Reactor` instance of the engine process. """
+    # pylint: disable=W0603
+    #         Using the global statement
+    global REACTOR
+    if REACTOR is None:
+        REACTOR = Reactor()
+    return REACTOR
+
+
+class Reactor(object):
+
+    """
+    Register file descriptors once, and poll for those that are ready.
+
+    Each file descriptor is registered along with the object it belongs
+    to (a server, client, or tty) and a short string describing its
+    ``kind``, which is returned by :meth:`poll` so that the caller may
+    dispatch without searching for the owner of a file descriptor.
+
+    Registration may be performed by any thread, such as the on-connect
+    negotiation threads which spawn new sessions: :meth:`wakeup` is used
+    to interrupt a blocking :meth:`poll` so that the new file descriptors
+    are included without delay.
+    """
+
+    def __init__(self):
+        """ Class initializer. """
+        self.log = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+
+        # fd -> (kind, obj) and obj -> fd
+        self._fds = dict()
+        self._objs = dict()
+
+        if hasattr(select, 'epoll'):
+            self.backend = 'epoll'
+            self._poller = select.epoll()
+            self._mask = select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP
+        elif hasattr(select, 'poll'):
+            self.backend = 'poll'
+            self._poller = select.poll()
+            self._mask = select.POLLIN | select.POLLERR | select.POLLHUP
+        else:
+            self.backend = 'select'
+            self._poller = None
+            self._mask = None
+
+        self._waker = self._make_waker()
+        if self._waker is not None:
+            self.register(self, self._waker[0], KIND_WAKEUP)
+        self.log.debug('reactor using {0}'.format(self.backend))
+
+    @staticmethod
+    def _make_waker():
+        """ Return non-blocking ``(read, write)`` self-pipe, if possible. """
+        try:
+            import fcntl
+        except ImportError:
+            # win32; pipes may not be polled, the caller must instead
+            # provide a timeout to poll().
+            return None
+        pipe_r, pipe_w = os.pipe()
+        for pipe_fd in (pipe_r, pipe_w):
+            flags = fcntl.fcntl(pipe_fd, fcntl.F_GETFL)
+            fcntl.fcntl(pipe_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            flags = fcntl.fcntl(pipe_fd, fcntl.F_GETFD)
+            fcntl.fcntl(pipe_fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+        return pipe_r, pipe_w
+
+    def __contains__(self, obj):
+        return obj in self._objs
+
+    def __len__(self):
+        return len(self._objs)
+
+    def register(self, obj, fd, kind):
+        """
+        Register file descriptor ``fd`` of ``obj`` for read readiness.
+
+        :param object obj: owner of the file descriptor.
+        :param int fd: file descriptor.
+        :param str kind: returned with ``obj`` by :meth:`poll`.
+        """
+        with self._lock:
+            if obj in self._objs:
+                self._forget(obj)
+            if fd in self._fds:
+                # a closed file descriptor number has been re-used
+                # before its previous owner was unregistered.
+                self._forget(self._fds[fd][1])
+            if self._poller is not None:
+                self._poller.register(fd, self._mask)
+            self._fds[fd] = (kind, obj)
+            self._objs[obj] = fd
+
+    def unregister(self, obj):
+        """ Unregister file descriptor of ``obj``, if any. """
+        with self._lock:
+            if obj in self._objs:
+                self._forget(obj)
+
+    def _forget(self, obj):
+        """ Remove ``obj`` from poller, caller must hold lock. """
+        fd = self._objs.pop(obj)
+        del self._fds[fd]
+        if self._poller is not None:
+            try:
+                self._poller.unregister(fd)
+            except (IOError, OSError, KeyError, ValueError):
+                # epoll(7) automatically removes file descriptors that
+                # have been closed, and may raise EBADF or ENOENT.
+                pass
+
+    def wakeup(self):
+        """ Interrupt a blocking :meth:`poll` of the engine thread. """
+        if self._waker is not None:
+            try:
+                os.write(self._waker[1], b'x')
+            except OSError as err:
+                if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+
+    def _drain(self):
+        """ Drain self-pipe of :meth:`wakeup`. """
+        try:
+            while os.read(self._waker[0], 4096):
+                pass
+        except OSError as err:
+            if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def poll(self, timeout=None):
+        """
+        Block until any registered file descriptors are ready for reading.
+
+        :param float timeout: seconds to block, ``None`` blocks indefinitely.
+        :rtype: list
+        :returns: list of ``(kind, obj)`` for each ready file descriptor.
+        :raises select.error: errors other than ``EINTR`` from ``select(2)``.
+        """
+        try:
+            if self.backend == 'epoll':
+                ready = [fd for fd, _ in self._poller.poll(
+                    -1 if timeout is None else timeout)]
+            elif self.backend == 'poll':
+                ready = [fd for fd, _ in self._poller.poll(
+                    None if timeout is None else int(timeout * 1000))]
+            else:
+                with self._lock:
+                    check_r = self._fds.keys()
+                ready, _, _ = select.select(check_r, [], [], timeout)
+        except (IOError, OSError, select.error) as err:
+            if err.args[0] == errno.EINTR:
+                return []
+            raise
+
+        result = []
+        for fd in ready:
+            kind, obj = self._fds.get(fd, (None, None))
+            if kind == KIND_WAKEUP:
+                self._drain()
+            elif kind is not None:
+                result.append((kind, obj))
+        return result
@@ -81,6 +81,18 @@ class SshClient(BaseClient):
             self.log.debug('{self.addrport}: transport shutdown '
                            '{self.__class__.__name__}'.format(self=self))
 
+    def fileno(self):
+        """
+        File descriptor of ssh session channel, polled for input.
+
+        The socket itself is read by paramiko's transport thread, so
+        ``None`` is returned until a channel is negotiated, or when the
+        session is of kind 'sftp', whose i/o is also handled by paramiko.
+        """
+        if self.channel is None or self.kind == 'sftp':
+            return None
+        return self.channel.fileno()
+
     def is_active(self):
         """ Whether this connection is active (bool). """
         if self.transport is None or self.channel is None:
@@ -5,8 +5,12 @@ import codecs
 import sys
 from blessed import Terminal as BlessedTerminal
 
+#: registered terminals, keyed by session id
 TERMINALS = dict()
 
+#: registered terminals, keyed by client
+CLIENT_TERMINALS = dict()
+
 
 class Terminal(BlessedTerminal):
 
@@ -234,14 +238,37 @@ def flush_queue(queue):
 
 
 def register_tty(tty):
-    """ Register a :class:`TerminalProcess` instance. """
+    """
+    Register a :class:`TerminalProcess` instance.
+
+    The session output pipe, ``tty.master_read``, is registered with the
+    engine's :class:`x84.reactor.Reactor`, as is the client, if it was not
+    already registered on accept (such as ssh, whose channel is negotiated
+    only after the connection is accepted).
+    """
+    from x84.reactor import get_reactor
     log = logging.getLogger(__name__)
     log.debug('[{tty.sid}] registered tty'.format(tty=tty))
     TERMINALS[tty.sid] = tty
+    CLIENT_TERMINALS[tty.client] = tty
+
+    if not sys.platform.lower().startswith('win32'):
+        # WIN32's IPC is not done using sockets, it is not possible to poll
+        # them; instead, the engine polls all sessions at every loop.
+        reactor = get_reactor()
+        reactor.register(tty, tty.master_read.fileno(), 'session')
+        client_fd = tty.client.fileno()
+        if tty.client not in reactor and client_fd is not None:
+            reactor.register(tty.client, client_fd, 'client')
+        # we are called by an on-connect negotiation thread, wake the engine
+        # so that it begins polling the new file descriptors immediately.
+        reactor.wakeup()
 
 
 def unregister_tty(tty):
     """ Unregister a :class:`TerminalProcess` instance. """
+    from x84.reactor import get_reactor
+    get_reactor().unregister(tty)
     try:
         flush_queue(tty.master_read)
         tty.master_read.close()
@@ -253,6 +280,8 @@ def unregister_tty(tty):
         # signal tcp socket to close
         tty.client.deactivate()
     del TERMINALS[tty.sid]
+    if CLIENT_TERMINALS.get(tty.client) is tty:
+        del CLIENT_TERMINALS[tty.client]
 
 
 def get_terminals():
@@ -260,17 +289,21 @@ def get_terminals():
     return TERMINALS.items()
 
 
+def get_tty(sid):
+    """ Return terminal registered by session id ``sid``, or None. """
+    return TERMINALS.get(sid)
+
+
 def find_tty(client):
     """ Given a client, return a matching tty, or None if not registered. """
-    try:
-        return next(tty for _, tty in get_terminals() if client == tty.client)
-    except StopIteration:
-        pass
+    return CLIENT_TERMINALS.get(client)
 
 
 def kill_session(client, reason='killed'):
     """ Given a client, shutdown its socket and signal subprocess exit. """
     from x84.bbs.exception import Disconnected
+    from x84.reactor import get_reactor
+    get_reactor().unregister(client)
     client.shutdown()
 
     log = logging.getLogger(__name__)
@@ -393,10 +426,9 @@ def on_naws(client):
 
     This is ultimately handled by :meth:`x84.bbs.session.Session.buffer_event`.
     """
-    for _, tty in get_terminals():
-        if client == tty.client:
-            columns = int(client.env['COLUMNS'])
-            rows = int(client.env['LINES'])
-            tty.master_write.send(('refresh', ('resize', (columns, rows),)))
-            break
+    tty = find_tty(client)
+    if tty is not None:
+        columns = int(client.env['COLUMNS'])
+        rows = int(client.env['LINES'])
+        tty.master_write.send(('refresh', ('resize', (columns, rows),)))
     return True
@@ -19,21 +19,42 @@ Example default.ini settings:
 [msg]
 # The name of the message networks hosted
 server_tags = x84net
+# The maximum number of messages replied to each pull request
+serve_batch = 100
 """
 import logging
+import threading
 import hashlib
 import json
 import time
+import gzip
 import web
 
+from cStringIO import StringIO
+
 #: response for general errors
 RESP_FAIL = json.dumps({u'response': False, u'message': u'Error'})
 
 #: token validation time in seconds
 AUTH_EXPIREY = 15
 
-#: maximum number of messages to reply in batches
-BATCH_MSGS = 20
+#: maximum number of messages to reply in batches, unless configured by
+#: ``serve_batch`` of section ``[msg]``.
+BATCH_MSGS = 100
+
+#: maximum number of seconds a pull request may be held, awaiting new
+#: messages.
+POLL_WAIT_MAX = 300
+
+#: maximum number of pull requests held at once, so that some threads of
+#: the web server remain available.
+POLL_WAIT_SLOTS = threading.BoundedSemaphore(5)
+
+#: maximum number of messages received by a single request.
+BATCH_PUSH_MAX = 500
+
+#: minimum size of json responses compressed, when accepted by the client.
+GZIP_MIN = 1024
 
 #: primary json fields
 VALIDATE_FIELDS = ('network', 'action', 'auth',)
@@ -79,20 +100,31 @@ class MessageApi(object):
                 log_msg=('request without header Auth-X84net.'),
                 status_exc=web.NoMethod)
 
+        # the request is held for up to 'wait' seconds, no more than
+        # POLL_WAIT_MAX, until new messages arrive.
+        try:
+            wait = max(0, min(POLL_WAIT_MAX, int(web.input(wait=0).wait)))
+        except ValueError:
+            raise server_error(
+                log_func=log.info,
+                log_msg='request with invalid wait.',
+                status_exc=web.BadRequest)
+
         # prepare request for message, last is the highest
-        # index previously received by client
+        # index previously received by client.
         response_data = get_response(request_data={
             'auth': web.ctx.env['HTTP_AUTH_X84NET'],
             'network': network,
             'action': 'pull',
-            'last': max(0, int(last)),
+            'last': max(-1, int(last)),
+            'wait': wait,
         })
 
         # return response data as json (200 OK)
         return self._jsonify(response_data, log)
 
     def PUT(self, network, *_):
-        """ PUT method - post messages. """
+        """ PUT method - post a message, or batch of ``messages``. """
         log = logging.getLogger(__name__)
         if 'HTTP_AUTH_X84NET' not in web.ctx.env:
             raise server_error(
@@ -100,14 +132,19 @@ class MessageApi(object):
                 log_msg='request without header Auth-X84net.',
                 status_exc=web.NoMethod)
 
-        # parse incoming message
+        # parse incoming message, or batch of messages
         webdata = web.input()
-        response_data = get_response(request_data={
+        request_data = {
             'auth': web.ctx.env['HTTP_AUTH_X84NET'],
             'network': network,
-            'action': 'push',
-            'message': json.loads(webdata.message)
-        })
+        }
+        if 'messages' in webdata:
+            request_data['action'] = 'push-batch'
+            request_data['messages'] = json.loads(webdata.messages)
+        else:
+            request_data['action'] = 'push'
+            request_data['message'] = json.loads(webdata.message)
+        response_data = get_response(request_data=request_data)
 
         # return response data as json
         return self._jsonify(response_data, log)
@@ -117,14 +154,26 @@ class MessageApi(object):
         """
         Return ``response_data`` as json.
 
+        Responses of at least :data:`GZIP_MIN` bytes are gzip-compressed
+        for clients that accept it.
+
         :raises web.HTTPError: response_data failed to encode to json.
         """
         try:
-            return json.dumps(response_data)
+            data = json.dumps(response_data)
         except ValueError as err:
             log.error('{err}: response_data={response_data!r}'.format(
                 err=err, response_data=response_data))
             raise web.HTTPError('500 Server Error', {}, RESP_FAIL)
+        web.header('Content-Type', 'application/json')
+        if (len(data) >= GZIP_MIN and 'gzip' in
+                web.ctx.env.get('HTTP_ACCEPT_ENCODING', '')):
+            buf = StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as fobj:
+                fobj.write(data)
+            web.header('Content-Encoding', 'gzip')
+            data = buf.getvalue()
+        return data
 
 
 def web_module():
@@ -162,78 +211,131 @@ def server_error(log_func, log_msg, status_exc):
     raise exc
 
 
-def serve_messages_for(board_id, request_data, db_source):
-    """ Reply-to api client request to receive new messages. """
+def find_messages_for(board_id, request_data, db_source):
+    """
+    Find new messages of the network for an api client.
+
+    Messages of the network following index ``last`` of ``request_data``
+    are returned, up to ``serve_batch`` of section ``[msg]``, excluding
+    those received from ``board_id``.
+
+    :rtype: tuple
+    :returns: messages, the index of the last message scanned, or ``None``
+              when none were scanned, and whether no messages remain.
+              Messages excluded are scanned, so that the following
+              request, of ``last`` the index scanned, does not scan them
+              again.
+    """
     # pylint: disable=R0914
     #         Too many local variables (16/15)
-    from x84.bbs import DBProxy, msgbase
-    from x84.bbs.msgbase import to_utctime
+    from x84.bbs import DBProxy, msgbase, get_ini
+    from x84.bbs.msgbase import to_utctime, decompress_body
     log = logging.getLogger(__name__)
-    # log.error(msg)
-    db_tags = DBProxy(msgbase.TAGDB, use_session=False)
+    db_tags = DBProxy(msgbase.TAGDB, table=msgbase.TAGIDX, use_session=False)
     db_messages = DBProxy(msgbase.MSGDB, use_session=False)
-
-    def message_owned_by(msg_id, board_id):
-        """ Whether given message is owned by specified board. """
-        return (msg_id in db_source and
-                db_source[msg_id] == board_id)
-
-    def msgs_after(idx=None):
-        """
-        Generator of network messages following index ``idx```.
-
-        If ``idx`` is None, all messages are returned.
-        """
-        for msg_id in db_tags.get(request_data['network'], []):
-            if idx is None:
-                yield db_messages[idx]
-            elif (int(msg_id) > int(idx) and
-                  not message_owned_by(msg_id, board_id)):
-                yield db_messages[msg_id]
-
-    last_seen = request_data.get('last', None)
-    pending_messages = msgs_after(last_seen)
-    return_messages = list()
-    num_sent = 0
-    for num_sent, msg in enumerate(pending_messages, start=1):
-        return_messages.append({
-            u'id': msg.idx,
-            u'author': msg.author,
-            u'recipient': msg.recipient,
-            u'parent': msg.parent,
-            u'subject': msg.subject,
-            u'tags': list(msg.tags ^ set([request_data['network']])),
-            u'ctime': to_utctime(msg.ctime),
-            u'body': msg.body
-        })
-        if num_sent >= BATCH_MSGS:
-            log.warn('[{request_data[network]}] Batch limit reached for '
-                     'board {board_id}; halting'
-                     .format(request_data=request_data, board_id=board_id))
+    db_bodies = DBProxy(msgbase.MSGDB, table=msgbase.BODYDB,
+                        use_session=False)
+    batch_msgs = get_ini(section='msg', key='serve_batch',
+                         getter='getint') or BATCH_MSGS
+
+    return_messages, last_scanned, exhausted = list(), None, False
+    cursor = request_data.get('last', None)
+    while len(return_messages) < batch_msgs:
+        # seek the next messages of the network, by index.
+        indices = db_tags.proxy_method(
+            'list_after', request_data['network'], cursor,
+            batch_msgs - len(return_messages))
+        if not indices:
+            exhausted = True
             break
-
-    if num_sent > 0:
+        cursor = last_scanned = indices[-1]
+        keys = ['%d' % (idx,) for idx in indices]
+
+        # exclude those messages received from the requesting board
+        keys = [key for key, source in zip(keys, db_source.get_many(keys))
+                if source != board_id]
+        for msg, body in zip(db_messages.get_many(keys),
+                             db_bodies.get_many(keys, u'')):
+            if msg is None:
+                continue
+            return_messages.append({
+                u'id': msg.idx,
+                u'author': msg.author,
+                u'recipient': msg.recipient,
+                u'parent': msg.parent,
+                u'subject': msg.subject,
+                u'tags': list(msg.tags ^ set([request_data['network']])),
+                u'ctime': to_utctime(msg.ctime),
+                u'body': decompress_body(body)
+            })
+
+    if return_messages:
         log.info('[{request_data[network]}] {num_sent} messages '
                  'served to {board_id}'.format(request_data=request_data,
-                                               num_sent=num_sent,
+                                               num_sent=len(return_messages),
                                                board_id=board_id))
 
-    return {u'response': True, u'messages': return_messages}
+    return return_messages, last_scanned, exhausted
 
 
-def receive_message_from(board_id, request_data,
-                         db_source, db_transactions):
-    """ Reply-to api client request to post a new message. """
-    from x84.bbs.msgbase import to_localtime, Msg
-    log = logging.getLogger(__name__)
+def serve_messages_for(board_id, request_data, db_source):
+    """
+    Reply-to api client request to receive new messages.
+
+    When no messages remain, the reply is held for up to ``wait`` seconds
+    of ``request_data`` until new messages of the network are saved.  The
+    reply's ``next`` value is the ``last`` index of the following request,
+    or ``None`` when no messages were scanned, and ``wait`` is the number of
+    seconds requests are allowed to be held, also when messages are
+    replied at once; it is 0 when no more requests may be held.
+    """
+    from x84.bbs.msgbase import get_newmsg_count, wait_newmsg
+    network = request_data['network']
+
+    count = get_newmsg_count(network)
+    messages, cursor, exhausted = find_messages_for(
+        board_id, request_data, db_source)
+
+    wait = request_data.get('wait', 0)
+    if messages or not exhausted or not wait:
+        # replied at once.
+        return {u'response': True, u'messages': messages,
+                u'next': cursor, u'wait': wait}
+
+    if not POLL_WAIT_SLOTS.acquire(False):
+        # all requests held would otherwise occupy the web server.
+        wait = 0
+    else:
+        try:
+            stime = time.time()
+            while (not messages and exhausted and wait_newmsg(
+                    network, count, wait - (time.time() - stime))):
+                count = get_newmsg_count(network)
+                if cursor is not None:
+                    # messages excluded are not scanned again.
+                    request_data = dict(request_data, last=cursor)
+                messages, last_scanned, exhausted = find_messages_for(
+                    board_id, request_data, db_source)
+                if last_scanned is not None:
+                    cursor = last_scanned
+        finally:
+            POLL_WAIT_SLOTS.release()
+
+    return {u'response': True, u'messages': messages,
+            u'next': cursor, u'wait': wait}
+
+
+def to_msg(request_data, pullmsg, db_transactions):
+    """
+    Validate and return message ``pullmsg`` posted to the network.
 
-    if 'message' not in request_data:
-        raise server_error(
-            log_func=log.info,
-            log_msg="request data missing 'message' content",
-            status_exc=web.BadRequest)
+    The returned message is not saved, and has no index.
 
-    pullmsg = request_data['message']
+    :rtype: x84.bbs.msgbase.Msg
+    :raises web.BadRequest: message is missing any of its fields.
+    """
+    from x84.bbs.msgbase import to_localtime, Msg
+    log = logging.getLogger(__name__)
 
     # validate
     for key in (_key for _key in VALIDATE_MSG_KEYS if _key not in pullmsg):
@@ -247,27 +349,165 @@ def receive_message_from(board_id, request_data,
     msg.author = pullmsg['author']
     msg.recipient = pullmsg['recipient']
     msg.subject = pullmsg['subject']
-    msg.parent = pullmsg['parent']
+    if pullmsg['parent'] is not None:
+        # network ids of a hub are its own message indices, unknown
+        # parent messages are not referenced.
+        msg.parent = db_transactions.proxy_method(
+            'get_idx', pullmsg['parent'])
     msg.tags = set(pullmsg['tags'] + [request_data['network']])
     msg.body = pullmsg['body']
 
     # ?? is this removing millesconds, or ?
-    _ctime = to_localtime(pullmsg['ctime'].split('.', 1)[0])
+    # pylint: disable=W0212
+    #         Access to a protected member _ctime of a client class
+    msg._ctime = msg._stime = to_localtime(
+        pullmsg['ctime'].split('.', 1)[0])
+    return msg
+
+
+def store_message(request_data, pullmsg, db_transactions):
+    """
+    Validate and store message ``pullmsg`` posted to the network.
+
+    :rtype: x84.bbs.msgbase.Msg
+    :raises web.BadRequest: message is missing any of its fields.
+    """
+    msg = to_msg(request_data, pullmsg, db_transactions)
+    msg.save(send_net=False, ctime=msg.ctime)
+    db_transactions.proxy_method('add', msg.idx, msg.idx)
+    return msg
+
+
+def store_messages(board_id, network, msgs):
+    """
+    Store messages ``msgs`` posted to ``network`` by ``board_id``.
+
+    Like :func:`x84.msgmail.import_msgs`, indices of all messages are
+    allocated at once, and each database is written by a single
+    transaction: records, bodies, search terms and threads of the
+    msgbase, then tags, private messages, network ids and source.
+    """
+    from x84.db import get_db_service
+    from x84.bbs.msgbase import (MSGDB, BODYDB, SEARCHIDX, THREADIDX, TAGDB,
+                                 READIDX, PRIVDB, TRANSIDX, compress_body,
+                                 broadcast_newmsg)
+    from x84.dbindex import Sequences, split_terms
+    if not msgs:
+        return
+    db_service = get_db_service()
+
+    def write_msgbase(db_msg, db_body, db_search, db_thread, db_seq):
+        """ Allocate indices and write records of all messages. """
+        idx = db_seq.next('unnamed', len(msgs))
+        for msg in msgs:
+            msg.idx, idx = idx, idx + 1
+            key = '%d' % (msg.idx,)
+            db_thread.set_parent(msg.idx, msg.parent)
+            # pylint: disable=W0212
+            #         Access to a protected member _body of a client class
+            db_body[key] = compress_body(msg._body)
+            db_search.set_terms(msg.idx, list(split_terms(msg.subject) |
+                                              split_terms(msg._body)))
+            db_msg[key] = msg
+
+    def write_tags(db_read):
+        """ Write tags of all messages, updating views of unread messages. """
+        for msg in msgs:
+            db_read.set_tags(msg.idx, list(msg.tags))
+
+    def write_privmsg(db_priv):
+        """ Add private messages to those of their recipient. """
+        for msg in msgs:
+            if u'public' not in msg.tags:
+                db_priv.atomic_update(msg.recipient, 'set-add', (msg.idx,))
+
+    def write_trans(db_trans):
+        """ Translate network ids, a hub's own message indices. """
+        for msg in msgs:
+            db_trans.add(msg.idx, msg.idx)
+
+    def write_source(db_source):
+        """ Record the board each message was received from. """
+        db_source.update((msg.idx, board_id) for msg in msgs)
+
+    db_service.call_func(MSGDB, ('unnamed', BODYDB, SEARCHIDX, THREADIDX,
+                                 Sequences.tablename), write_msgbase)
+    db_service.call_func(TAGDB, (READIDX,), write_tags)
+    db_service.call_func(PRIVDB, ('unnamed',), write_privmsg)
+    db_service.call_func('{0}trans'.format(network), (TRANSIDX,),
+                         write_trans)
+    db_service.call_func('{0}source'.format(network), ('unnamed',),
+                         write_source)
+
+    # wake held pull requests, and sessions, once all are stored.
+    for msg in msgs:
+        broadcast_newmsg(msg)
+
+
+def receive_message_from(board_id, request_data,
+                         db_source, db_transactions):
+    """ Reply-to api client request to post a new message. """
+    log = logging.getLogger(__name__)
+
+    if 'message' not in request_data:
+        raise server_error(
+            log_func=log.info,
+            log_msg="request data missing 'message' content",
+            status_exc=web.BadRequest)
 
-    msg.save(send_net=False, ctime=_ctime)
-    with db_source, db_transactions:
+    msg = store_message(request_data, request_data['message'],
+                        db_transactions)
+    with db_source:
         db_source[msg.idx] = board_id
-        db_transactions[msg.idx] = msg.idx
 
     web.ctx.status = '201 Created'
     return {u'response': True, u'id': msg.idx}
 
 
+def receive_messages_from(board_id, request_data, db_transactions):
+    """
+    Reply-to api client request to post a batch of new messages.
+
+    The reply's ``ids`` are the message id of each message posted, or
+    ``None`` for those that are invalid.
+    """
+    log = logging.getLogger(__name__)
+
+    if not isinstance(request_data.get('messages', None), list):
+        raise server_error(
+            log_func=log.info,
+            log_msg="request data missing 'messages' content",
+            status_exc=web.BadRequest)
+    elif len(request_data['messages']) > BATCH_PUSH_MAX:
+        raise server_error(
+            log_func=log.info,
+            log_msg=("request data 'messages' exceeds {0} messages"
+                     .format(BATCH_PUSH_MAX)),
+            status_exc=web.BadRequest)
+
+    msgs = list()
+    for pullmsg in request_data['messages']:
+        try:
+            msgs.append(to_msg(request_data, pullmsg, db_transactions))
+        except web.HTTPError:
+            msgs.append(None)
+    store_messages(board_id, request_data['network'], filter(None, msgs))
+    msg_ids = [msg and msg.idx for msg in msgs]
+
+    log.info('[{request_data[network]}] {num} messages received from '
+             '{board_id}'.format(request_data=request_data,
+                                 num=len(msg_ids) - msg_ids.count(None),
+                                 board_id=board_id))
+    web.ctx.status = '201 Created'
+    return {u'response': True, u'ids': msg_ids}
+
+
 def get_response(request_data):
     """ Serve one API server request and return. """
     # pylint: disable=R0914
     #         Too many local variables (16/15)
     from x84.bbs import DBProxy, get_ini
+    from x84.bbs.msgbase import TRANSIDX
     log = logging.getLogger(__name__)
 
     # validate primary json request keys
@@ -333,7 +573,8 @@ def get_response(request_data):
     # these need to be better named for their transmission direction,
     # its very clear how they are consumed as they are currently named.
     db_source = DBProxy('{0}source'.format(tag), use_session=False)
-    db_transactions = DBProxy('{0}trans'.format(tag), use_session=False)
+    db_transactions = DBProxy('{0}trans'.format(tag),
+                              table=TRANSIDX, use_session=False)
 
     if request_data.get('action', None) == 'pull':
         # client is requesting to pull messages
@@ -341,6 +582,12 @@ def get_response(request_data):
                                   request_data=request_data,
                                   db_source=db_source)
 
+    elif request_data.get('action', None) == 'push-batch':
+        # client is sending a batch of messages to the network
+        return receive_messages_from(board_id=board_id,
+                                     request_data=request_data,
+                                     db_transactions=db_transactions)
+
     elif request_data.get('action', None) == 'push':
         # client is sending a message to the network
         return receive_message_from(board_id=board_id,